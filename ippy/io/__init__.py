@@ -3,4 +3,17 @@ import sys
 from .mt_copy import mt_copy2
 
 if sys.version_info[:2] >= (3, 7):
+    from .backends import available_backends, get_backend, set_default_backend
+    from .combine import combine_chips
+    from .cutouts import Cutouts, extract_cutouts
+    from .detrend import (
+        DETREND_CACHE,
+        DetrendCache,
+        detrend_ota,
+        get_detrend_frame,
+        overscan_bias,
+        subtract_overscan_bias,
+    )
+    from .header_index import HeaderIndex, read_fits_headers
     from .read_fits import read_cell, read_chip
+    from .write_fits import write_cell, write_chip, write_hdus
@@ -0,0 +1,182 @@
+import re
+import warnings
+
+from astropy.io import fits
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
+
+# keywords of the structure of the raw HDU, including the binary table of a tile-compressed image, which astropy
+# recomputes from the data
+structural_keyword_pattern = re.compile(
+    r"(SIMPLE|EXTEND|XTENSION|BITPIX|NAXIS\d*|PCOUNT|GCOUNT|BZERO|BSCALE|BLANK|CHECKSUM|DATASUM|TFIELDS|THEAP"
+    r"|T(TYPE|FORM|UNIT|DIM)\d+"
+    r"|Z(IMAGE|SIMPLE|EXTEND|TENSION|BITPIX|NAXIS\d*|TILE\d+|CMPTYPE|NAME\d+|VAL\d+|QUANTIZ|DITHER0|BLOCKED"
+    r"|PCOUNT|GCOUNT|HECKSUM|DATASUM))"
+)
+
+# ZQUANTIZ values of the quantize methods of CompImageHDU
+QUANTIZE_METHODS = {
+    "NO_DITHER": -1,
+    "SUBTRACTIVE_DITHER_1": 1,
+    "SUBTRACTIVE_DITHER_2": 2,
+}
+# ZNAMEn parameters of the compression mapped to the arguments of CompImageHDU
+COMPRESSION_PARAMETERS = {
+    "NOISEBIT": "quantize_level",
+    "SCALE": "hcomp_scale",
+    "SMOOTH": "hcomp_smooth",
+}
+
+
+class AstropyBackend:
+    """
+    FITS access through astropy.io.fits, with lazily loaded HDUs
+    """
+
+    name = "astropy"
+
+    def open_hdul(self, cls, path):
+        return cls.fromfile(path, mode="readonly")
+
+    def read_headers(self, path):
+        # the headers of compressed images are the headers of the images
+        with fits.open(path, mode="readonly", lazy_load_hdus=True) as hdul:
+            return [hdu.header.copy() for hdu in hdul]
+
+    def read_image(self, path, ext=1, rows=None, cols=None):
+        with fits.open(path, mode="readonly") as hdul:
+            return hdul[ext].section[
+                slice(None) if rows is None else slice(*rows),
+                slice(None) if cols is None else slice(*cols),
+            ]
+
+
+class FitsioBackend:
+    """
+    FITS access through fitsio, the wrapper of cfitsio, whose decompression of tile-compressed images and header
+    parsing are faster than those of astropy
+
+    The HDUs are read eagerly into in-memory astropy HDUs, so that ChipHDUList and CellHDUList keep their API. The
+    compressed images become CompImageHDUs with the compression of their ZCMPTYPE, ZTILEn, ZQUANTIZ, ZDITHER0 and
+    ZNAMEn/ZVALn keywords, so that write_chip and write_cell compress them again the same way.
+    """
+
+    name = "fitsio"
+
+    def __init__(self):
+        if fitsio is None:
+            raise ImportError("The fitsio backend requires the fitsio package.")
+
+    @staticmethod
+    def _astropy_header(fitsio_header):
+        header = fits.Header()
+        for record in fitsio_header.records():
+            if structural_keyword_pattern.fullmatch(record["name"] or ""):
+                continue
+            if record.get("card_string"):
+                header.append(fits.Card.fromstring(record["card_string"]))
+            else:
+                header.append(
+                    (record["name"], record.get("value"), record.get("comment", ""))
+                )
+        return header
+
+    @staticmethod
+    def _compression_settings(fitsio_header):
+        # CompImageHDU arguments of the Z keywords of a compressed image, None if they are missing
+        if "ZCMPTYPE" not in fitsio_header:
+            return None
+        settings = {"compression_type": fitsio_header["ZCMPTYPE"].strip()}
+        tile_shape = []
+        while f"ZTILE{len(tile_shape) + 1}" in fitsio_header:
+            tile_shape.append(int(fitsio_header[f"ZTILE{len(tile_shape) + 1}"]))
+        if tile_shape:
+            # numpy order
+            settings["tile_shape"] = tuple(tile_shape[::-1])
+        if "ZQUANTIZ" in fitsio_header:
+            settings["quantize_method"] = QUANTIZE_METHODS.get(
+                fitsio_header["ZQUANTIZ"].strip(), -1
+            )
+        if "ZDITHER0" in fitsio_header:
+            settings["dither_seed"] = int(fitsio_header["ZDITHER0"])
+        idx = 1
+        while f"ZNAME{idx}" in fitsio_header:
+            argument = COMPRESSION_PARAMETERS.get(
+                fitsio_header[f"ZNAME{idx}"].strip().upper()
+            )
+            if argument is not None:
+                settings[argument] = fitsio_header[f"ZVAL{idx}"]
+            idx += 1
+        return settings
+
+    def open_hdul(self, cls, path):
+        hdus = []
+        with fitsio.FITS(str(path)) as fits_file:
+            for idx, hdu in enumerate(fits_file):
+                fitsio_header = hdu.read_header()
+                header = self._astropy_header(fitsio_header)
+                data = hdu.read() if hdu.has_data() else None
+                if idx == 0:
+                    hdus.append(fits.PrimaryHDU(data, header))
+                elif hdu.get_exttype() == "IMAGE_HDU" and hdu.is_compressed():
+                    settings = self._compression_settings(fitsio_header)
+                    if settings is None:
+                        warnings.warn(
+                            f"No compression keywords of HDU {idx} of '{str(path)}', it is read as an uncompressed "
+                            "image."
+                        )
+                        hdus.append(fits.ImageHDU(data, header))
+                    else:
+                        hdus.append(fits.CompImageHDU(data, header, **settings))
+                elif hdu.get_exttype() == "IMAGE_HDU":
+                    hdus.append(fits.ImageHDU(data, header))
+                else:
+                    hdus.append(fits.BinTableHDU(data, header))
+        return cls(hdus)
+
+    def read_headers(self, path):
+        with fitsio.FITS(str(path)) as fits_file:
+            return [self._astropy_header(hdu.read_header()) for hdu in fits_file]
+
+    def read_image(self, path, ext=1, rows=None, cols=None):
+        with fitsio.FITS(str(path)) as fits_file:
+            return fits_file[ext][
+                slice(None) if rows is None else slice(*rows),
+                slice(None) if cols is None else slice(*cols),
+            ]
+
+
+BACKENDS = {"astropy": AstropyBackend, "fitsio": FitsioBackend}
+_default_backend = "astropy"
+
+
+def available_backends():
+    """
+    names of the FITS backends whose packages are installed
+    """
+    return [name for name in BACKENDS if name != "fitsio" or fitsio is not None]
+
+
+def set_default_backend(name):
+    """
+    set the FITS backend used by read_chip, read_cell and add_mask when none is given, "astropy" or "fitsio"
+    """
+    global _default_backend
+    get_backend(name)
+    _default_backend = name
+
+
+def get_backend(backend=None):
+    """
+    return a FITS backend from its name, by default the default backend, or the given backend object
+    """
+    if backend is None:
+        backend = _default_backend
+    if isinstance(backend, str):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown FITS backend: {backend}")
+        return BACKENDS[backend]()
+    return backend
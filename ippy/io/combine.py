@@ -0,0 +1,197 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from ippy.io.cutouts import _image_hdu, resolve_paths
+from ippy.stats import sigma_clip_stats
+
+# keywords of the input image header that are not copied into the combined image header
+STRUCTURAL_KEYWORDS = {
+    "SIMPLE",
+    "XTENSION",
+    "BITPIX",
+    "NAXIS",
+    "NAXIS1",
+    "NAXIS2",
+    "EXTEND",
+    "PCOUNT",
+    "GCOUNT",
+    "BZERO",
+    "BSCALE",
+    "BLANK",
+    "CHECKSUM",
+    "DATASUM",
+}
+
+
+class _BandReader:
+    # reads row bands of the images of many files, each thread with its own file handles because the HDUs of a
+    # file cannot be read by several threads at once
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._local = threading.local()
+        self._hduls = []
+        self._lock = threading.Lock()
+
+    def _hdus(self):
+        if not hasattr(self._local, "hdus"):
+            hduls = [fits.open(path, mode="readonly") for path in self.paths]
+            with self._lock:
+                self._hduls.extend(hduls)
+            self._local.hdus = [_image_hdu(hdul) for hdul in hduls]
+        return self._local.hdus
+
+    @property
+    def shape(self):
+        return self._hdus()[0].shape
+
+    @property
+    def header(self):
+        return self._hdus()[0].header
+
+    def read(self, row1, row2, out):
+        # only the tiles of compressed images and the rows of uncompressed images of the band are read
+        for idx, hdu in enumerate(self._hdus()):
+            out[idx] = hdu.section[row1:row2]
+        return out
+
+    def close(self):
+        for hdul in self._hduls:
+            hdul.close()
+
+
+def combine_chips(
+    paths,
+    mask_paths=None,
+    method="median",
+    output=None,
+    scales=None,
+    nsigma=3,
+    maxiters=5,
+    ngood_min=1,
+    band_rows=256,
+    max_workers=4,
+    overwrite=False,
+):
+    """
+    sigma clipped mean or median of many chip images, e.g. to build flats, darks or diagnostic medians, computed in
+    row bands so that only a few bands of all inputs are in memory at once
+
+    Each band of all inputs is read through memory mapping or, for tile-compressed images, by decompressing only the
+    tiles of the band, the masked pixels are excluded, and the band is combined with ippy.stats.sigma_clip_stats.
+    The bands are processed by a pool of threads and written to the output in order as soon as they are done.
+
+    Parameters
+    ----------
+    paths : list of str
+        real or nebulous paths of the chip images of the same shape
+    mask_paths : list of str, optional
+        paths of the masks of the chip images, whose pixels > 0 are excluded, by default None
+    method : str, optional
+        "mean" or "median", by default "median"
+    output : str, optional
+        path of the FITS file of the combined image, with the image in the first extension like the chip images, by
+        default None to return the combined image
+    scales : array_like, optional
+        divisors of the inputs before they are combined, e.g. their median for a flat, by default None
+    nsigma : float, optional
+        number of standard deviations of the clipping bounds, by default 3
+    maxiters : int, optional
+        maximum number of clipping iterations, by default 5
+    ngood_min : int, optional
+        minimum number of kept values of a pixel to have a valid value, by default 1
+    band_rows : int, optional
+        number of rows of a band, by default 256
+    max_workers : int, optional
+        number of threads combining the bands, by default 4
+    overwrite : bool, optional
+        whether to overwrite output, by default False
+
+    Returns
+    -------
+    numpy.ndarray or str
+        the combined float32 image with NaN where fewer than ngood_min values are kept, or output if given
+    """
+    if method not in ("mean", "median"):
+        raise ValueError("method must be 'mean' or 'median'")
+    paths = list(paths)
+    if mask_paths is not None:
+        mask_paths = list(mask_paths)
+        if len(mask_paths) != len(paths):
+            raise ValueError("mask_paths and paths must have the same length.")
+    real_paths = resolve_paths(paths + (mask_paths or []))
+    missing = [path for path, real_path in real_paths.items() if real_path is None]
+    if missing:
+        raise FileNotFoundError(f"No such file: '{str(missing[0])}'")
+    images = _BandReader([real_paths[path] for path in paths])
+    masks = (
+        None
+        if mask_paths is None
+        else _BandReader([real_paths[path] for path in mask_paths])
+    )
+    if scales is not None:
+        scales = np.asarray(scales, dtype=np.float32).reshape(-1, 1, 1)
+    num_row, num_col = images.shape
+    stat_idx = 0 if method == "mean" else 1
+
+    def combine_band(row1):
+        row2 = min(row1 + band_rows, num_row)
+        band = images.read(
+            row1, row2, np.empty((len(paths), row2 - row1, num_col), dtype=np.float32)
+        )
+        if masks is not None:
+            mask_band = masks.read(row1, row2, np.empty(band.shape, dtype=np.int32))
+            band[mask_band > 0] = np.nan
+        if scales is not None:
+            band /= scales
+        return sigma_clip_stats(
+            band, sigma=nsigma, axis=0, maxiters=maxiters, ngood_min=ngood_min
+        )[stat_idx].astype(np.float32, copy=False)
+
+    if output is None:
+        combined = np.empty((num_row, num_col), dtype=np.float32)
+    else:
+        header = fits.ImageHDU().header
+        header["BITPIX"] = -32
+        header["NAXIS"] = 2
+        header["NAXIS1"] = num_col
+        header["NAXIS2"] = num_row
+        for card in images.header.cards:
+            if card.keyword not in STRUCTURAL_KEYWORDS and card.keyword:
+                header.append(card)
+        header["NCOMBINE"] = (len(paths), "number of combined images")
+        header["COMBMETH"] = (method, "sigma clipped combine method")
+        fits.PrimaryHDU().writeto(output, overwrite=overwrite)
+        combined = fits.StreamingHDU(output, header)
+
+    # at most two bands per worker are pending at once to bound the memory
+    bands = iter(range(0, num_row, band_rows))
+    row1 = 0
+    try:
+        with ThreadPoolExecutor(max_workers) as executor:
+            pending = deque()
+            for band_row1 in bands:
+                pending.append(executor.submit(combine_band, band_row1))
+                if len(pending) >= 2 * max_workers:
+                    break
+            while pending:
+                band = pending.popleft().result()
+                next_row1 = next(bands, None)
+                if next_row1 is not None:
+                    pending.append(executor.submit(combine_band, next_row1))
+                if output is None:
+                    combined[row1 : row1 + band.shape[0]] = band
+                else:
+                    combined.write(band)
+                row1 += band.shape[0]
+    finally:
+        images.close()
+        if masks is not None:
+            masks.close()
+        if output is not None:
+            combined.close()
+    return combined if output is None else output
@@ -0,0 +1,178 @@
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import numpy as np
+from astropy.io import fits
+
+from ippy.nebulous import neb_locate_bulk
+
+# fraction of the image in the tiles covering the stamps of a file above which the whole image is decompressed at
+# once instead of the tiles of each stamp
+FULL_READ_FRACTION = 0.5
+
+
+class Cutouts(NamedTuple):
+    data: np.ndarray
+    mask: Optional[np.ndarray]
+    found: np.ndarray
+
+
+def resolve_paths(paths):
+    """
+    resolve real paths and nebulous paths, the latter with a single neb_locate_bulk call
+
+    Parameters
+    ----------
+    paths : iterable of str
+        real or nebulous paths
+
+    Returns
+    -------
+    dict
+        the given paths mapped to the real path of the first instance, or None if not found
+    """
+    resolved = {}
+    neb_paths = []
+    for path in dict.fromkeys(paths):
+        if path is None:
+            continue
+        if Path(path).expanduser().is_file():
+            resolved[path] = Path(path).expanduser()
+        else:
+            neb_paths.append(path)
+    for path, instances in neb_locate_bulk(neb_paths).items():
+        resolved[path] = instances[0]["path"] if instances else None
+    return resolved
+
+
+def _image_hdu(hdul):
+    # the first 2d image, which is the CompImageHDU of the compressed chip images
+    for hdu in hdul:
+        if hdu.is_image and hdu.header.get("NAXIS") == 2:
+            return hdu
+    raise ValueError("No 2d image found.")
+
+
+def _num_tile_pix(hdu, shape):
+    # upper bound of the number of pixels of the tiles covering a stamp of shape, which are decompressed for it
+    if not isinstance(hdu, fits.CompImageHDU):
+        return shape[0] * shape[1]
+    tile_shape = [min(int(t), n) for t, n in zip(hdu.tile_shape, hdu.shape)]
+    return np.prod(
+        [min((-(-s // t) + 1) * t, n) for s, t, n in zip(shape, tile_shape, hdu.shape)]
+    )
+
+
+def _cut_stamps(path, rows, cols, shape, fill, dtype):
+    # stamps of shape whose first pixels are at rows and cols of the image of path, filled outside the image
+    stamps = np.full((len(rows),) + shape, fill, dtype=dtype)
+    with fits.open(path, mode="readonly") as hdul:
+        hdu = _image_hdu(hdul)
+        num_row, num_col = hdu.shape
+        if (
+            len(rows) * _num_tile_pix(hdu, shape)
+            > FULL_READ_FRACTION * num_row * num_col
+        ):
+            image = hdu.data
+        else:
+            # only the tiles that cover each stamp are decompressed
+            image = hdu.section
+        for stamp, row, col in zip(stamps, rows, cols):
+            row1, row2 = max(row, 0), min(row + shape[0], num_row)
+            col1, col2 = max(col, 0), min(col + shape[1], num_col)
+            if row1 < row2 and col1 < col2:
+                stamp[row1 - row : row2 - row, col1 - col : col2 - col] = image[
+                    row1:row2, col1:col2
+                ]
+    return stamps
+
+
+def extract_cutouts(
+    paths, x, y, size=(64, 64), mask_paths=None, origin=0, max_workers=8
+):
+    """
+    extract postage stamps around many positions on many images, e.g. chip images of transient candidates
+
+    The positions are grouped by file, the nebulous paths are resolved in one batch, and the files are read in
+    parallel, decompressing only the tiles that cover the stamps unless the stamps cover a large part of the image.
+
+    Parameters
+    ----------
+    paths : list of str
+        real or nebulous paths of the images, one per position
+    x : array_like
+        column of the stamp centers
+    y : array_like
+        row of the stamp centers
+    size : int or tuple, optional
+        (height, width) of the stamps, by default (64, 64)
+    mask_paths : list of str, optional
+        paths of the masks of the images, one per position or None to skip, by default None
+    origin : int, optional
+        0 if x and y are numpy indices or 1 if they are FITS pixel coordinates, by default 0
+    max_workers : int, optional
+        maximum number of files read at once, by default 8
+
+    Returns
+    -------
+    Cutouts
+        data: float32 stamps of shape (N, height, width), NaN outside the images or for missing files;
+        mask: int32 mask stamps of the same shape, 0 outside the masks, or None without mask_paths;
+        found: whether the image (and mask) file of each position was found
+    """
+    paths = list(paths)
+    shape = (size, size) if np.isscalar(size) else tuple(size)
+    # the first pixel of the stamps
+    rows = (
+        np.floor(np.asarray(y, dtype=float) - origin + 0.5).astype(int) - shape[0] // 2
+    )
+    cols = (
+        np.floor(np.asarray(x, dtype=float) - origin + 0.5).astype(int) - shape[1] // 2
+    )
+    if not len(paths) == rows.size == cols.size:
+        raise ValueError("paths, x and y must have the same length.")
+    if mask_paths is not None:
+        mask_paths = list(mask_paths)
+        if len(mask_paths) != len(paths):
+            raise ValueError("mask_paths and paths must have the same length.")
+    real_paths = resolve_paths(
+        paths if mask_paths is None else paths + [p for p in mask_paths if p]
+    )
+    data = np.full((len(paths),) + shape, np.nan, dtype=np.float32)
+    mask = None if mask_paths is None else np.zeros(data.shape, dtype=np.int32)
+    found = np.ones(len(paths), dtype=bool)
+
+    jobs = {}
+    for idx, path in enumerate(paths):
+        jobs.setdefault((path, False), []).append(idx)
+        if mask_paths is not None and mask_paths[idx]:
+            jobs.setdefault((mask_paths[idx], True), []).append(idx)
+
+    def cut(job):
+        (path, is_mask), idxs = job
+        if real_paths.get(path) is None:
+            return job, None
+        return job, _cut_stamps(
+            real_paths[path],
+            rows[idxs],
+            cols[idxs],
+            shape,
+            0 if is_mask else np.nan,
+            np.int32 if is_mask else np.float32,
+        )
+
+    missing = []
+    with ThreadPoolExecutor(max_workers) as executor:
+        for ((path, is_mask), idxs), stamps in executor.map(cut, jobs.items()):
+            if stamps is None:
+                missing.append(path)
+                found[idxs] = False
+            elif is_mask:
+                mask[idxs] = stamps
+            else:
+                data[idxs] = stamps
+    if missing:
+        warnings.warn(f"{len(missing)} files not found, e.g. '{missing[0]}'.")
+    return Cutouts(data, mask, found)
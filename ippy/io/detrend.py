@@ -0,0 +1,355 @@
+import threading
+import warnings
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from ippy.misc import find_detrend_imfile
+from ippy.nebulous import neb_locate
+from ippy.stats import sigma_clip_stats
+
+
+def _running_median(x, window):
+    # running median along the last axis with the edges padded by their nearest values
+    half = window // 2
+    padded = np.pad(x, [(0, 0)] * (x.ndim - 1) + [(half, half)], mode="edge")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(
+            np.lib.stride_tricks.sliding_window_view(padded, window, axis=-1),
+            axis=-1,
+        )
+
+
+def overscan_bias(cube, camera, method="row", window=31, nsigma=3, maxiters=5):
+    """
+    estimate the bias of all untrimmed cells at once from their overscan columns and rows
+
+    Parameters
+    ----------
+    cube : numpy.ndarray
+        3d array of the untrimmed cells of shape (num_cells, cell_num_pix_row_untrimmed, cell_num_pix_col_untrimmed),
+        e.g. from CellHDUList.get_cube
+    camera : ippy.constants.pixels.Camera
+        camera of the cells
+    method : str, optional
+        "row" for the median of the overscan columns of each row smoothed by a running median over window rows, which
+        the overscan rows cannot contribute to, or "scalar" for the sigma clipped median of all overscan pixels of each
+        cell, i.e. the overscan columns and rows, by default "row"
+    window : int, optional
+        number of rows of the running median of the row-wise bias, by default 31
+    nsigma : float, optional
+        number of standard deviations of the clipping bounds of the scalar bias, by default 3
+    maxiters : int, optional
+        maximum number of clipping iterations of the scalar bias, by default 5
+
+    Returns
+    -------
+    numpy.ndarray
+        bias of shape (num_cells, cell_num_pix_row_untrimmed) for "row" or (num_cells,) for "scalar", NaN for cells
+        without valid overscan pixels
+    """
+    if cube.shape[1:] != (
+        camera.cell_num_pix_row_untrimmed,
+        camera.cell_num_pix_col_untrimmed,
+    ):
+        raise ValueError("The bias can only be estimated from untrimmed cells.")
+    overscan = cube[:, :, camera.cell_num_pix_col :]
+    if method == "scalar":
+        # the overscan columns of the imaging rows, then the overscan rows including their overscan columns
+        overscan = np.concatenate(
+            [
+                overscan[:, : camera.cell_num_pix_row].reshape(len(cube), -1),
+                cube[:, camera.cell_num_pix_row :].reshape(len(cube), -1),
+            ],
+            axis=1,
+        )
+        return sigma_clip_stats(overscan, sigma=nsigma, axis=1, maxiters=maxiters)[1]
+    elif method == "row":
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            row_bias = np.nanmedian(overscan, axis=2)
+        return _running_median(row_bias, window).astype(cube.dtype, copy=False)
+    else:
+        raise ValueError("method must be 'row' or 'scalar'")
+
+
+def subtract_overscan_bias(cube, camera, method="row", **kwargs):
+    """
+    subtract the bias estimated by overscan_bias from the untrimmed cells in place
+
+    Parameters
+    ----------
+    cube : numpy.ndarray
+        3d float array of the untrimmed cells, modified in place
+    camera : ippy.constants.pixels.Camera
+        camera of the cells
+    method : str, optional
+        "row" or "scalar", see overscan_bias, by default "row"
+    **kwargs
+        other arguments of overscan_bias
+
+    Returns
+    -------
+    numpy.ndarray
+        the subtracted bias
+    """
+    if cube.dtype.kind != "f":
+        raise TypeError("The bias can only be subtracted in place from a float cube.")
+    bias = overscan_bias(cube, camera, method=method, **kwargs)
+    if method == "row":
+        cube -= bias[:, :, np.newaxis]
+    else:
+        cube -= bias[:, np.newaxis, np.newaxis]
+    return bias
+
+
+class DetrendCache:
+    """
+    memory-bounded LRU cache of detrend frames keyed by (dbname, det_id, iteration, OTA)
+
+    A frame is read once and kept until the cached frames exceed max_bytes, when the least recently used frames are
+    dropped. The cache can be shared by threads processing different exposures.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        maximum total size of the cached frames, by default 4 GiB, i.e. about 40 float32 OTA frames
+    """
+
+    def __init__(self, max_bytes=4 * 2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    def get(self, key, load):
+        """
+        return the cached frame of key, calling load() to read it on a miss
+        """
+        with self._lock:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                self.hits += 1
+                return self._frames[key]
+            self.misses += 1
+        # read outside the lock so that other frames can be served meanwhile
+        frame = load()
+        with self._lock:
+            if key not in self._frames:
+                self._frames[key] = frame
+                self.nbytes += frame.nbytes
+            # keep at least the newest frame even if it alone exceeds max_bytes
+            while self.nbytes > self.max_bytes and len(self._frames) > 1:
+                _, dropped = self._frames.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+            return self._frames[key]
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+
+
+# the cache shared by the detrend calls that are not given their own
+DETREND_CACHE = DetrendCache()
+
+
+def _resolve_path(data):
+    # a real path, or the path of the first instance of a nebulous path
+    path = Path(data).expanduser()
+    if not path.is_file():
+        instances = neb_locate(data)
+        if instances:
+            path = instances[0]["path"]
+        else:
+            raise FileNotFoundError(f"No such file: '{str(data)}'")
+    return path
+
+
+def read_detrend_cube(path, camera, mask=False):
+    """
+    read a detrend file of an OTA into a cube of its trimmed cells
+
+    Parameters
+    ----------
+    path : str
+        path or nebulous path of the detrend file with one extension per cell
+    camera : ippy.constants.pixels.Camera
+        camera of the detrend
+    mask : bool, optional
+        whether the detrend is a mask, by default False
+
+    Returns
+    -------
+    numpy.ndarray
+        3d array of shape (num_cell_per_chip, cell_num_pix_row, cell_num_pix_col) in the order of camera.cells, float32
+        with NaN for missing cells, or uint16 with 0 for missing cells if mask
+    """
+    # the detrend files do not necessarily have the TELESCOP and INSTRUME keywords required by read_cell
+    from ippy.io.read_fits import CellHDUList
+
+    shape = (camera.cell_num_pix_row, camera.cell_num_pix_col)
+    cube = np.full(
+        (camera.num_cell_per_chip,) + shape,
+        0 if mask else np.nan,
+        dtype=np.uint16 if mask else np.float32,
+    )
+    with CellHDUList.fromfile(_resolve_path(path), mode="readonly") as cell_hdul:
+        extnames = {hdu.name.upper(): idx for idx, hdu in enumerate(cell_hdul)}
+        for idx, cell in enumerate(camera.cells):
+            hdu_idx = extnames.get(cell.upper())
+            if hdu_idx is None or cell_hdul[hdu_idx].data is None:
+                continue
+            cell_img = cell_hdul[hdu_idx].data[: shape[0], : shape[1]]
+            if cell_img.shape == shape:
+                cube[idx] = cell_img
+    return cube
+
+
+def _detrend_key(detrend):
+    # det_id or (det_id, iteration)
+    if isinstance(detrend, (tuple, list)):
+        det_id, iteration = detrend
+    else:
+        det_id, iteration = detrend, None
+    return int(det_id), None if iteration is None else int(iteration)
+
+
+def get_detrend_frame(detrend, ota, camera, dbname="gpc1", mask=False, cache=None):
+    """
+    return the trimmed cube of a detrend of an OTA, read at most once through the cache
+
+    Parameters
+    ----------
+    detrend : int or tuple
+        det_id, or (det_id, iteration) of the detrend
+    ota : str
+        OTA name, e.g. "XY01"
+    camera : ippy.constants.pixels.Camera
+        camera of the detrend
+    dbname : str, optional
+        gpc1 or gpc2, by default "gpc1"
+    mask : bool, optional
+        whether the detrend is a mask, by default False
+    cache : DetrendCache, optional
+        cache of the frames, by default the shared DETREND_CACHE
+
+    Returns
+    -------
+    numpy.ndarray
+        the cube of the detrend, see read_detrend_cube. It is shared by the cache and must not be modified.
+    """
+    cache = DETREND_CACHE if cache is None else cache
+    det_id, iteration = _detrend_key(detrend)
+    ota = ota.upper()
+
+    def load():
+        uris = find_detrend_imfile(det_id, ota=ota, iteration=iteration, dbname=dbname)
+        frame = read_detrend_cube(uris[ota], camera, mask=mask)
+        frame.flags.writeable = False
+        return frame
+
+    return cache.get((dbname, det_id, iteration, ota), load)
+
+
+def detrend_ota(
+    cell_hdul,
+    ota=None,
+    bias="row",
+    dark=None,
+    flat=None,
+    mask=None,
+    dark_scale=1.0,
+    dbname=None,
+    cache=None,
+):
+    """
+    apply the bias, dark, flat and mask to all cells of a raw OTA at once in float32
+
+    The detrend frames are read through the cache, so detrending many exposures reads each frame once.
+
+    Parameters
+    ----------
+    cell_hdul : CellHDUList
+        raw OTA from read_cell, preferably with trim_overscan=False for the overscan bias
+    ota : str, optional
+        OTA name of the detrend files, by default the EXTNAME of the primary header
+    bias : str, optional
+        "row" or "scalar" to subtract the bias estimated from the overscan of untrimmed cells, "header" to subtract
+        the BIASLVL keyword of each cell, or None to skip, by default "row"
+    dark : int or tuple, optional
+        det_id, or (det_id, iteration) of the dark to subtract, by default None to skip
+    flat : int or tuple, optional
+        det_id, or (det_id, iteration) of the flat to divide by, by default None to skip
+    mask : int or tuple, optional
+        det_id, or (det_id, iteration) of the mask whose non-zero pixels are set to NaN, by default None to skip
+    dark_scale : float, optional
+        scale of the dark frame before it is subtracted, e.g. the ratio of the exposure times, by default 1.0
+    dbname : str, optional
+        gpc1 or gpc2 of the detrends, by default the instrument of cell_hdul
+    cache : DetrendCache, optional
+        cache of the detrend frames, by default the shared DETREND_CACHE
+
+    Returns
+    -------
+    tuple
+        3d float32 array of the detrended trimmed cells in the order of camera.cells, and the 3d array of the mask
+        of the cells or None if no mask is applied
+    """
+    camera = cell_hdul.camera
+    if ota is None:
+        ota = cell_hdul[0].header.get("EXTNAME")
+        if ota is None:
+            raise ValueError("ota must be given when the primary header has no EXTNAME")
+    if dbname is None:
+        dbname = camera.name.lower()
+    cube = cell_hdul.get_cube()
+    if bias in ("row", "scalar"):
+        if cell_hdul.trim_overscan:
+            raise ValueError(
+                "The overscan has been trimmed, please use read_cell(trim_overscan=False)."
+            )
+        subtract_overscan_bias(cube, camera, method=bias)
+    elif bias == "header":
+        cube -= np.array(
+            [
+                (
+                    np.nan
+                    if (bias_mean := cell_hdul.get_kw_val(cell, "BIASLVL")) is None
+                    else bias_mean
+                )
+                for cell in camera.cells
+            ],
+            dtype=np.float32,
+        )[:, np.newaxis, np.newaxis]
+    elif bias is not None:
+        raise ValueError("bias must be 'row', 'scalar', 'header' or None")
+    cube = cube[:, : camera.cell_num_pix_row, : camera.cell_num_pix_col]
+    if dark is not None:
+        dark_frame = get_detrend_frame(dark, ota, camera, dbname=dbname, cache=cache)
+        if dark_scale == 1:
+            cube -= dark_frame
+        else:
+            cube -= np.float32(dark_scale) * dark_frame
+    if flat is not None:
+        flat_frame = get_detrend_frame(flat, ota, camera, dbname=dbname, cache=cache)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cube /= flat_frame
+        cube[~np.isfinite(cube)] = np.nan
+    mask_frame = None
+    if mask is not None:
+        mask_frame = get_detrend_frame(
+            mask, ota, camera, dbname=dbname, mask=True, cache=cache
+        )
+        cube[mask_frame > 0] = np.nan
+    return cube, mask_frame
@@ -0,0 +1,339 @@
+import os
+import sqlite3
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from astropy.io.fits.header import BLOCK_SIZE
+from astropy.table import Table
+
+from ippy.io.cutouts import resolve_paths
+
+CARD_LENGTH = 80
+# keywords indexed by default, those of the primary header are inherited by the extensions
+DEFAULT_KEYWORDS = (
+    "TELESCOP",
+    "INSTRUME",
+    "MJD-OBS",
+    "EXPTIME",
+    "FILTERID",
+    "OBSTYPE",
+    "BIASLVL",
+    "BACKEST",
+)
+DEFAULT_HEADER_INDEX = os.path.join(
+    os.path.expanduser("~"), ".cache", "ippy", "fits_header_index.sqlite"
+)
+# keywords of the size of the data of an HDU
+_SIZE_KEYWORDS = ("BITPIX", "NAXIS", "PCOUNT", "GCOUNT")
+
+
+def _card_int(card):
+    # integer value of a fixed-format card, which the size keywords must be
+    return int(card[10:].split(b"/")[0])
+
+
+def _data_size(structure):
+    # number of bytes of the data of an HDU including the padding of the last block, see the FITS standard 4.4.1
+    naxis = structure.get("NAXIS", 0)
+    if naxis == 0:
+        return 0
+    num_pix = 1
+    for axis in range(1, naxis + 1):
+        num_pix *= structure[f"NAXIS{axis}"]
+    size = (
+        abs(structure["BITPIX"])
+        // 8
+        * structure.get("GCOUNT", 1)
+        * (structure.get("PCOUNT", 0) + num_pix)
+    )
+    return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def read_fits_headers(path, keywords=None):
+    """
+    read keywords of the headers of all HDUs of a FITS file, parsing only the cards of the keywords and skipping the
+    data, so that a file is read in a few small reads whatever its size
+
+    The headers of tile-compressed images are those of their binary tables, which keep the keywords of the images.
+
+    Parameters
+    ----------
+    path : str
+        path of the FITS file
+    keywords : iterable of str, optional
+        keywords to read, by default None for all keywords but COMMENT, HISTORY and blank ones
+
+    Returns
+    -------
+    list of dict
+        keywords of each HDU mapped to their values, only those present
+    """
+    if keywords is not None:
+        keywords = {keyword.upper() for keyword in keywords}
+    headers = []
+    with open(path, "rb") as fits_file:
+        while True:
+            block = fits_file.read(BLOCK_SIZE)
+            if not block:
+                break
+            if not headers and not block.startswith(b"SIMPLE  ="):
+                raise OSError(f"Not a FITS file: '{str(path)}'")
+            values = {}
+            structure = {}
+            end = False
+            while not end:
+                if len(block) < BLOCK_SIZE:
+                    raise OSError(f"Truncated FITS header in '{str(path)}'.")
+                for idx in range(0, BLOCK_SIZE, CARD_LENGTH):
+                    card = block[idx : idx + CARD_LENGTH]
+                    keyword = card[:8].rstrip().decode("ascii", "replace")
+                    if keyword == "END":
+                        end = True
+                        break
+                    if keyword in _SIZE_KEYWORDS or keyword.startswith("NAXIS"):
+                        structure[keyword] = _card_int(card)
+                    if card[8:10] == b"= " and (
+                        keywords is None or keyword in keywords
+                    ):
+                        values[keyword] = fits.Card.fromstring(
+                            card.decode("ascii", "replace")
+                        ).value
+                if not end:
+                    block = fits_file.read(BLOCK_SIZE)
+            headers.append(values)
+            fits_file.seek(_data_size(structure), os.SEEK_CUR)
+    if not headers:
+        raise OSError(f"Empty FITS file '{str(path)}'.")
+    return headers
+
+
+def _column_name(keyword):
+    # SQL column of a keyword, e.g. "mjd_obs" for "MJD-OBS"
+    return keyword.lower().replace("-", "_")
+
+
+def _sql_value(value):
+    # SQLite value of a keyword value, None for undefined values
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, fits.card.Undefined):
+        return None
+    return str(value)
+
+
+def _masked_column(values):
+    # typed masked array of the values of a column, masked where the keyword is missing
+    mask = np.array([value is None for value in values])
+    present = np.array([value for value in values if value is not None])
+    if present.size == 0:
+        return np.ma.masked_all(len(values))
+    data = np.zeros(len(values), dtype=present.dtype)
+    data[~mask] = present
+    return np.ma.MaskedArray(data, mask=mask)
+
+
+def _scan_file(path, keywords):
+    # stats and keywords of each HDU of a file, with those of the primary header inherited by the extensions
+    stat = os.stat(path)
+    headers = read_fits_headers(path, keywords + ("EXTNAME",))
+    for header in headers[1:]:
+        for keyword, value in headers[0].items():
+            if keyword != "EXTNAME":
+                header.setdefault(keyword, value)
+    return stat.st_mtime, stat.st_size, headers
+
+
+class HeaderIndex:
+    """
+    SQLite index of header keywords of many FITS files, e.g. BIASLVL and BACKEST of all cells of a night, so that
+    they can be queried without reading the files again
+
+    The index has a row per HDU in the table "hdus" with the columns path, hdu, extname and one column per keyword
+    named after it in lower case with "-" replaced by "_", e.g. mjd_obs for MJD-OBS. A file is scanned again only if
+    its mtime or size changed or if it was scanned for fewer keywords.
+
+    Parameters
+    ----------
+    index_path : str, optional
+        path of the SQLite file, by default DEFAULT_HEADER_INDEX, or ":memory:"
+    keywords : iterable of str, optional
+        keywords to index, by default DEFAULT_KEYWORDS
+    """
+
+    def __init__(self, index_path=DEFAULT_HEADER_INDEX, keywords=DEFAULT_KEYWORDS):
+        self.keywords = tuple(dict.fromkeys(keyword.upper() for keyword in keywords))
+        if index_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        self.conn = sqlite3.connect(index_path)
+        with self.conn:
+            self.conn.execute("""
+                create table if not exists files (
+                    path text primary key,
+                    real_path text not null,
+                    mtime real not null,
+                    size integer not null,
+                    keywords text not null
+                )
+                """)
+            self.conn.execute("""
+                create table if not exists hdus (
+                    path text not null,
+                    hdu integer not null,
+                    extname text,
+                    primary key (path, hdu)
+                )
+                """)
+            columns = {row[1] for row in self.conn.execute("pragma table_info(hdus)")}
+            for keyword in self.keywords:
+                if _column_name(keyword) not in columns:
+                    self.conn.execute(
+                        f'alter table hdus add column "{_column_name(keyword)}"'
+                    )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _stale_paths(self, real_paths):
+        # paths whose files changed or were not scanned for all keywords
+        indexed = {
+            row[0]: row[1:]
+            for row in self.conn.execute(
+                "select path, real_path, mtime, size, keywords from files"
+            )
+        }
+        stale = []
+        for path, real_path in real_paths.items():
+            row = indexed.get(path)
+            if row is not None and row[0] == str(real_path):
+                try:
+                    stat = os.stat(real_path)
+                except OSError:
+                    stat = None
+                if (
+                    stat is not None
+                    and (row[1], row[2]) == (stat.st_mtime, stat.st_size)
+                    and set(self.keywords) <= set(row[3].split(","))
+                ):
+                    continue
+            stale.append(path)
+        return stale
+
+    def update(self, paths, max_workers=16):
+        """
+        scan the headers of the files that are not indexed or changed, in parallel, and index their keywords
+
+        Parameters
+        ----------
+        paths : iterable of str
+            real or nebulous paths of FITS files, the latter resolved with a single neb_locate_bulk call
+        max_workers : int, optional
+            number of files read at once, by default 16
+
+        Returns
+        -------
+        int
+            number of scanned files
+        """
+        real_paths = resolve_paths(paths)
+        missing = [path for path, real_path in real_paths.items() if real_path is None]
+        real_paths = {
+            path: real_path
+            for path, real_path in real_paths.items()
+            if real_path is not None
+        }
+        stale = self._stale_paths(real_paths)
+        columns = ["path", "hdu", "extname"] + [
+            _column_name(keyword) for keyword in self.keywords
+        ]
+        insert_hdu = (
+            f"insert into hdus ({', '.join(columns)}) "
+            f"values ({', '.join('?' * len(columns))})"
+        )
+
+        def scan(path):
+            try:
+                return path, _scan_file(real_paths[path], self.keywords)
+            except (OSError, ValueError) as err:
+                return path, err
+
+        failed = []
+        with ThreadPoolExecutor(max_workers) as executor, self.conn:
+            for path, result in executor.map(scan, stale):
+                if isinstance(result, Exception):
+                    failed.append(result)
+                    continue
+                mtime, size, headers = result
+                self.conn.execute("delete from hdus where path = ?", (path,))
+                self.conn.executemany(
+                    insert_hdu,
+                    [
+                        (path, idx, header.get("EXTNAME"))
+                        + tuple(
+                            _sql_value(header.get(keyword)) for keyword in self.keywords
+                        )
+                        for idx, header in enumerate(headers)
+                    ],
+                )
+                self.conn.execute(
+                    "insert or replace into files values (?, ?, ?, ?, ?)",
+                    (path, str(real_paths[path]), mtime, size, ",".join(self.keywords)),
+                )
+        if missing:
+            warnings.warn(f"{len(missing)} files not found, e.g. '{missing[0]}'.")
+        if failed:
+            warnings.warn(f"{len(failed)} files could not be read, e.g. {failed[0]}")
+        return len(stale) - len(failed)
+
+    def query(self, where=None, params=(), columns=None):
+        """
+        select HDUs from the index, e.g. query("backest > ? and mjd_obs >= ?", (1000, 60600)) for the cells with
+        BACKEST > 1000 since MJD 60600
+
+        Parameters
+        ----------
+        where : str, optional
+            SQL condition on the columns, with ? placeholders, by default None for all HDUs
+        params : tuple, optional
+            values of the placeholders, by default ()
+        columns : list of str, optional
+            columns to return, by default None for all
+
+        Returns
+        -------
+        astropy.table.Table
+            the selected HDUs, masked where the keywords are missing
+        """
+        if columns is None:
+            columns = ["path", "hdu", "extname"] + [
+                _column_name(keyword) for keyword in self.keywords
+            ]
+        query = f"select {', '.join(columns)} from hdus"
+        if where:
+            query += f" where {where}"
+        cursor = self.conn.execute(query + " order by path, hdu", params)
+        names = [description[0] for description in cursor.description]
+        rows = cursor.fetchall()
+        if not rows:
+            return Table(names=names, masked=True)
+        return Table(
+            [_masked_column(values) for values in zip(*rows)],
+            names=names,
+            masked=True,
+        )
+
+    def remove(self, paths):
+        """
+        remove files from the index
+        """
+        paths = [(path,) for path in paths]
+        with self.conn:
+            self.conn.executemany("delete from hdus where path = ?", paths)
+            self.conn.executemany("delete from files where path = ?", paths)
@@ -2,14 +2,33 @@ from pathlib import Path
 
 import numpy as np
 from astropy.io.fits import HDUList
+from astropy.table import Table
 from astropy.visualization import ImageNormalize, ZScaleInterval
 from matplotlib import pyplot as plt
 
 from ippy.constants import GPC1, GPC2
+from ippy.io.backends import get_backend
+from ippy.io.detrend import subtract_overscan_bias
+from ippy.misc import CellSet
 from ippy.nebulous import neb_locate
+from ippy.stats import sigma_clip_stats
 
 
-def read_chip(data, mask=None):
+def read_chip(data, mask=None, backend=None):
+    """
+    read a chip image, and its mask if given, into a ChipHDUList
+
+    Args:
+        data (str or pathlib object): real or nebulous path to the chip fits file
+        mask (str or pathlib object, optional): path to the mask fits file. Defaults to None.
+        backend (str, optional): FITS backend, "astropy" or "fitsio", see ippy.io.backends. Defaults to None for the
+            default backend. With "fitsio" the images are read eagerly and a compressed image is rebuilt as a
+            CompImageHDU from its Z keywords, so that write_chip keeps its compression; it is written uncompressed,
+            with a warning at reading, if those keywords are missing.
+
+    Returns:
+        ChipHDUList: HDU list of the chip image
+    """
     path = Path(data).expanduser()
     # check if the FITS file exists
     if not path.is_file():
@@ -18,7 +37,12 @@ def read_chip(data, mask=None):
             path = neb_locate(data)[0]["path"]
         else:
             raise FileNotFoundError(f"No such file: '{str(data)}'")
-    chip_hdul = ChipHDUList.fromfile(path, mode="readonly")
+    # the fitsio backend decompresses the image eagerly and faster than astropy
+    backend = get_backend(backend)
+    chip_hdul = backend.open_hdul(ChipHDUList, path)
+    chip_hdul.backend = backend
+    # keep the original EXTNAME for write_chip
+    chip_hdul.extname = chip_hdul[1].header.get("EXTNAME")
     chip_hdul[1].header["extname"] = "data"
     telescope = chip_hdul[1].header.get("TELESCOP")
     instrument = chip_hdul[1].header.get("INSTRUME")
@@ -35,7 +59,7 @@ def read_chip(data, mask=None):
     return chip_hdul
 
 
-def read_cell(data, mask=None, trim_overscan=True):
+def read_cell(data, mask=None, trim_overscan=True, subtract_bias=None, backend=None):
     path = Path(data).expanduser()
     # check if the FITS file exists
     if not path.is_file():
@@ -44,7 +68,9 @@ def read_cell(data, mask=None, trim_overscan=True):
             path = neb_locate(data)[0]["path"]
         else:
             raise FileNotFoundError(f"No such file: '{str(data)}'")
-    cell_hdul = CellHDUList.fromfile(path, mode="readonly")
+    backend = get_backend(backend)
+    cell_hdul = backend.open_hdul(CellHDUList, path)
+    cell_hdul.backend = backend
     telescope = cell_hdul[0].header.get("TELESCOP")
     instrument = cell_hdul[0].header.get("INSTRUME")
     if telescope == "PS1" or instrument == "gpc1":
@@ -55,6 +81,15 @@ def read_cell(data, mask=None, trim_overscan=True):
         raise ValueError("Telescope or instrument not recognized.")
     cell_hdul.telescope = telescope
     cell_hdul.instrument = instrument
+    if subtract_bias is not None:
+        # subtract the bias from the overscan of all untrimmed cells at once before trimming them
+        cell_hdul.trim_overscan = False
+        cube = cell_hdul.get_cube()
+        subtract_overscan_bias(cube, cell_hdul.camera, method=subtract_bias)
+        for idx, cell in enumerate(cell_hdul.camera.cells):
+            if cell in cell_hdul and cell_hdul[cell].data is not None:
+                if cell_hdul[cell].data.shape == cube.shape[1:]:
+                    cell_hdul[cell].data = cube[idx]
     cell_hdul.trim_overscan = trim_overscan
     if cell_hdul.trim_overscan:
         for hdu in cell_hdul[1:]:
@@ -71,6 +106,39 @@ def read_cell(data, mask=None, trim_overscan=True):
     return cell_hdul
 
 
+def _cell_stats_table(
+    cells, cell_imgs, excluded, nsigma, maxiters, ngood_min, bias=None
+):
+    # table of the statistics of the cell images along the last two axes, excluding NaNs and the pixels in excluded
+    if excluded is not False:
+        cell_imgs = np.where(excluded, np.float32(np.nan), cell_imgs).astype(
+            np.float32, copy=False
+        )
+    mean, median, std, _ = sigma_clip_stats(
+        cell_imgs, sigma=nsigma, axis=(-2, -1), maxiters=maxiters, ngood_min=ngood_min
+    )
+    npix = cell_imgs.shape[-2] * cell_imgs.shape[-1]
+    ngood = np.count_nonzero(np.isfinite(cell_imgs), axis=(-2, -1))
+    # square in float64, which integer images would overflow
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rms = np.sqrt(
+            np.nansum(np.square(cell_imgs, dtype=np.float64), axis=(-2, -1)) / ngood
+        )
+    table = Table(
+        {
+            "cell": cells,
+            "mean": mean.ravel(),
+            "median": median.ravel(),
+            "std": std.ravel(),
+            "rms": rms.ravel(),
+            "masked_frac": 1 - ngood.ravel() / npix,
+        }
+    )
+    if bias is not None:
+        table["bias"] = bias.ravel()
+    return table
+
+
 class ChipHDUList(HDUList):
     """
     HDUList subclass for handling chip fits file that ends with ota.ch.[mk.]fits. When the chip fits file is opened, a `ChipHDUList` object is returned.
@@ -90,7 +158,9 @@ class ChipHDUList(HDUList):
             else:
                 raise FileNotFoundError(f"No such file: '{str(mask_path)}'")
         # with ChipHDUList.fromfile(mask_path, mode="readonly") as mask_hdul:
-        mask_hdul = ChipHDUList.fromfile(mask_path, mode="readonly")
+        mask_hdul = get_backend(getattr(self, "backend", None)).open_hdul(
+            ChipHDUList, mask_path
+        )
         if mask_hdul[1].data.shape == self[1].data.shape:
             self.append(mask_hdul[1])
             self[-1].header["extname"] = "mask"
@@ -148,43 +218,135 @@ class ChipHDUList(HDUList):
         numpy.ndarray
             2d array of the selected cell image
         """
-        # assert chip_fits_pattern.search(cell)
-        # assert cell in CELLS
-        if cell in self.camera.cells:
-            x1 = int(cell[2])
-            x2 = x1 + 1
-            y1 = int(cell[3])
-            y2 = y1 + 1
-        elif cell.startswith("xy"):
-            cell_num_idx = eval("np.s_" + cell[2:])
-            xs = np.arange(self.camera.num_cell_per_row)[cell_num_idx[0]]
-            ys = np.arange(self.camera.num_cell_per_col)[cell_num_idx[1]]
-            if np.array_equiv(xs, np.arange(xs.min(), xs.max() + 1)) and np.array_equiv(
-                ys, np.arange(ys.min(), ys.max() + 1)
-            ):
-                x1, x2 = xs.min(), xs.max() + 1
-                y1, y2 = ys.min(), ys.max() + 1
-            else:
-                raise ValueError("Cells must be spatially continuous.")
-        else:
-            raise ValueError("Invalid cell name.")
-        chip_img = self.get_data(masked=masked)
-        cell_idx = np.s_[
-            y1
-            * (self.camera.cell_num_pix_row + self.camera.cell_num_pix_row_gap) : y2
-            * (self.camera.cell_num_pix_row + self.camera.cell_num_pix_row_gap)
-            - self.camera.cell_num_pix_row_gap,
-            x1
-            * (self.camera.cell_num_pix_col + self.camera.cell_num_pix_col_gap) : x2
-            * (self.camera.cell_num_pix_col + self.camera.cell_num_pix_col_gap)
-            - self.camera.cell_num_pix_col_gap,
-        ]
-        cell_img = chip_img[cell_idx]
+        cell_idx = self._get_cells_idx(cell)
+        cell_img = self.get_data(masked=masked)[cell_idx]
         if return_idx:
             return cell_img, cell_idx
         else:
             return cell_img
 
+    def _get_cells_idx(self, cells):
+        # index of the pixels of a rectangle of cells, including the gaps between them
+        try:
+            cells = CellSet(cells)
+        except ValueError:
+            raise ValueError("Invalid cell name.")
+        if not cells:
+            raise ValueError("No cell selected.")
+        xs = [int(cell[2]) for cell in cells]
+        ys = [int(cell[3]) for cell in cells]
+        x1, x2 = min(xs), max(xs) + 1
+        y1, y2 = min(ys), max(ys) + 1
+        if len(cells) != (x2 - x1) * (y2 - y1):
+            raise ValueError("Cells must be spatially continuous.")
+        row_step = self.camera.cell_num_pix_row + self.camera.cell_num_pix_row_gap
+        col_step = self.camera.cell_num_pix_col + self.camera.cell_num_pix_col_gap
+        return np.s_[
+            y1 * row_step : y2 * row_step - self.camera.cell_num_pix_row_gap,
+            x1 * col_step : x2 * col_step - self.camera.cell_num_pix_col_gap,
+        ]
+
+    def slice_cells(self, cells=None, masked=False):
+        """
+        slice many cells or sets of spatially continuous cells from a single chip image
+
+        The chip image, masked once if masked is True, is shared by all the returned images, which are views into
+        it, so that slicing all 64 cells costs one masking pass instead of 64.
+
+        Parameters
+        ----------
+        cells : list of str, optional
+            cell names like "xy12" or ranges like "xy[3:5][1:4]", by default all cells of the camera
+        masked : bool, optional
+            If True then the masked pixels are np.nan in the returned images, by default False
+
+        Returns
+        -------
+        dict
+            the given cells mapped to tuples of the 2d view of their image and its index in the chip image
+        """
+        if cells is None:
+            cells = self.camera.cells
+        elif isinstance(cells, str):
+            cells = [cells]
+        cells_idx = {cell: self._get_cells_idx(cell) for cell in cells}
+        chip_img = self.get_data(masked=masked)
+        return {cell: (chip_img[idx], idx) for cell, idx in cells_idx.items()}
+
+    def get_cell_view(self, chip_img=None):
+        """
+        return a view of the cells of the chip image without copying them
+
+        Parameters
+        ----------
+        chip_img : numpy.ndarray, optional
+            a chip image of the camera geometry, by default the data of the chip
+
+        Returns
+        -------
+        numpy.ndarray
+            4d array of shape (num_cell_per_row, num_cell_per_col, cell_num_pix_row, cell_num_pix_col), where
+            [x, y] is the image of the cell "xy{x}{y}"
+        """
+        if chip_img is None:
+            chip_img = self.get_data()
+        if chip_img.shape != (
+            self.camera.chip_num_pix_row,
+            self.camera.chip_num_pix_col,
+        ):
+            raise ValueError("Chip image shape does not match camera specification.")
+        row_stride, col_stride = chip_img.strides
+        return np.lib.stride_tricks.as_strided(
+            chip_img,
+            shape=(
+                self.camera.num_cell_per_row,
+                self.camera.num_cell_per_col,
+                self.camera.cell_num_pix_row,
+                self.camera.cell_num_pix_col,
+            ),
+            strides=(
+                col_stride
+                * (self.camera.cell_num_pix_col + self.camera.cell_num_pix_col_gap),
+                row_stride
+                * (self.camera.cell_num_pix_row + self.camera.cell_num_pix_row_gap),
+                row_stride,
+                col_stride,
+            ),
+            writeable=False,
+        )
+
+    def cell_stats(self, masked=False, nsigma=3, maxiters=10, ngood_min=1):
+        """
+        sigma clipped statistics of every cell of the chip, computed at once on a strided view of the cells
+
+        Parameters
+        ----------
+        masked : bool, optional
+            If True then exclude the masked pixels, by default False
+        nsigma : float, optional
+            number of standard deviations of the clipping bounds, by default 3
+        maxiters : int, optional
+            maximum number of clipping iterations, by default 10
+        ngood_min : int, optional
+            minimum number of kept pixels to have valid statistics, by default 1
+
+        Returns
+        -------
+        astropy.table.Table
+            one row per cell with the clipped mean, median and std, the rms, and the fraction of pixels excluded by
+            the mask or not finite
+        """
+        cell_imgs = self.get_cell_view()
+        excluded = self.get_cell_view(self.get_mask()) > 0 if masked else False
+        cells = [
+            f"xy{x}{y}"
+            for x in range(self.camera.num_cell_per_row)
+            for y in range(self.camera.num_cell_per_col)
+        ]
+        return _cell_stats_table(
+            cells, cell_imgs, excluded, nsigma, maxiters, ngood_min
+        )
+
     def display(self, show_mask=False, ax=None, **kwargs):
         "Display the chip image with mask overlaid."
         if show_mask:
@@ -202,7 +364,8 @@ class ChipHDUList(HDUList):
         ax.imshow(chip_img, norm=norm, cmap="gray_r")
         if show_mask:
             ax.imshow(mk_img, cmap="autumn", alpha=0.6)
-        ax.set_title(Path(self.filename()).name)
+        # in-memory HDUs of the fitsio backend have no file name
+        ax.set_title(Path(self.filename() or "").name)
 
 
 class CellHDUList(HDUList):
@@ -226,7 +389,11 @@ class CellHDUList(HDUList):
                 mask_path = neb_locate(mask_path)[0]["path"]
             else:
                 raise FileNotFoundError(f"No such file: '{str(mask_path)}'")
-        with read_cell(mask_path, trim_overscan=self.trim_overscan) as mask_hdul:
+        with read_cell(
+            mask_path,
+            trim_overscan=self.trim_overscan,
+            backend=getattr(self, "backend", None),
+        ) as mask_hdul:
             assert len(self) == len(mask_hdul)
             for idx in range(1, len(self)):
                 assert mask_hdul[idx].data.shape == self[idx].data.shape
@@ -291,6 +458,83 @@ class CellHDUList(HDUList):
                 "No mask available. Please use add_mask() to add a mask first."
             )
 
+    def get_cube(self, masked=False, mask=False):
+        """
+        return the images of all cells as a float32 cube, NaN for missing cells
+
+        Args:
+            masked (bool, optional): whether the masked pixels should be set to np.nan. Defaults to False.
+            mask (bool, optional): return the cube of the cell masks instead. Defaults to False.
+
+        Returns:
+            numpy.ndarray: 3d array of shape (num_cell_per_chip, rows, cols) in the order of camera.cells, where
+            the cells are trimmed if the overscan has been trimmed
+        """
+        if self.trim_overscan:
+            shape = (self.camera.cell_num_pix_row, self.camera.cell_num_pix_col)
+        else:
+            shape = (
+                self.camera.cell_num_pix_row_untrimmed,
+                self.camera.cell_num_pix_col_untrimmed,
+            )
+        extnames = {hdu.name.upper() for hdu in self}
+        if mask or masked:
+            # raise the error of a missing mask
+            self.get_mask(self.camera.cells[0])
+        cube = np.full(
+            (self.camera.num_cell_per_chip,) + shape,
+            0 if mask else np.nan,
+            dtype=np.int32 if mask else np.float32,
+        )
+        for idx, cell in enumerate(self.camera.cells):
+            extname = cell + " mask" if mask else cell
+            if extname.upper() not in extnames or self[extname].data is None:
+                continue
+            cell_img = self[extname].data
+            if cell_img.shape == shape:
+                cube[idx] = cell_img
+        if masked and not mask:
+            cube[self.get_cube(mask=True) > 0] = np.nan
+        return cube
+
+    def cell_stats(self, masked=False, nsigma=3, maxiters=10, ngood_min=1):
+        """
+        sigma clipped statistics of every cell at once, with the bias from the overscan for untrimmed cells
+
+        Args:
+            masked (bool, optional): whether the masked pixels should be excluded. Defaults to False.
+            nsigma (float, optional): number of standard deviations of the clipping bounds. Defaults to 3.
+            maxiters (int, optional): maximum number of clipping iterations. Defaults to 10.
+            ngood_min (int, optional): minimum number of kept pixels to have valid statistics. Defaults to 1.
+
+        Returns:
+            astropy.table.Table: one row per cell with the clipped mean, median and std, the rms, the fraction of
+            pixels excluded by the mask or not finite, and the clipped median of the overscan columns as bias if the
+            overscan has not been trimmed
+        """
+        cube = self.get_cube(masked=masked)
+        cell_imgs = cube[
+            :, : self.camera.cell_num_pix_row, : self.camera.cell_num_pix_col
+        ]
+        bias = None
+        if not self.trim_overscan:
+            bias = sigma_clip_stats(
+                cube[:, : self.camera.cell_num_pix_row, self.camera.cell_num_pix_col :],
+                sigma=nsigma,
+                axis=(-2, -1),
+                maxiters=maxiters,
+                ngood_min=ngood_min,
+            )[1]
+        return _cell_stats_table(
+            list(self.camera.cells),
+            cell_imgs,
+            False,
+            nsigma,
+            maxiters,
+            ngood_min,
+            bias=bias,
+        )
+
     def assemble_chip(
         self,
         no_gap=False,
@@ -302,13 +546,36 @@ class CellHDUList(HDUList):
     ):
         """
         assemble the cell images into a chip image
+
+        Args:
+            mask_cells (str, list of str or CellSet, optional): cells to be set to np.nan, e.g. ["xy10", "xy23"] or
+                "xy[3:5][1:4]". Defaults to None.
+            subtract_bias (bool or str, optional): True to subtract the BIASLVL keyword of each cell, or "row" or
+                "scalar" to subtract the bias estimated from the overscan of all cells at once, which requires
+                untrimmed cells. Defaults to False.
         """
+        overscan_bias_method = (
+            subtract_bias if subtract_bias in ("row", "scalar") else None
+        )
+        if overscan_bias_method is not None:
+            if self.trim_overscan:
+                raise ValueError(
+                    "The overscan has been trimmed, please use read_cell(trim_overscan=False)."
+                )
+            cube = self.get_cube()
+            subtract_overscan_bias(cube, self.camera, method=overscan_bias_method)
+            cube = dict(zip(self.camera.cells, cube))
+        if mask_cells is not None:
+            mask_cells = CellSet(mask_cells)
 
         for y in range(8):
             for x in range(8):
                 cell = f"xy{x}{y}"
                 if cell in self.camera.cells:
-                    cell_img = self.get_data(cell)
+                    if overscan_bias_method is not None:
+                        cell_img = cube[cell]
+                    else:
+                        cell_img = self.get_data(cell)
                 else:
                     if self.trim_overscan:
                         cell_img = np.full(
@@ -352,6 +619,7 @@ class CellHDUList(HDUList):
                     ]
                 if (
                     subtract_bias
+                    and overscan_bias_method is None
                     and (bias_mean := self.get_kw_val(cell, "BIASLVL")) is not None
                 ):
                     cell_img -= bias_mean
@@ -0,0 +1,270 @@
+import ctypes
+import io
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.io.fits.hdu.compressed import DITHER_SEED_CHECKSUM
+from astropy.io.fits.header import BLOCK_SIZE
+
+# keywords of the image header recomputed by astropy when the image is compressed again
+SCALE_KEYWORDS = ("BZERO", "BSCALE", "BLANK")
+COMMENTARY_KEYWORDS = ("", "COMMENT", "HISTORY")
+
+
+def _compression_settings(hdu):
+    # the compression of a CompImageHDU read from a file, to compress its data again the same way
+    return {
+        "compression_type": hdu.compression_type,
+        "tile_shape": tuple(int(n) for n in hdu.tile_shape),
+        "quantize_level": hdu.quantize_level,
+        "quantize_method": hdu.quantize_method,
+        # a fixed seed keeps the output reproducible when the input seed is not known
+        "dither_seed": hdu.dither_seed or DITHER_SEED_CHECKSUM,
+        "hcomp_scale": hdu.hcomp_scale,
+        "hcomp_smooth": hdu.hcomp_smooth,
+    }
+
+
+def _extension_bytes(data, header, settings):
+    # the bytes of an image extension, compressed with settings unless they are None
+    if settings is None:
+        hdu = fits.ImageHDU(data, header)
+    else:
+        header = header.copy()
+        for keyword in SCALE_KEYWORDS:
+            header.remove(keyword, ignore_missing=True)
+        hdu = fits.CompImageHDU(data, header, **settings)
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(buffer)
+    # the empty primary HDU is a single block
+    return buffer.getvalue()[BLOCK_SIZE:]
+
+
+def _resolve_dither_seed(data, settings):
+    # positive dither seed of an image, computing the checksum seed of its first tile like astropy, so that the bands
+    # of the image compressed separately share it
+    seed = settings["dither_seed"]
+    if seed > 0:
+        return seed
+    first_tile = np.ascontiguousarray(
+        data[tuple(slice(n) for n in settings["tile_shape"])]
+    )
+    return ctypes.c_ulong(int(first_tile.view(np.uint8).sum())).value % 10000 + 1
+
+
+def _band_jobs(data, header, settings, num_bands):
+    # the row bands of an image aligned to its tiles, each compressed with the dither seed of its first tile, so that
+    # the merged tiles are identical to those of the image compressed at once
+    tile_rows = min(settings["tile_shape"][0], data.shape[0])
+    num_tiles_per_row = -(-data.shape[1] // settings["tile_shape"][1])
+    num_tile_rows = -(-data.shape[0] // tile_rows)
+    num_bands = min(num_bands, num_tile_rows)
+    seed = _resolve_dither_seed(data, settings)
+    jobs = []
+    for band in range(num_bands):
+        tile_row1 = band * num_tile_rows // num_bands
+        tile_row2 = (band + 1) * num_tile_rows // num_bands
+        first_tile = tile_row1 * num_tiles_per_row
+        jobs.append(
+            (
+                data[tile_row1 * tile_rows : tile_row2 * tile_rows],
+                header,
+                dict(settings, dither_seed=(seed - 1 + first_tile) % 10000 + 1),
+            )
+        )
+    return jobs, seed
+
+
+def _merge_bands(bands, seed):
+    # one compressed image extension from the compressed row bands of an image, whose tables have a row per tile, or
+    # None if the bands were compressed with different columns or keywords and cannot be merged
+    if len(bands) == 1:
+        return bands[0]
+    empty_primary = io.BytesIO()
+    fits.PrimaryHDU().writeto(empty_primary)
+    tables = [
+        fits.open(
+            io.BytesIO(empty_primary.getvalue() + band),
+            disable_image_compression=True,
+        )[1]
+        for band in bands
+    ]
+    column_formats = [
+        [
+            (column.name, re.sub(r"\(.*\)", "", str(column.format)))
+            for column in table.columns
+        ]
+        for table in tables
+    ]
+    if any(formats != column_formats[0] for formats in column_formats[1:]):
+        return None
+    columns = []
+    for column in tables[0].columns:
+        values = [table.data[column.name] for table in tables]
+        if re.match(r"1?[PQ]", str(column.format)):
+            # variable length arrays of the compressed tiles, whose maximum length is recomputed
+            columns.append(
+                fits.Column(
+                    column.name,
+                    format=re.sub(r"\(.*\)", "", str(column.format)),
+                    array=[tile for value in values for tile in value],
+                )
+            )
+        else:
+            columns.append(
+                fits.Column(
+                    column.name, format=column.format, array=np.concatenate(values)
+                )
+            )
+    merged = fits.BinTableHDU.from_columns(columns)
+    # keywords of all bands, since some are only in some bands, e.g. ZBLANK of the bands of a float image with NaNs
+    table_keywords = set(merged.header) | {"THEAP"}
+    band_keywords = {}
+    for idx, table in enumerate(tables):
+        for card in table.header.cards:
+            # the number of rows and the dither seed differ between the bands and are set below
+            if card.keyword in COMMENTARY_KEYWORDS + ("ZNAXIS2", "ZDITHER0"):
+                if idx == 0:
+                    merged.header.append(card)
+            elif card.keyword in table_keywords:
+                continue
+            elif card.keyword not in band_keywords:
+                band_keywords[card.keyword] = card.value
+                merged.header.append(card)
+            elif band_keywords[card.keyword] != card.value:
+                return None
+    merged.header["ZNAXIS2"] = sum(table.header["ZNAXIS2"] for table in tables)
+    if "ZDITHER0" in merged.header:
+        merged.header["ZDITHER0"] = seed
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), merged]).writeto(buffer)
+    return buffer.getvalue()[BLOCK_SIZE:]
+
+
+def write_hdus(hdus, path, max_workers=None, overwrite=False):
+    """
+    write a primary HDU and image extensions, compressing the extensions concurrently in separate processes with the
+    compression they were read with
+
+    When there are fewer extensions than processes, e.g. for a chip, the compressed images are split into row bands
+    aligned to their tiles, which are compressed concurrently with the dither seeds of their first tiles and merged
+    into one compressed table, so that the tiles are identical to those of the image compressed at once.
+
+    The file is written to a temporary file in the directory of path, which is renamed into place only when it is
+    complete, so that path is never partially written.
+
+    Parameters
+    ----------
+    hdus : list of astropy.io.fits HDUs
+        the primary HDU followed by ImageHDU or CompImageHDU extensions
+    path : str
+        path of the FITS file
+    max_workers : int, optional
+        number of processes compressing the extensions or their bands, by default None for the number of CPUs. With
+        one process the extensions are compressed in this process.
+    overwrite : bool, optional
+        whether to overwrite path, by default False
+
+    Returns
+    -------
+    pathlib.Path
+        path of the written file
+    """
+    path = Path(path).expanduser()
+    if path.exists() and not overwrite:
+        raise FileExistsError(f"File '{str(path)}' already exists.")
+    primary, extensions = hdus[0], hdus[1:]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    # the compressed images are split into row bands when there are fewer images than processes, e.g. a chip
+    num_bands = -(-max_workers // max(len(extensions), 1))
+    extension_jobs = []
+    for hdu in extensions:
+        job = (
+            hdu.data,
+            hdu.header,
+            _compression_settings(hdu) if isinstance(hdu, fits.CompImageHDU) else None,
+        )
+        if isinstance(hdu, fits.CompImageHDU) and hdu.data.ndim == 2:
+            extension_jobs.append(_band_jobs(*job, num_bands) + (job,))
+        else:
+            extension_jobs.append(([job], None, job))
+    jobs = [job for band_jobs, _, _ in extension_jobs for job in band_jobs]
+
+    def merge(bands, seed, job):
+        extension = _merge_bands(bands, seed)
+        # the image is compressed at once if its bands cannot be merged
+        return _extension_bytes(*job) if extension is None else extension
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            fits.PrimaryHDU(primary.data, primary.header).writeto(tmp_file)
+            if max_workers > 1 and len(jobs) > 1:
+                with ProcessPoolExecutor(min(max_workers, len(jobs))) as executor:
+                    bands = executor.map(_extension_bytes, *zip(*jobs))
+                    for band_jobs, seed, job in extension_jobs:
+                        tmp_file.write(
+                            merge([next(bands) for _ in band_jobs], seed, job)
+                        )
+            else:
+                for band_jobs, seed, job in extension_jobs:
+                    tmp_file.write(
+                        merge(
+                            [_extension_bytes(*band_job) for band_job in band_jobs],
+                            seed,
+                            job,
+                        )
+                    )
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+    return path
+
+
+def write_chip(chip_hdul, path, max_workers=None, overwrite=False):
+    """
+    write the chip image of a ChipHDUList from read_chip, without its mask, atomically to path, see write_hdus
+
+    The image is compressed like the input if it was read as a CompImageHDU, i.e. with either backend of read_chip
+    unless the fitsio backend found no compression keywords, and written uncompressed otherwise.
+    """
+    data_hdu = chip_hdul[1]
+    extname = getattr(chip_hdul, "extname", None)
+    header = data_hdu.header.copy()
+    # restore the EXTNAME that read_chip replaced by "data"
+    if extname is None:
+        header.remove("EXTNAME", ignore_missing=True)
+    else:
+        header["EXTNAME"] = extname
+    if isinstance(data_hdu, fits.CompImageHDU):
+        data_hdu = fits.CompImageHDU(
+            data_hdu.data, header, **_compression_settings(data_hdu)
+        )
+    else:
+        data_hdu = fits.ImageHDU(data_hdu.data, header)
+    return write_hdus(
+        [chip_hdul[0], data_hdu], path, max_workers=max_workers, overwrite=overwrite
+    )
+
+
+def write_cell(cell_hdul, path, max_workers=None, overwrite=False):
+    """
+    write the cell images of a CellHDUList from read_cell, without their masks, atomically to path, compressing the
+    cells concurrently, see write_hdus
+
+    The cells are written as they are in cell_hdul, i.e. without overscan if it has been trimmed.
+    """
+    hdus = [hdu for hdu in cell_hdul if not hdu.name.lower().endswith(" mask")]
+    return write_hdus(hdus, path, max_workers=max_workers, overwrite=overwrite)
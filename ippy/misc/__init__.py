@@ -1 +1,2 @@
+from .cellset import *
 from .utils import *
@@ -0,0 +1,288 @@
+import re
+
+import numpy as np
+
+# cells of an OTA, "xy00" to "xy77", whose bit index is the octal number of their name like in cells_to_binary
+NUM_CELLS = 64
+FULL_CELL_MASK = 2**NUM_CELLS - 1
+
+cell_item_pattern = re.compile(r"xy(\d|\[[^\[\],]*\])(\d|\[[^\[\],]*\])")
+# the numpy index form "xy[3:5,1:4]" of slice_cell_from_chip
+cell_item_pattern_np = re.compile(r"xy\[([^\[\],]*),([^\[\],]*)\]")
+# commas and whitespace outside brackets
+cell_item_separator = re.compile(r"[,\s]+(?![^\[]*\])")
+
+
+def _cell_bit(cell):
+    # bit index of a cell name like "xy12"
+    if (
+        not isinstance(cell, str)
+        or len(cell) != 4
+        or cell[:2].lower() != "xy"
+        or not all(c in "01234567" for c in cell[2:])
+    ):
+        raise ValueError(f"Invalid cell name: {cell!r}")
+    return int(cell[2:], 8)
+
+
+def _parse_cell_index(index):
+    # cell numbers along one axis of a digit or a bracketed integer or slice like "[3:5]"
+    if not index.startswith("["):
+        if int(index) >= 8:
+            raise ValueError(f"Invalid cell index: {index!r}")
+        return [int(index)]
+    parts = index[1:-1].split(":")
+    try:
+        parts = [int(p) if p.strip() else None for p in parts]
+    except ValueError:
+        raise ValueError(f"Invalid cell index: {index!r}")
+    if len(parts) == 1:
+        if parts[0] is None:
+            raise ValueError(f"Invalid cell index: {index!r}")
+        return list(range(8))[parts[0] : parts[0] + 1 or None]
+    elif len(parts) <= 3:
+        return list(range(8))[slice(*parts)]
+    else:
+        raise ValueError(f"Invalid cell index: {index!r}")
+
+
+def _format_run(start, stop):
+    return str(start) if stop == start + 1 else f"[{start}:{stop}]"
+
+
+class CellSet:
+    """
+    immutable set of the cells of an OTA backed by a 64 bit mask, so that membership and set algebra are O(1)
+
+    Bit i of the mask is the cell whose name is the octal number of i, i.e. xy{x}{y} is bit 8 * x + y, which is also
+    the order of camera.cells and of the cubes of CellHDUList.get_cube.
+
+    Parameters
+    ----------
+    cells : str, iterable of str, CellSet or int, optional
+        a cell name like "xy12" or a range like "xy[3:5][1:4]", see from_range, an iterable of those, another CellSet,
+        or a 64 bit mask, by default None for the empty set
+    """
+
+    __slots__ = ("mask",)
+
+    def __init__(self, cells=None):
+        if cells is None:
+            mask = 0
+        elif isinstance(cells, CellSet):
+            mask = cells.mask
+        elif isinstance(cells, (int, np.integer)):
+            mask = int(cells)
+            if not 0 <= mask <= FULL_CELL_MASK:
+                raise ValueError(
+                    "The mask of a CellSet must be a 64 bit unsigned integer."
+                )
+        elif isinstance(cells, str):
+            mask = CellSet.from_range(cells).mask
+        else:
+            mask = 0
+            for cell in cells:
+                if isinstance(cell, str) and len(cell) == 4:
+                    mask |= 1 << _cell_bit(cell)
+                else:
+                    mask |= CellSet(cell).mask
+        object.__setattr__(self, "mask", mask)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CellSet is immutable.")
+
+    @classmethod
+    def all(cls):
+        return cls(FULL_CELL_MASK)
+
+    @classmethod
+    def from_range(cls, cell_range):
+        """
+        parse cells in the range syntax, e.g. "xy12", "xy[3:5][1:4]", "xy0[2:]" or "xy[0:2]7, xy77"
+
+        Each item is "xy" followed by the x and the y cell numbers, each either a digit or a bracketed Python integer
+        or slice over range(8), or both in one bracket like "xy[3:5,1:4]". Items are separated by commas or
+        whitespace.
+        """
+        mask = 0
+        for item in cell_item_separator.split(cell_range.strip()):
+            if not item:
+                continue
+            item = item.lower().replace(" ", "")
+            match = cell_item_pattern.fullmatch(item)
+            if match is not None:
+                x_index, y_index = match.groups()
+            elif (match := cell_item_pattern_np.fullmatch(item)) is not None:
+                x_index, y_index = (f"[{index}]" for index in match.groups())
+            else:
+                raise ValueError(f"Invalid cell range: {item!r}")
+            for x in _parse_cell_index(x_index):
+                for y in _parse_cell_index(y_index):
+                    mask |= 1 << (8 * x + y)
+        return cls(mask)
+
+    def to_range(self):
+        """
+        format the cells in the range syntax of from_range, merging the runs of y of consecutive x
+        """
+        columns = [(self.mask >> (8 * x)) & 0xFF for x in range(8)]
+        runs = []
+        for x in range(8):
+            y = 0
+            while y < 8:
+                if columns[x] >> y & 1:
+                    stop = y
+                    while stop < 8 and columns[x] >> stop & 1:
+                        stop += 1
+                    runs.append((x, y, stop))
+                    y = stop
+                else:
+                    y += 1
+        items = []
+        done = set()
+        for x, y1, y2 in runs:
+            if (x, y1, y2) in done:
+                continue
+            x2 = x + 1
+            while (x2, y1, y2) in runs:
+                done.add((x2, y1, y2))
+                x2 += 1
+            items.append(f"xy{_format_run(x, x2)}{_format_run(y1, y2)}")
+        return ",".join(items)
+
+    @classmethod
+    def from_binary(cls, binary, flag=True):
+        """
+        inverse of to_binary
+        """
+        if len(binary) != NUM_CELLS or set(binary) - {"0", "1"}:
+            raise ValueError("binary must be a string of 64 zeros and ones.")
+        mask = int(binary[::-1], 2)
+        return cls(mask if flag else ~mask & FULL_CELL_MASK)
+
+    def to_binary(self, flag=True):
+        """
+        64 character string whose character i is "1" ("0") if the cell of bit i is in the set and flag is True
+        (False), the per-cell configuration of the pattern row correction, see cells_to_binary
+        """
+        mask = self.mask if flag else ~self.mask & FULL_CELL_MASK
+        return format(mask, "064b")[::-1]
+
+    def __int__(self):
+        return self.mask
+
+    def __index__(self):
+        return self.mask
+
+    def __contains__(self, cell):
+        try:
+            return bool(self.mask >> _cell_bit(cell) & 1)
+        except ValueError:
+            return False
+
+    def __iter__(self):
+        mask = self.mask
+        while mask:
+            low = mask & -mask
+            yield f"xy{low.bit_length() - 1:02o}"
+            mask ^= low
+
+    def __len__(self):
+        return bin(self.mask).count("1")
+
+    def __bool__(self):
+        return self.mask != 0
+
+    def __eq__(self, other):
+        if isinstance(other, CellSet):
+            return self.mask == other.mask
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.mask)
+
+    def __le__(self, other):
+        return self.mask & ~CellSet(other).mask == 0
+
+    def __ge__(self, other):
+        return CellSet(other).mask & ~self.mask == 0
+
+    def __or__(self, other):
+        return CellSet(self.mask | CellSet(other).mask)
+
+    def __and__(self, other):
+        return CellSet(self.mask & CellSet(other).mask)
+
+    def __sub__(self, other):
+        return CellSet(self.mask & ~CellSet(other).mask)
+
+    def __xor__(self, other):
+        return CellSet(self.mask ^ CellSet(other).mask)
+
+    def __invert__(self):
+        return CellSet(~self.mask & FULL_CELL_MASK)
+
+    __ror__ = __or__
+    __rand__ = __and__
+    __rxor__ = __xor__
+    issubset = __le__
+    issuperset = __ge__
+    union = __or__
+    intersection = __and__
+    difference = __sub__
+
+    def __repr__(self):
+        return f"CellSet({self.to_range()!r})"
+
+
+def cell_masks_contain(masks, cell):
+    """
+    whether each of an array of 64 bit cell masks, e.g. of thousands of OTAs, contains the cell
+
+    Parameters
+    ----------
+    masks : array_like
+        cell masks as unsigned 64 bit integers
+    cell : str
+        cell name like "xy12"
+
+    Returns
+    -------
+    numpy.ndarray
+        boolean array of the shape of masks
+    """
+    bit = np.uint64(1) << np.uint64(_cell_bit(cell))
+    return (np.asarray(masks, dtype=np.uint64) & bit) != 0
+
+
+def cell_masks_count(masks):
+    """
+    number of cells of each of an array of 64 bit cell masks
+    """
+    masks = np.asarray(masks, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(masks).astype(np.int64)
+    bits = np.unpackbits(masks[..., np.newaxis].view(np.uint8), axis=-1)
+    return bits.sum(axis=-1, dtype=np.int64)
+
+
+def cell_masks_to_bool(masks):
+    """
+    expand an array of 64 bit cell masks into a boolean array with a last axis of the 64 cells in the order of
+    camera.cells
+    """
+    masks = np.asarray(masks, dtype=np.uint64)[..., np.newaxis]
+    bits = masks >> np.arange(NUM_CELLS, dtype=np.uint64)
+    return (bits & np.uint64(1)).astype(bool)
+
+
+def cell_masks_from_bool(cells):
+    """
+    inverse of cell_masks_to_bool, pack a boolean array whose last axis is the 64 cells into 64 bit cell masks
+    """
+    cells = np.asarray(cells, dtype=bool)
+    if cells.shape[-1] != NUM_CELLS:
+        raise ValueError("The last axis must be the 64 cells.")
+    return np.bitwise_or.reduce(
+        cells.astype(np.uint64) << np.arange(NUM_CELLS, dtype=np.uint64), axis=-1
+    )
@@ -2,12 +2,27 @@ import datetime
 import re
 
 import MySQLdb
+import numpy as np
 
 expname_pattern = re.compile(r"^[oc]\d{4,5}[gh]\d{4}[obdfl]$")
 gpc1_expname_pattern = re.compile(r"^[oc]\d{4,5}g\d{4}[obdfl]$")
 gpc2_expname_pattern = re.compile(r"^[oc]\d{4,5}h\d{4}[obdfl]$")
 
 from ippy.constants import SCIDBS1
+from ippy.misc.cellset import CellSet
+
+# maximum number of values in the IN clause of a bulk query
+DB_QUERY_CHUNK_SIZE = 1000
+
+
+def _ota_condition(ota):
+    # parameterized condition on class_id of a single OTA or a list of OTAs
+    if isinstance(ota, str):
+        return " and class_id like %s", [ota]
+    elif isinstance(ota, list) and ota and all(isinstance(o, str) for o in ota):
+        return f" and class_id in ({', '.join(['%s'] * len(ota))})", list(ota)
+    else:
+        raise TypeError(f"ota must be a string or a list of strings.")
 
 
 def infer_inst_from_expname(expname):
@@ -43,6 +58,111 @@ def infer_inst_from_expname(expname):
         raise ValueError(f"Invalid exposure name: {expname}")
 
 
+def _isin_chars(codes, chars):
+    # whether the code points are any of the characters
+    return np.logical_or.reduce([codes == ord(c) for c in chars])
+
+
+expname_dtype = np.dtype(
+    [
+        ("prefix", "U1"),
+        ("mjd", np.int32),
+        ("camera", "U4"),
+        ("seq", np.int32),
+        ("type", "U1"),
+        ("valid", bool),
+    ]
+)
+
+
+def parse_expnames(expnames):
+    """
+    parse many exposure names at once without a regex
+
+    The names are read as an array of UCS4 code points and every field of the format of expname_pattern, e.g.
+    o9000g0123o, is checked and decoded for all names together, so millions of names are parsed in seconds.
+
+    Parameters
+    ----------
+    expnames : array_like of str
+        exposure names, leading and trailing whitespace is ignored like infer_inst_from_expname
+
+    Returns
+    -------
+    numpy.ndarray
+        structured array of expname_dtype with the prefix ("o" or "c"), MJD, camera ("gpc1" or "gpc2"), sequence
+        number, type suffix ("o", "b", "d", "f" or "l") and whether the name is valid. The fields of invalid names
+        are empty strings and -1.
+    """
+    expnames = np.char.strip(np.asarray(expnames, dtype=str).ravel())
+    parsed = np.zeros(expnames.size, dtype=expname_dtype)
+    parsed["mjd"] = parsed["seq"] = -1
+    if expnames.size == 0:
+        return parsed
+    # code points of the names padded with at least one zero to at least 12 characters
+    width = max(expnames.dtype.itemsize // 4, 12) + 1
+    codes = np.zeros((expnames.size, width), dtype=np.uint32)
+    codes[:, : expnames.dtype.itemsize // 4] = expnames.view(np.uint32).reshape(
+        expnames.size, -1
+    )
+    powers = 10 ** np.arange(4, -1, -1)
+    for num_digits in (4, 5):
+        # names of 7 characters and an MJD of num_digits, whose characters are all checked below
+        length = 7 + num_digits
+        rows = np.flatnonzero((codes[:, length - 1] != 0) & (codes[:, length] == 0))
+        chars = codes[rows, :length]
+        mjd_digits = chars[:, 1 : 1 + num_digits] - ord("0")
+        seq_digits = chars[:, 2 + num_digits : 6 + num_digits] - ord("0")
+        prefix, camera, type_ = chars[:, [0, 1 + num_digits, length - 1]].T
+        # the digits below "0" wrap around to large unsigned integers
+        valid = (
+            np.all(mjd_digits <= 9, axis=1)
+            & np.all(seq_digits <= 9, axis=1)
+            & _isin_chars(prefix, "oc")
+            & _isin_chars(camera, "gh")
+            & _isin_chars(type_, "obdfl")
+        )
+        rows = rows[valid]
+        parsed["prefix"][rows] = prefix[valid].view("U1")
+        parsed["mjd"][rows] = mjd_digits[valid] @ powers[-num_digits:]
+        parsed["camera"][rows] = np.where(camera[valid] == ord("g"), "gpc1", "gpc2")
+        parsed["seq"][rows] = seq_digits[valid] @ powers[1:]
+        parsed["type"][rows] = type_[valid].view("U1")
+        parsed["valid"][rows] = True
+    return parsed
+
+
+def group_expnames_by_inst(expnames):
+    """
+    group exposure names by their instrument, see parse_expnames
+
+    Parameters
+    ----------
+    expnames : list of str
+        exposure names
+
+    Returns
+    -------
+    dict
+        instrument names, "gpc1" or "gpc2", mapped to lists of the given exposure names in their order
+
+    Raises
+    ------
+    ValueError
+        when an exposure name is not valid
+    """
+    expnames = list(expnames)
+    parsed = parse_expnames(expnames)
+    if not parsed["valid"].all():
+        raise ValueError(
+            f"Invalid exposure name: {expnames[np.argmin(parsed['valid'])]}"
+        )
+    expnames_per_inst = {}
+    for expname, inst in zip(expnames, parsed["camera"].tolist()):
+        expnames_per_inst.setdefault(inst, []).append(expname)
+    return expnames_per_inst
+
+
 def find_raw_imfile(exp_name, ota=None):
     """
     find raw image file based on exposure name
@@ -74,17 +194,13 @@ def find_raw_imfile(exp_name, ota=None):
         host=SCIDBS1.node, db=dbname, user=SCIDBS1.user, passwd=SCIDBS1.password
     )
     db_cur = db_conn.cursor()
-    query = f"select class_id, uri from rawExp join rawImfile using (exp_id) where rawExp.exp_name like '{exp_name}'"
+    query = "select class_id, uri from rawExp join rawImfile using (exp_id) where rawExp.exp_name like %s"
+    params = [exp_name]
     if ota is not None:
-        if isinstance(ota, str):
-            query += f" and class_id like '{ota}'"
-        elif isinstance(ota, list) and all(isinstance(o, str) for o in ota):
-            # make sure ota has more than one element otherwise tuple(ota) will be (ota[0],) and break the query
-            ota = ota + [ota[-1]]
-            query += f" and class_id in {tuple(ota)}"
-        else:
-            raise TypeError(f"ota must be a string or a list of strings.")
-    db_cur.execute(query)
+        ota_query, ota_params = _ota_condition(ota)
+        query += ota_query
+        params += ota_params
+    db_cur.execute(query, params)
     result = db_cur.fetchall()
     db_cur.close()
     db_conn.close()
@@ -95,7 +211,7 @@ def find_raw_imfile(exp_name, ota=None):
         raise ValueError(f"Cannot find raw image file for {exp_name} and OTA {ota}.")
 
 
-def find_active_detrend(type, time=None, filter=None, dbname="gpc1"):
+def find_active_detrend(type, time=None, filter=None, dbname="gpc1", index=None):
     """
     find active detrend for a given time and type
 
@@ -109,6 +225,10 @@ def find_active_detrend(type, time=None, filter=None, dbname="gpc1"):
 
     dbname : str, optional, should be gpc1 or gpc2. default is gpc1.
 
+    index : DetrendIndex or bool, optional
+        look up the detrend in memory instead of querying the database, with the given DetrendIndex or, if True, with
+        the shared one of dbname from get_detrend_index. default is None.
+
     Returns
     -------
     int
@@ -123,6 +243,15 @@ def find_active_detrend(type, time=None, filter=None, dbname="gpc1"):
     """
     if time is None:
         time = datetime.datetime.utcnow()
+    if index is not None and index is not False:
+        if index is True:
+            index = get_detrend_index(dbname)
+        det_id = index.lookup(type, time, filter=filter)
+        if det_id is None:
+            raise ValueError(
+                f"Cannot find {dbname} active detrend for {time} and type {type} and filter {filter}."
+            )
+        return det_id
     db_conn = MySQLdb.connect(
         host=SCIDBS1.node, db=dbname, user=SCIDBS1.user, passwd=SCIDBS1.password
     )
@@ -133,7 +262,7 @@ def find_active_detrend(type, time=None, filter=None, dbname="gpc1"):
     and (use_end is NULL or use_end >= "{time}") 
     """
     if filter is not None:
-        query += f" and filer like '{filter}'"
+        query += f" and filter like '{filter}'"
     query += " order by coalesce(time_begin, use_begin) desc"
     db_cur.execute(query)
     result = db_cur.fetchone()
@@ -147,6 +276,156 @@ def find_active_detrend(type, time=None, filter=None, dbname="gpc1"):
         )
 
 
+# bounds of the time and use windows whose begin or end is NULL, which can be negated without overflow
+_time_min = np.iinfo(np.int64).min + 1
+_time_max = np.iinfo(np.int64).max - 1
+
+
+def _as_us(times, null):
+    # times as int64 microseconds, with None or NaT replaced by null
+    times = np.asarray(times, dtype="datetime64[us]")
+    us = times.astype(np.int64)
+    return np.where(np.isnat(times), null, us)
+
+
+class DetrendIndex:
+    """
+    in-memory interval index of the stopped detRun rows of a database to find active detrends without a query
+
+    A detrend is active at a time within both its time and use windows, whose NULL ends are unbounded, and the one
+    with the latest coalesce(time_begin, use_begin) wins like find_active_detrend. For every (type, filter) the
+    windows are cut into elementary intervals at their bounds and the winner of each interval is resolved once, so
+    a lookup is a binary search over the interval bounds, vectorized over arrays of times.
+
+    Types and filters are matched case-insensitively and literally, i.e. SQL wildcards are not supported.
+
+    Parameters
+    ----------
+    rows : list of tuple
+        (det_id, iteration, det_type, filter, time_begin, time_end, use_begin, use_end) of the detRun rows, e.g.
+        from DetrendIndex.from_db
+    """
+
+    query = """select det_id, iteration, det_type, filter, time_begin, time_end, use_begin, use_end
+    from detRun where state like 'stop'"""
+
+    def __init__(self, rows):
+        rows = list(rows)
+        self.det_ids = np.array([r[0] for r in rows], dtype=np.int64)
+        self.iterations = np.array([r[1] for r in rows], dtype=np.int64)
+        self.types = np.array([str(r[2]).lower() for r in rows], dtype=object)
+        self.filters = np.array(
+            [None if r[3] is None else str(r[3]).lower() for r in rows], dtype=object
+        )
+        begins = [_as_us([r[4] for r in rows], _time_min)]
+        begins.append(_as_us([r[6] for r in rows], _time_min))
+        ends = [_as_us([r[5] for r in rows], _time_max)]
+        ends.append(_as_us([r[7] for r in rows], _time_max))
+        self.begins = np.maximum(*begins)
+        self.ends = np.minimum(*ends)
+        # coalesce(time_begin, use_begin) of the ordering, with NULL sorted last
+        self.priorities = np.where(begins[0] != _time_min, begins[0], begins[1])
+        self._intervals = {}
+
+    @classmethod
+    def from_db(cls, dbname="gpc1"):
+        """
+        load the stopped detRun rows of dbname
+        """
+        db_conn = MySQLdb.connect(
+            host=SCIDBS1.node, db=dbname, user=SCIDBS1.user, passwd=SCIDBS1.password
+        )
+        db_cur = db_conn.cursor()
+        db_cur.execute(cls.query)
+        rows = db_cur.fetchall()
+        db_cur.close()
+        db_conn.close()
+        return cls(rows)
+
+    def __len__(self):
+        return self.det_ids.size
+
+    def _get_intervals(self, type, filter):
+        # lower bounds of the elementary intervals and the row index of their winners, -1 if none
+        key = (type.lower(), None if filter is None else filter.lower())
+        if key not in self._intervals:
+            selected = self.types == key[0]
+            if key[1] is not None:
+                selected &= self.filters == key[1]
+            rows = np.flatnonzero(selected & (self.begins <= self.ends))
+            # latest priority first, the order of the rows for ties
+            rows = rows[np.argsort(-self.priorities[rows], kind="stable")]
+            # the closed windows [begin, end] are the half-open [begin, end + 1) of the integer microseconds
+            bounds = np.unique(np.concatenate((self.begins[rows], self.ends[rows] + 1)))
+            # the winner before the first bound is none
+            winners = np.full(bounds.size + 1, -1)
+            if rows.size:
+                covers = (self.begins[rows, np.newaxis] <= bounds) & (
+                    bounds <= self.ends[rows, np.newaxis]
+                )
+                covered = covers.any(axis=0)
+                winners[1:][covered] = rows[np.argmax(covers, axis=0)][covered]
+            self._intervals[key] = (bounds, winners)
+        return self._intervals[key]
+
+    def lookup_rows(self, type, times, filter=None):
+        """
+        find the index of the rows of the active detrends at times
+
+        Parameters
+        ----------
+        type : str
+            type of detrend, e.g. "dark", "flat", or "mask"
+        times : array_like
+            times of the observations as datetime.datetime, numpy.datetime64 or str
+        filter : str, optional
+            filter of the detrend, by default None for any filter
+
+        Returns
+        -------
+        numpy.ndarray
+            index of the rows, -1 where no detrend is active
+        """
+        bounds, winners = self._get_intervals(type, filter)
+        times = _as_us(times, _time_min)
+        rows = winners[np.searchsorted(bounds, times, side="right")]
+        # no detrend is active at unknown times
+        return np.where(times == _time_min, -1, rows)
+
+    def lookup_many(self, type, times, filter=None):
+        """
+        find the det_ids of the active detrends at an array of times, see lookup_rows
+
+        Returns
+        -------
+        numpy.ndarray
+            det_ids, -1 where no detrend is active
+        """
+        rows = self.lookup_rows(type, times, filter=filter)
+        return np.where(rows >= 0, self.det_ids[rows], -1)
+
+    def lookup(self, type, time=None, filter=None):
+        """
+        find the det_id of the active detrend at time, by default the current UTC date, or None if none is active
+        """
+        if time is None:
+            time = datetime.datetime.utcnow()
+        det_id = self.lookup_many(type, [time], filter=filter)[0]
+        return None if det_id < 0 else int(det_id)
+
+
+_detrend_indexes = {}
+
+
+def get_detrend_index(dbname="gpc1", refresh=False):
+    """
+    return the DetrendIndex of dbname, loaded from the database once per process unless refresh is True
+    """
+    if refresh or dbname not in _detrend_indexes:
+        _detrend_indexes[dbname] = DetrendIndex.from_db(dbname)
+    return _detrend_indexes[dbname]
+
+
 def find_detrend_imfile(det_id, ota=None, iteration=None, dbname="gpc1"):
     """
     find detrend files based on det_id
@@ -178,19 +457,16 @@ def find_detrend_imfile(det_id, ota=None, iteration=None, dbname="gpc1"):
         host=SCIDBS1.node, db=dbname, user=SCIDBS1.user, passwd=SCIDBS1.password
     )
     db_cur = db_conn.cursor()
-    query = f"select class_id, uri, data_state, fault from  detRegisteredImfile where det_id = {det_id}"
+    query = "select class_id, uri, data_state, fault from detRegisteredImfile where det_id = %s"
+    params = [det_id]
     if iteration is not None:
-        query += f" and iteration = {iteration}"
+        query += " and iteration = %s"
+        params.append(int(iteration))
     if ota is not None:
-        if isinstance(ota, str):
-            query += f" and class_id like '{ota}'"
-        elif isinstance(ota, list) and all(isinstance(o, str) for o in ota):
-            # make sure ota has more than one element otherwise tuple(ota) will be (ota[0],) and break the query
-            ota = ota + [ota[-1]]
-            query += f" and class_id in {tuple(ota)}"
-        else:
-            raise TypeError(f"ota must be a string or a list of strings.")
-    db_cur.execute(query)
+        ota_query, ota_params = _ota_condition(ota)
+        query += ota_query
+        params += ota_params
+    db_cur.execute(query, params)
     result = db_cur.fetchall()
     db_cur.close()
     db_conn.close()
@@ -203,6 +479,113 @@ def find_detrend_imfile(det_id, ota=None, iteration=None, dbname="gpc1"):
         )
 
 
+def _bulk_query(dbname, query, keys, params=(), chunk_size=DB_QUERY_CHUNK_SIZE):
+    # run query, whose {} is replaced by the placeholders of a chunk of keys followed by params, for all chunks of
+    # keys over a single connection and return all rows
+    db_conn = MySQLdb.connect(
+        host=SCIDBS1.node, db=dbname, user=SCIDBS1.user, passwd=SCIDBS1.password
+    )
+    db_cur = db_conn.cursor()
+    rows = []
+    for i in range(0, len(keys), chunk_size):
+        keys_chunk = keys[i : i + chunk_size]
+        db_cur.execute(
+            query.format(", ".join(["%s"] * len(keys_chunk))),
+            list(keys_chunk) + list(params),
+        )
+        rows.extend(db_cur.fetchall())
+    db_cur.close()
+    db_conn.close()
+    return rows
+
+
+def find_raw_imfiles(exp_names, ota=None, chunk_size=DB_QUERY_CHUNK_SIZE):
+    """
+    find raw image files of many exposures with one query per chunk of exposures
+
+    Parameters
+    ----------
+    exp_names : list of str
+        exposure names, gpc1 and gpc2 exposures can be mixed
+
+    ota : str or a list of str, optional
+
+    chunk_size : int, optional
+        number of exposures per query, default is DB_QUERY_CHUNK_SIZE.
+
+    Returns
+    -------
+    dict
+        exposure names mapped to dictionaries of OTA as key and nebulous path of raw image file as value, without the
+        exposures that are not found
+
+    Raises
+    ------
+    ValueError
+        when an exposure name is not valid
+    """
+    exp_names_of_db = {}
+    for exp_name in dict.fromkeys(exp_names):
+        exp_names_of_db.setdefault(infer_inst_from_expname(exp_name), []).append(
+            exp_name.strip()
+        )
+    query = "select exp_name, class_id, uri from rawExp join rawImfile using (exp_id) where exp_name in ({})"
+    params = []
+    if ota is not None:
+        ota_query, params = _ota_condition(ota)
+        query += ota_query
+    uris = {}
+    for dbname, db_exp_names in exp_names_of_db.items():
+        for r in _bulk_query(dbname, query, db_exp_names, params, chunk_size):
+            uris.setdefault(r[0], {})[r[1]] = r[2]
+    return uris
+
+
+def find_detrend_imfiles(
+    det_ids, ota=None, iteration=None, dbname="gpc1", chunk_size=DB_QUERY_CHUNK_SIZE
+):
+    """
+    find detrend files of many det_ids with one query per chunk of det_ids
+
+    Parameters
+    ----------
+    det_ids : list of int
+        det_ids of the detrends
+
+    ota : str or a list of str, optional
+
+    iteration : int, optional
+        iteration of the detrends, default is None for any iteration like find_detrend_imfile.
+
+    dbname : str, optional, should be gpc1 or gpc2. default is gpc1.
+
+    chunk_size : int, optional
+        number of det_ids per query, default is DB_QUERY_CHUNK_SIZE.
+
+    Returns
+    -------
+    dict
+        det_ids mapped to dictionaries of OTA as key and nebulous path of detrend file as value, without the det_ids
+        that are not found
+    """
+    det_ids = list(dict.fromkeys(int(det_id) for det_id in det_ids))
+    query = "select det_id, class_id, uri from detRegisteredImfile where det_id in ({})"
+    params = []
+    if iteration is not None:
+        query += " and iteration = %s"
+        params.append(int(iteration))
+    if ota is not None:
+        ota_query, ota_params = _ota_condition(ota)
+        query += ota_query
+        params += ota_params
+    # the latest iteration comes last when iteration is None
+    query += " order by iteration"
+    uris = {}
+    for r in _bulk_query(dbname, query, det_ids, params, chunk_size):
+        uris.setdefault(int(r[0]), {})[r[1]] = r[2]
+    return uris
+
+
 def cells_to_binary(cells, flag=True):
     """Converts a list of cells to a binary number.
 
@@ -217,10 +600,4 @@ def cells_to_binary(cells, flag=True):
         cells = [cells]
     if not all(isinstance(cell, str) for cell in cells):
         raise ValueError("All elements in cells must be strings.")
-    binary_number = 0
-    for cell in cells:
-        binary_number |= 1 << int(cell[2:], 8)
-    # if flag is False, invert the binary number
-    if not flag:
-        binary_number = ~binary_number & 2**64 - 1
-    return format(binary_number, "064b")[::-1]
+    return CellSet(cells).to_binary(flag=flag)
@@ -1 +1 @@
-from .nebulous import neb_locate, neb_replace
+from .nebulous import neb_locate, neb_locate_bulk, neb_replace
@@ -17,7 +17,11 @@ else:
     NEBULOUS_PSW = MYSQL_PSW_POWER
 
 
-def neb_locate(ext_id, no_wildcard=False):
+# number of ext_ids per "in (...)" clause of neb_locate_bulk
+NEB_QUERY_CHUNK_SIZE = 1000
+
+
+def _normalize_ext_id(ext_id):
     ext_id = str(ext_id).lower().strip()
     if ext_id.startswith("neb://"):
         ext_id = ext_id[6:]
@@ -27,7 +31,22 @@ def neb_locate(ext_id, no_wildcard=False):
     # strip duplicate /
     ext_id_parts = ext_id.split("/")
     ext_id_parts = [p for p in ext_id_parts if p]  # remove empty substrings
-    ext_id = "/".join(ext_id_parts)
+    return "/".join(ext_id_parts)
+
+
+def _instance_from_row(r):
+    return {
+        "ext_id": r[0],
+        "path": r[1].replace("file://", "") if r[1] else None,
+        "volume": r[2],
+        "allocate": r[3],
+        "available": r[4],
+        "xattr": r[5],
+    }
+
+
+def neb_locate(ext_id, no_wildcard=False):
+    ext_id = _normalize_ext_id(ext_id)
     # deal with wildcards
     if no_wildcard:
         if "%" in ext_id:
@@ -45,17 +64,42 @@ def neb_locate(ext_id, no_wildcard=False):
     neb_cur.close()
     neb_conn.close()
     if result:
-        return [
-            {
-                "ext_id": r[0],
-                "path": r[1].replace("file://", "") if r[1] else None,
-                "volume": r[2],
-                "allocate": r[3],
-                "available": r[4],
-                "xattr": r[5],
-            }
-            for r in result
-        ]
+        return [_instance_from_row(r) for r in result]
+
+
+def neb_locate_bulk(ext_ids):
+    """
+    locate many nebulous keys with a few queries of exact matches (no wildcards)
+
+    Parameters
+    ----------
+    ext_ids : iterable of str
+        nebulous keys, with or without the neb:// prefix
+
+    Returns
+    -------
+    dict
+        the given keys mapped to the list of their instances like neb_locate returns, or None if not found
+    """
+    ext_ids = list(ext_ids)
+    normalized = {ext_id: _normalize_ext_id(ext_id) for ext_id in ext_ids}
+    unique_ext_ids = list(set(normalized.values()))
+    instances = {}
+    if not unique_ext_ids:
+        return {}
+    neb_conn = MySQLdb.connect(
+        host=NEBULOUS_HOST, db="nebulous", user=NEBULOUS_USER, passwd=NEBULOUS_PSW
+    )
+    neb_cur = neb_conn.cursor()
+    for i in range(0, len(unique_ext_ids), NEB_QUERY_CHUNK_SIZE):
+        ext_ids_chunk = unique_ext_ids[i : i + NEB_QUERY_CHUNK_SIZE]
+        query = f"select ext_id, uri, name, allocate, available, xattr from storage_object left join instance using (so_id) left join volume using (vol_id) where ext_id in ({', '.join(['%s'] * len(ext_ids_chunk))})"
+        neb_cur.execute(query, ext_ids_chunk)
+        for r in neb_cur.fetchall():
+            instances.setdefault(r[0].lower(), []).append(_instance_from_row(r))
+    neb_cur.close()
+    neb_conn.close()
+    return {ext_id: instances.get(normalized[ext_id]) for ext_id in ext_ids}
 
 
 def neb_replace(phy_path, neb_key, review=True, verbose=True):
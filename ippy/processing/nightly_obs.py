@@ -260,69 +260,82 @@ class Quad:
             elif len(not_bad_visits) <= 1:
                 return []
 
-    def queue_wwdiffs(self, pretend=True, verbose=False):
+    def diffs_to_queue(self):
         """
-        queue the remaining diff pairs for a quad based on the current status
+        return the expected diff pairs that are not queued yet and the subset of them whose warps are both ready
+
+        Returns
+        -------
+        tuple of two lists of tuples of visit1 and visit2 (Visit object)
         """
         expected_diff_pairs = self.expected_diff_pairs()
+        queued_diff_pairs = [(d.exp1, d.exp2) for d in self.wwdiffs]
         diffs_to_queue = [
+            pair for pair in expected_diff_pairs if pair not in queued_diff_pairs
+        ]
+        diffs_can_be_queued = [
             pair
-            for pair in expected_diff_pairs
-            if pair not in [(d.exp1, d.exp2) for d in self.wwdiffs]
+            for pair in diffs_to_queue
+            if pair[0].warp_state == "full" and pair[1].warp_state == "full"
         ]
+        return diffs_to_queue, diffs_can_be_queued
+
+    def queue_wwdiffs(self, pretend=True, verbose=False):
+        """
+        queue the remaining diff pairs for a quad based on the current status
+        """
+        diffs_to_queue, diffs_can_be_queued = self.diffs_to_queue()
         count_diffs_to_queue = len(diffs_to_queue)
-        count_diffs_can_be_queued = 0
-        for pair in diffs_to_queue:
-            if pair[0].warp_state == "full" and pair[1].warp_state == "full":
-                count_diffs_can_be_queued += 1
-                run_difftool_cmd = [
-                    "difftool",
-                    "-dbname",
-                    self.dbname,
-                    "-definewarpwarp",
-                    "-warp_id",
-                    str(pair[0].warp_id),
-                    "-template_warp_id",
-                    str(pair[1].warp_id),
-                    "-backwards",
-                    "-set_workdir",
-                    pair[0].chip_workdir,
-                    "-set_dist_group",
-                    (
-                        pair[0].chip_dist_group
-                        if pair[0].chip_dist_group is not None
-                        else "NULL"
-                    ),
-                    "-set_label",
-                    pair[0].chip_label,
-                    "-set_data_group",
-                    (
-                        pair[0].chip_data_group
-                        if pair[0].chip_data_group is not None
-                        else "NULL"
-                    ),
-                    "-set_reduction",
-                    pair[0].chip_reduction,
-                    "-simple",
-                    "-rerun",
-                    "-good_frac",
-                    "0.1",
-                ]
-                if pretend:
-                    run_difftool_cmd.append("-pretend")
+        count_diffs_can_be_queued = len(diffs_can_be_queued)
+        for pair in diffs_can_be_queued:
+            run_difftool_cmd = [
+                "difftool",
+                "-dbname",
+                self.dbname,
+                "-definewarpwarp",
+                "-warp_id",
+                str(pair[0].warp_id),
+                "-template_warp_id",
+                str(pair[1].warp_id),
+                "-backwards",
+                "-set_workdir",
+                pair[0].chip_workdir,
+                "-set_dist_group",
+                (
+                    pair[0].chip_dist_group
+                    if pair[0].chip_dist_group is not None
+                    else "NULL"
+                ),
+                "-set_label",
+                pair[0].chip_label,
+                "-set_data_group",
+                (
+                    pair[0].chip_data_group
+                    if pair[0].chip_data_group is not None
+                    else "NULL"
+                ),
+                "-set_reduction",
+                pair[0].chip_reduction,
+                "-simple",
+                "-rerun",
+                "-good_frac",
+                "0.1",
+            ]
+            if pretend:
+                run_difftool_cmd.append("-pretend")
+            if verbose:
+                print(" ".join(run_difftool_cmd))
+            try:
+                run_difftool = subprocess.run(
+                    run_difftool_cmd, check=True, text=True, capture_output=True
+                )
                 if verbose:
-                    print(" ".join(run_difftool_cmd))
-                try:
-                    run_difftool = subprocess.run(
-                        run_difftool_cmd, check=True, text=True, capture_output=True
-                    )
-                    if verbose:
-                        print(run_difftool.stdout)
-                except subprocess.CalledProcessError as e:
-                    print(
-                        f"Command '{' '.join(e.cmd)}' returned non-zero exit status, please check its stderr below."
-                    )
-                    print(e.stderr)
+                    print(run_difftool.stdout)
+            except subprocess.CalledProcessError as e:
+                print(
+                    f"Command '{' '.join(e.cmd)}' returned non-zero exit status, please check its stderr below."
+                )
+                print(e.stderr)
         return count_diffs_to_queue, count_diffs_can_be_queued
 
 
@@ -625,8 +638,12 @@ class Chunk:
         count_diffs_to_queue = 0
         count_diffs_can_be_queued = 0
         for quad in self.quads:
-            count_diffs_to_queue += quad.queue_wwdiffs(pretend=pretend)[0]
-            count_diffs_can_be_queued += quad.queue_wwdiffs(pretend=pretend)[1]
+            (
+                count_diffs_to_queue_this_quad,
+                count_diffs_can_be_queued_this_quad,
+            ) = quad.queue_wwdiffs(pretend=pretend)
+            count_diffs_to_queue += count_diffs_to_queue_this_quad
+            count_diffs_can_be_queued += count_diffs_can_be_queued_this_quad
         return count_diffs_to_queue, count_diffs_can_be_queued
 
 
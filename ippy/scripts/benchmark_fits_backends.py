@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+ippy_parent_dir = str(Path(__file__).resolve().parents[2])
+if ippy_parent_dir not in sys.path:
+    sys.path.append(ippy_parent_dir)
+
+from ippy.constants import GPC1, GPC2
+from ippy.io import available_backends, get_backend, read_cell, read_chip
+
+
+def make_chip_file(path, camera, seed=0):
+    """
+    write a tile-compressed chip image of the shape of camera, with one row per tile like the IPP chip images
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.normal(
+        1000, 10, (camera.chip_num_pix_row, camera.chip_num_pix_col)
+    ).astype(np.float32)
+    header = fits.Header(
+        {"TELESCOP": "PS1" if camera is GPC1 else "PS2", "EXTNAME": "xy01.hdr"}
+    )
+    hdu = fits.CompImageHDU(
+        data,
+        header,
+        compression_type="RICE_1",
+        tile_shape=(1, camera.chip_num_pix_col),
+    )
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+
+
+def make_cell_file(path, camera, seed=0):
+    """
+    write the 64 tile-compressed untrimmed uint16 cell images of an OTA of camera
+    """
+    rng = np.random.default_rng(seed)
+    shape = (camera.cell_num_pix_row_untrimmed, camera.cell_num_pix_col_untrimmed)
+    hdus = [
+        fits.PrimaryHDU(
+            header=fits.Header({"TELESCOP": "PS1" if camera is GPC1 else "PS2"})
+        )
+    ]
+    for cell in camera.cells:
+        data = rng.poisson(1000, shape).astype(np.uint16)
+        hdus.append(
+            fits.CompImageHDU(
+                data, fits.Header({"EXTNAME": cell}), compression_type="RICE_1"
+            )
+        )
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+
+
+def best_time(func, repeat):
+    """
+    the shortest of repeat wall-clock times of func, in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark(chip_path, cell_path, backend_names, repeat):
+    """
+    time the header, full image and section reads of the chip and cell files with each backend
+    """
+
+    def read_chip_data(name):
+        with read_chip(chip_path, backend=name) as chip_hdul:
+            chip_hdul.get_data()
+
+    def read_cell_data(name):
+        with read_cell(cell_path, backend=name) as cell_hdul:
+            cell_hdul.get_cube()
+
+    tests = {
+        "chip headers": lambda name: get_backend(name).read_headers(chip_path),
+        "cell headers": lambda name: get_backend(name).read_headers(cell_path),
+        "chip section": lambda name: get_backend(name).read_image(
+            chip_path, 1, rows=(2000, 2100), cols=(2000, 2100)
+        ),
+        "chip image": read_chip_data,
+        "cell images": read_cell_data,
+    }
+    print(f"{'test':<16}" + "".join(f"{name:>12}" for name in backend_names))
+    for test, func in tests.items():
+        times = [best_time(lambda: func(name), repeat) for name in backend_names]
+        print(f"{test:<16}" + "".join(f"{t * 1000:>10.1f}ms" for t in times))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Benchmark the FITS backends of ippy.io on synthetic tile-compressed chip and cell files of the
+        shape of GPC1 or GPC2, or on given files. The shortest of the repeated wall-clock times is reported."""
+    )
+    parser.add_argument(
+        "--camera",
+        default="gpc1",
+        choices=["gpc1", "gpc2"],
+        help="The camera of the synthetic files. Default: gpc1",
+    )
+    parser.add_argument("--chip", help="A chip file to read instead of a synthetic one")
+    parser.add_argument("--cell", help="A cell file to read instead of a synthetic one")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=available_backends(),
+        help=f"The backends to benchmark. Default: {' '.join(available_backends())}",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of runs of each test. Default: 3"
+    )
+    args = parser.parse_args()
+
+    camera = GPC1 if args.camera == "gpc1" else GPC2
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chip_path = args.chip
+        if chip_path is None:
+            chip_path = Path(tmp_dir) / "chip.fits"
+            make_chip_file(chip_path, camera)
+        cell_path = args.cell
+        if cell_path is None:
+            cell_path = Path(tmp_dir) / "cell.fits"
+            make_cell_file(cell_path, camera)
+        benchmark(chip_path, cell_path, args.backends, args.repeat)
@@ -1,9 +1,16 @@
 import argparse
+import hashlib
+import os
 import re
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
+import types
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from time import sleep
 
 import MySQLdb
 
@@ -11,7 +18,7 @@ ippy_parent_dir = str(Path(__file__).resolve().parents[2])
 if ippy_parent_dir not in sys.path:
     sys.path.append(ippy_parent_dir)
 
-from ippy.nebulous import neb_locate
+from ippy.nebulous import neb_locate, neb_locate_bulk
 
 if sys.version_info[:2] >= (3, 7):
     from ippy.constants import SCIDBS1
@@ -27,188 +34,202 @@ else:
     SCIDBS1_PSW = MYSQL_PSW_READ_ONLY
 
 
-def tail(path, nline=50):
-    with open(path, "r") as f:
-        lines = f.readlines()
-        return lines[-nline:]
+def tail(path, nline=50, block_size=4096):
+    """
+    return the last nline lines of a file by reading blocks backwards from the end of the file
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        # one more line than needed because the first line in the read blocks may be partial
+        while pos > 0 and data.count(b"\n") <= nline:
+            read_size = min(block_size, pos)
+            pos -= read_size
+            f.seek(pos)
+            data = f.read(read_size) + data
+    lines = data.decode(errors="replace").splitlines(keepends=True)
+    return lines[-nline:]
 
 
-def find_missing_nebkey(log_neb_path):
-    log_phy_path = neb_locate(log_neb_path)
+def _log_host(instance):
+    # storage host of a nebulous instance, e.g. ipp138 for volume ipp138.0
+    if instance["volume"]:
+        return instance["volume"].split(".")[0]
+    return Path(instance["path"]).parts[2].split(".")[0]
+
+
+# one pass over the log lines for both the error message of the missing file and the input warp cmf file of a stack,
+# which is the actual culprit of the offsite LANL HPC processing (IPP-1776)
+update_log_line = re.compile(
+    r"(?P<error>(?i:couldn't find input|failed to (?:open|read)|nebulous there_can_be_only_one))"
+    r"|^inputSources:\s(?P<input_warp_cmf>neb://\S+\.wrp\.\d+\.skycell\.\d+\.\d+\.cmf)\b"
+)
+missing_nebkey_in_line = re.compile(r"\s(neb://\S+)\b")
+
+
+def _parse_update_log(log_cont):
+    """
+    return the missing nebulous key in the last error message and the last input warp cmf file of the log lines
+    """
+    missing_nebkey = input_warp_cmf = None
+    is_error_found = False
+    for line in reversed(log_cont):
+        m = update_log_line.search(line)
+        if m is None:
+            continue
+        if m.group("error") is not None and not is_error_found:
+            is_error_found = True
+            m_nebkey = missing_nebkey_in_line.search(line)
+            if m_nebkey:
+                missing_nebkey = m_nebkey.group(1)
+        elif m.group("input_warp_cmf") is not None and input_warp_cmf is None:
+            input_warp_cmf = m.group("input_warp_cmf")
+        if is_error_found and input_warp_cmf is not None:
+            break
+    return missing_nebkey, input_warp_cmf
+
+
+def _resolve_log(log_neb_path, log_phy_path):
     if (
         log_phy_path is not None
         and len(log_phy_path) == 1
         and log_phy_path[0]["available"]
     ):
-        log_path = log_phy_path[0]["path"]
+        return log_phy_path[0]
     else:
         print(f"Update log {log_neb_path} is not available")
         return None
-    log_cont = tail(log_path)
-    log_cont.reverse()
-    err_msg = re.compile(
-        r"couldn't find input|failed to (open|read)|nebulous there_can_be_only_one",
-        flags=re.IGNORECASE,
-    )
-    neb_key = re.compile(r"\s(neb://\S+)\b")
-    for line in log_cont:
-        if err_msg.search(line):
-            m = neb_key.search(line)
-            if m:
-                return m.group(1)
-            else:
-                return None
-    else:
+
+
+def find_missing_nebkey(log_neb_path):
+    instance = _resolve_log(log_neb_path, neb_locate(log_neb_path))
+    if instance is None:
         return None
+    return _parse_update_log(tail(instance["path"]))[0]
 
 
-def classify_problem(missing_nebkey, log_neb_path):
-    if missing_nebkey is None:
-        return missing_nebkey, None
-    # define various nebulous key patterns
-    missing_warp_product = re.compile(
-        r"^neb://\S+\.wrp\.\d+\.skycell\.\d+\.\d+\.\S*(fits|cmf)$"
-    )
-    missing_subkernel = re.compile(
-        r"^neb://\S+\.skycell\.\d+\.\d+(\.WS)?\.dif\.\d+\.subkernel$"
-    )
-    missing_psf = re.compile(r"^neb://\S+\.skycell\.\d+\.\d+(\.WS)?\.dif\.\d+\.psf$")
-    # missing_subkernel_gone = re.compile(
-    #     r"^neb://\S+\.skycell\.\d+\.\d+(\.WS)?\.dif\.\d+\.subkernel\.GONE$"
-    # )
-    missing_stk_cmf = re.compile(r"^neb://\S+\.skycell\.\d+\.\d+\.stk\.(\d+)\.cmf$")
-    missing_mdl = re.compile(r"^neb://\S+\.skycell\.\d+\.\d+\.WS\.dif\.\d+\.mdl\.fits$")
-    # match the missing nebulous key with the pattern
-    # various warp products, including IPP-1762; see https://panstarrs.atlassian.net/wiki/spaces/IPPCZAR/pages/678633973/ipp138.0+Warp+Diff+Data+Recovery#Missing-wrp.skycell.fits-file-SOLVED
-    if missing_warp_product.fullmatch(missing_nebkey):
-        culprit_phy_path = neb_locate(missing_nebkey)
-        if (
-            culprit_phy_path is not None
-            and len(culprit_phy_path) >= 1
-            and not culprit_phy_path[0]["available"]
-            and culprit_phy_path[0]["volume"].startswith("ipp138.0")
-        ):
-            return missing_nebkey, repair_warp
-        else:
-            return missing_nebkey, None
-    # IPP-1776
-    if missing_stk_cmf.fullmatch(missing_nebkey):
-        culprit_phy_path = neb_locate(missing_nebkey)
-        if culprit_phy_path is None:
-            m = missing_stk_cmf.fullmatch(missing_nebkey)
-            stack_id = m.group(1)
-            query = f"""
-            select stack_id, hostname from stackSumSkyfile where stack_id={stack_id}
-            """
-            db_conn = MySQLdb.connect(
-                host=SCIDBS1_HOST, db="gpc1", user=SCIDBS1_USER, passwd=SCIDBS1_PSW
+def resolve_update_logs(log_neb_paths):
+    """
+    resolve many update logs with one bulk nebulous query
+
+    Returns
+    -------
+    dict
+        nebulous path of each log mapped to its available nebulous instance, or None if the log is not available
+    """
+    log_phy_paths = neb_locate_bulk(log_neb_paths)
+    return {
+        log_neb_path: _resolve_log(log_neb_path, log_phy_path)
+        for log_neb_path, log_phy_path in log_phy_paths.items()
+    }
+
+
+def stat_update_logs(instances, max_workers=32):
+    """
+    return the (mtime, size) of each resolved update log, or None if the log is not available or cannot be stat'ed
+    """
+
+    def stat(instance):
+        if instance is None:
+            return None
+        try:
+            st = os.stat(instance["path"])
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        return dict(zip(instances, executor.map(stat, instances.values())))
+
+
+def scan_update_logs(
+    log_neb_paths, max_workers=32, max_open_per_host=4, instances=None
+):
+    """
+    find the missing nebulous keys and the input warp cmf files in many update logs
+
+    All logs are resolved with one bulk nebulous query and only their tails are read, concurrently on a thread pool
+    with at most max_open_per_host files open at once on each storage host.
+
+    Parameters
+    ----------
+    log_neb_paths : list of str
+        nebulous paths of the update logs
+    max_workers : int, optional
+        number of threads reading the logs, by default 32
+    max_open_per_host : int, optional
+        maximum number of logs read at once from the same storage host, by default 4
+    instances : dict, optional
+        logs already resolved by resolve_update_logs, by default None to resolve them here
+
+    Returns
+    -------
+    dict
+        nebulous path of each log mapped to a tuple of its missing nebulous key and input warp cmf file, either of
+        which is None if the log is not available or it is not found in the log
+    """
+    if instances is None:
+        instances = resolve_update_logs(log_neb_paths)
+    else:
+        instances = {
+            log_neb_path: instances.get(log_neb_path) for log_neb_path in log_neb_paths
+        }
+    host_locks = {
+        _log_host(instance): threading.BoundedSemaphore(max_open_per_host)
+        for instance in instances.values()
+        if instance is not None
+    }
+
+    def scan(log_neb_path):
+        instance = instances[log_neb_path]
+        if instance is None:
+            return None, None
+        with host_locks[_log_host(instance)]:
+            try:
+                log_cont = tail(instance["path"])
+            except OSError as e:
+                print(f"Update log {log_neb_path} cannot be read: {e}")
+                return None, None
+        return _parse_update_log(log_cont)
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        scanned = executor.map(scan, instances)
+        return dict(zip(instances, scanned))
+
+
+def run_difftool(cmd, retries=2, retry_delay=1.0):
+    """
+    run a difftool command, retrying it with an increasing delay if it fails
+
+    Returns
+    -------
+    bool
+        whether the command eventually succeeded
+    """
+    for attempt in range(retries + 1):
+        try:
+            subprocess.run(
+                cmd,
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
             )
-            db_cursor = db_conn.cursor()
-            db_cursor.execute(query)
-            result = db_cursor.fetchone()
-            db_cursor.close()
-            db_conn.close()
-            if result is not None:
-                stack_id, hostname = result
-                if hostname.strip() == "LANL/Mustang":
-                    # at this point we are confident that it is the offsite LANL HPC processing situation (IPP-1776)
-                    # parse the log again
-                    log_phy_path = neb_locate(log_neb_path)
-                    if (
-                        log_phy_path is not None
-                        and len(log_phy_path) == 1
-                        and log_phy_path[0]["available"]
-                    ):
-                        log_path = log_phy_path[0]["path"]
-                    else:
-                        print(f"Update log {log_neb_path} is not available")
-                        return None
-                    log_cont = tail(log_path)
-                    log_cont.reverse()
-                    # locate the actually culprit: warp cmf file
-                    neb_key = re.compile(
-                        r"^inputSources:\s(neb://\S+\.wrp\.\d+\.skycell\.\d+\.\d+\.cmf)\b"
-                    )
-                    for line in log_cont:
-                        if neb_key.search(line):
-                            m = neb_key.search(line)
-                            missing_nebkey_ = m.group(1)
-                            culprit_phy_path = neb_locate(missing_nebkey_)
-                            if (
-                                culprit_phy_path is not None
-                                and len(culprit_phy_path) >= 1
-                                and not culprit_phy_path[0]["available"]
-                                and culprit_phy_path[0]["volume"].startswith("ipp138.0")
-                            ):
-                                return missing_nebkey_, repair_warp
-                            else:
-                                return missing_nebkey, None
-                    else:
-                        return missing_nebkey, None
-            else:
-                return missing_nebkey, None
-        else:
-            return missing_nebkey, None
-    # IPP-1580, IPP-1826, IPP-1987
-    # IPP-1826 is a special case when the missing file is not neccessarily in ipp138.0
-    # the problem probably arise from experiments trying to fix IPP-1580
-    # I include it here because it has a fairly simple solution
-    # and it is a hassele to manually fix it when there are many of faulted items
-    if missing_subkernel.fullmatch(missing_nebkey):
-        culprit_phy_path = neb_locate(missing_nebkey)
-        if culprit_phy_path is None:
-            subkernel_gone_guess = neb_locate(missing_nebkey + ".GONE")
-            if subkernel_gone_guess is not None and len(subkernel_gone_guess) >= 1:
-                return missing_nebkey, mv_subkernel_gone
-            else:
-                return missing_nebkey, None
-        else:
-            if len(culprit_phy_path) == 1:
-                if culprit_phy_path[0]["volume"]:
-                    if (
-                        culprit_phy_path[0]["volume"].startswith("ipp138.0")
-                        and not culprit_phy_path[0]["available"]
-                    ):
-                        return missing_nebkey, "ipp1580"
-                elif (
-                    culprit_phy_path[0]["volume"] is None
-                    and culprit_phy_path[0]["path"] is None
-                ):
-                    return missing_nebkey, "ipp1987"
-                else:
-                    return missing_nebkey, None
-            else:
-                return missing_nebkey, None
-    # IPP-1606
-    if missing_mdl.fullmatch(missing_nebkey):
-        culprit_phy_path = neb_locate(missing_nebkey)
-        if (
-            culprit_phy_path is not None
-            and len(culprit_phy_path) == 1
-            and not culprit_phy_path[0]["available"]
-            and culprit_phy_path[0]["volume"].startswith("ipp138.0")
-        ):
-            return missing_nebkey, "ipp1606"
-        else:
-            return missing_nebkey, None
-    # IPP-2009
-    if missing_psf.fullmatch(missing_nebkey):
-        culprit_phy_path = neb_locate(missing_nebkey)
-        if len(culprit_phy_path) == 1:
-            if (
-                culprit_phy_path[0]["volume"] is None
-                and culprit_phy_path[0]["path"] is None
-            ):
-                return missing_nebkey, "ipp2009"
+            return True
+        except subprocess.CalledProcessError as e:
+            if attempt < retries:
+                time.sleep(retry_delay * 2**attempt)
             else:
-                return missing_nebkey, None
-        else:
-            return missing_nebkey, None
-    # unknown cases
-    return missing_nebkey, None
+                print(
+                    f"Command '{' '.join(e.cmd)}' returned non-zero exit status after {retries + 1} attempts, please check its stderr below."
+                )
+                # print(e.stdout)
+                print(e.stderr)
+    return False
 
 
-def clear_faults(diff_id, skycell_ids, label, faults, pretend=True):
+def _clear_fault_commands(diff_id, skycell_ids, label, faults):
     if not isinstance(diff_id, int) or not isinstance(label, str):
         raise ValueError("diff_id and label must be a scalar")
     if len(skycell_ids) != len(faults):
@@ -228,62 +249,98 @@ def clear_faults(diff_id, skycell_ids, label, faults, pretend=True):
         str(diff_id),
     ]
     set_fault_5 = [
-        "difftool",
-        "-dbname",
-        "gpc1",
-        "-updatediffskyfile",
-        "-fault",
-        "5",
-        "-diff_id",
-        str(diff_id),
+        [
+            "difftool",
+            "-dbname",
+            "gpc1",
+            "-updatediffskyfile",
+            "-fault",
+            "5",
+            "-diff_id",
+            str(diff_id),
+            "-skycell_id",
+            skycell_id,
+        ]
+        for skycell_id in skycell_ids_
     ]
+    return change_label, set_fault_5, len(skycell_ids) - len(skycell_ids_)
+
+
+def clear_faults_batch(to_clear, pretend=True, max_workers=8, retries=2):
+    """
+    clear the faults of many diffRuns in two phases: change the labels of all diffRuns, then set fault 5 to all their
+    skycells, each phase running the difftool commands concurrently
+
+    The skycells of a diffRun whose label cannot be changed are left untouched so that they are picked up again by
+    the next run.
+
+    Parameters
+    ----------
+    to_clear : list of tuple
+        (diff_id, skycell_ids, label, faults) of each diffRun, where label is the new label of the diffRun
+    pretend : bool, optional
+        print the commands only, by default True
+    max_workers : int, optional
+        number of difftool commands running at once, by default 8
+    retries : int, optional
+        number of retries of a failed difftool command, by default 2
+
+    Returns
+    -------
+    list of str
+        the failed commands
+    """
+    cmds = [_clear_fault_commands(*item) for item in to_clear]
+    n_skipped = sum(item[2] for item in cmds)
     if pretend:
         print("Suggested commands:")
-        print(" ".join(change_label))
-        if len(skycell_ids_) < len(skycell_ids):
-            print(f"Skipped {len(skycell_ids)-len(skycell_ids_)} skycell with fault 5.")
-        for skycell_id in skycell_ids_:
-            print(" ".join(set_fault_5 + ["-skycell_id", skycell_id]))
-    else:
-        print("Running commands ...")
-        print(" ".join(change_label))
-        try:
-            subprocess.run(
-                change_label,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-            )
-        except subprocess.CalledProcessError as e:
-            print(
-                f"Command '{' '.join(e.cmd)}' returned non-zero exit status, please check its stderr below."
-            )
-            # print(e.stdout)
-            print(e.stderr)
-            # return None
-        sleep(0.01)
-        if len(skycell_ids_) < len(skycell_ids):
-            print(f"Skipped {len(skycell_ids)-len(skycell_ids_)} skycell with fault 5.")
-        for skycell_id in skycell_ids_:
-            cmd = set_fault_5 + ["-skycell_id", skycell_id]
+        for change_label, set_fault_5, _ in cmds:
+            print(" ".join(change_label))
+            for cmd in set_fault_5:
+                print(" ".join(cmd))
+        if n_skipped:
+            print(f"Skipped {n_skipped} skycell with fault 5.")
+        return []
+    print("Running commands ...")
+    time_start = time.time()
+    failed = []
+    with ThreadPoolExecutor(max_workers) as executor:
+        label_changed = list(
+            executor.map(lambda item: run_difftool(item[0], retries=retries), cmds)
+        )
+        for (change_label, _, _), is_changed in zip(cmds, label_changed):
+            print(" ".join(change_label))
+            if not is_changed:
+                failed.append(" ".join(change_label))
+        set_fault_5 = [
+            cmd
+            for (_, set_fault_5_, _), is_changed in zip(cmds, label_changed)
+            if is_changed
+            for cmd in set_fault_5_
+        ]
+        fault_set = list(
+            executor.map(lambda cmd: run_difftool(cmd, retries=retries), set_fault_5)
+        )
+        for cmd, is_set in zip(set_fault_5, fault_set):
             print(" ".join(cmd))
-            try:
-                subprocess.run(
-                    cmd,
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    universal_newlines=True,
-                )
-            except subprocess.CalledProcessError as e:
-                print(
-                    f"Command '{' '.join(e.cmd)}' returned non-zero exit status, please check its stderr below."
-                )
-                # print(e.stdout)
-                print(e.stderr)
-                # return None
-            sleep(0.01)
+            if not is_set:
+                failed.append(" ".join(cmd))
+    if n_skipped:
+        print(f"Skipped {n_skipped} skycell with fault 5.")
+    n_cmds = len(cmds) + len(set_fault_5)
+    elapsed = time.time() - time_start
+    print(
+        f"{n_cmds - len(failed)}/{n_cmds} difftool commands succeeded in {elapsed:.1f} seconds ({n_cmds / max(elapsed, 1e-6):.1f} commands/s)"
+    )
+    if failed:
+        print("Failed commands:")
+        for cmd in failed:
+            print(cmd)
+    return failed
+
+
+def clear_faults(diff_id, skycell_ids, label, faults, pretend=True):
+    return clear_faults_batch([(diff_id, skycell_ids, label, faults)], pretend=pretend)
 
 
 def mv_subkernel_gone(missing_nebkey, pretend=True):
@@ -442,7 +499,7 @@ def repair_warp(missing_nebkey, pretend=True):
                 stderr=subprocess.PIPE,
                 universal_newlines=True,
             )
-            sleep(0.05)
+            time.sleep(0.05)
             subprocess.run(
                 clean_warp,
                 check=True,
@@ -450,7 +507,7 @@ def repair_warp(missing_nebkey, pretend=True):
                 stderr=subprocess.PIPE,
                 universal_newlines=True,
             )
-            sleep(0.05)
+            time.sleep(0.05)
             subprocess.run(
                 update_warp,
                 check=True,
@@ -467,7 +524,431 @@ def repair_warp(missing_nebkey, pretend=True):
             return None
 
 
-def main(label, pretend=True, limit=None):
+def get_stack_hostnames(stack_ids):
+    """
+    return the hostnames that processed the given stacks with one query of stackSumSkyfile
+    """
+    stack_ids = sorted(set(stack_ids))
+    if not stack_ids:
+        return {}
+    db_conn = MySQLdb.connect(
+        host=SCIDBS1_HOST, db="gpc1", user=SCIDBS1_USER, passwd=SCIDBS1_PSW
+    )
+    db_cursor = db_conn.cursor()
+    hostnames = {}
+    for i in range(0, len(stack_ids), 1000):
+        stack_ids_chunk = stack_ids[i : i + 1000]
+        query = f"select stack_id, hostname from stackSumSkyfile where stack_id in ({', '.join(['%s'] * len(stack_ids_chunk))})"
+        db_cursor.execute(query, stack_ids_chunk)
+        for stack_id, hostname in db_cursor.fetchall():
+            hostnames[int(stack_id)] = hostname
+    db_cursor.close()
+    db_conn.close()
+    return hostnames
+
+
+# lookups of the fault rules: return the nebulous keys and stack_ids to look up for a matched missing nebulous key
+def _lookup_key(m, input_warp_cmf):
+    return [m.group(0)], []
+
+
+def _lookup_key_gone(m, input_warp_cmf):
+    return [m.group(0), m.group(0) + ".GONE"], []
+
+
+def _lookup_stack(m, input_warp_cmf):
+    nebkeys = [m.group(0)]
+    if input_warp_cmf is not None:
+        nebkeys.append(input_warp_cmf)
+    return nebkeys, [int(m.group("stack_id"))]
+
+
+# predicates of the fault rules: return the culprit nebulous key if the rule applies, otherwise None
+def _is_unavailable_on_ipp138(instances, single=False):
+    return (
+        instances is not None
+        and (len(instances) == 1 if single else len(instances) >= 1)
+        and not instances[0]["available"]
+        and instances[0]["volume"] is not None
+        and instances[0]["volume"].startswith("ipp138.0")
+    )
+
+
+def _unavailable_on_ipp138(m, input_warp_cmf, instances, stack_hostnames):
+    if _is_unavailable_on_ipp138(instances.get(m.group(0))):
+        return m.group(0)
+
+
+def _single_unavailable_on_ipp138(m, input_warp_cmf, instances, stack_hostnames):
+    if _is_unavailable_on_ipp138(instances.get(m.group(0)), single=True):
+        return m.group(0)
+
+
+def _single_without_volume(m, input_warp_cmf, instances, stack_hostnames):
+    culprit_phy_path = instances.get(m.group(0))
+    if (
+        culprit_phy_path is not None
+        and len(culprit_phy_path) == 1
+        and culprit_phy_path[0]["volume"] is None
+        and culprit_phy_path[0]["path"] is None
+    ):
+        return m.group(0)
+
+
+def _gone_only(m, input_warp_cmf, instances, stack_hostnames):
+    subkernel_gone_guess = instances.get(m.group(0) + ".GONE")
+    if (
+        instances.get(m.group(0)) is None
+        and subkernel_gone_guess is not None
+        and len(subkernel_gone_guess) >= 1
+    ):
+        return m.group(0)
+
+
+def _lanl_input_warp_unavailable_on_ipp138(
+    m, input_warp_cmf, instances, stack_hostnames
+):
+    # a missing stack cmf processed by LANL/Mustang is the offsite LANL HPC processing situation (IPP-1776)
+    # and the actual culprit is the input warp cmf file
+    hostname = stack_hostnames.get(int(m.group("stack_id")))
+    if (
+        instances.get(m.group(0)) is None
+        and hostname is not None
+        and hostname.strip() == "LANL/Mustang"
+        and input_warp_cmf is not None
+        and _is_unavailable_on_ipp138(instances.get(input_warp_cmf))
+    ):
+        return input_warp_cmf
+
+
+# a fault rule applies a solution to a missing nebulous key that matches the pattern (without anchors) when the
+# predicate returns the culprit nebulous key. the solution is either a callable fixing the problem or a string of the
+# JIRA ticket of a non-fixable problem. rules of the same pattern are tried in order and the first one applies.
+# named groups in the patterns must be unique across the table.
+FaultRule = namedtuple("FaultRule", ["pattern", "lookup", "predicate", "solution"])
+
+missing_subkernel = r"neb://\S+\.skycell\.\d+\.\d+(?:\.WS)?\.dif\.\d+\.subkernel"
+FAULT_RULES = [
+    # various warp products, including IPP-1762; see https://panstarrs.atlassian.net/wiki/spaces/IPPCZAR/pages/678633973/ipp138.0+Warp+Diff+Data+Recovery#Missing-wrp.skycell.fits-file-SOLVED
+    FaultRule(
+        r"neb://\S+\.wrp\.\d+\.skycell\.\d+\.\d+\.\S*(?:fits|cmf)",
+        _lookup_key,
+        _unavailable_on_ipp138,
+        repair_warp,
+    ),
+    # IPP-1776
+    FaultRule(
+        r"neb://\S+\.skycell\.\d+\.\d+\.stk\.(?P<stack_id>\d+)\.cmf",
+        _lookup_stack,
+        _lanl_input_warp_unavailable_on_ipp138,
+        repair_warp,
+    ),
+    # IPP-1580, IPP-1826, IPP-1987
+    # IPP-1826 is a special case when the missing file is not neccessarily in ipp138.0
+    # the problem probably arise from experiments trying to fix IPP-1580
+    # I include it here because it has a fairly simple solution
+    # and it is a hassele to manually fix it when there are many of faulted items
+    FaultRule(missing_subkernel, _lookup_key_gone, _gone_only, mv_subkernel_gone),
+    FaultRule(missing_subkernel, _lookup_key, _single_unavailable_on_ipp138, "ipp1580"),
+    FaultRule(missing_subkernel, _lookup_key, _single_without_volume, "ipp1987"),
+    # IPP-1606
+    FaultRule(
+        r"neb://\S+\.skycell\.\d+\.\d+\.WS\.dif\.\d+\.mdl\.fits",
+        _lookup_key,
+        _single_unavailable_on_ipp138,
+        "ipp1606",
+    ),
+    # IPP-2009
+    FaultRule(
+        r"neb://\S+\.skycell\.\d+\.\d+(?:\.WS)?\.dif\.\d+\.psf",
+        _lookup_key,
+        _single_without_volume,
+        "ipp2009",
+    ),
+]
+
+
+def compile_fault_rules(fault_rules):
+    """
+    compile the patterns of the fault rules into one regex with a named group per unique pattern
+
+    Returns
+    -------
+    tuple
+        the compiled regex and a dict of the group names mapped to the rules of the pattern
+    """
+    patterns = {}
+    for rule in fault_rules:
+        patterns.setdefault(rule.pattern, []).append(rule)
+    rules_of_group = {f"rule{i}": rules for i, rules in enumerate(patterns.values())}
+    fault_regex = re.compile(
+        "|".join(
+            f"(?P<{group}>{rules[0].pattern})"
+            for group, rules in rules_of_group.items()
+        )
+    )
+    return fault_regex, rules_of_group
+
+
+fault_regex, fault_rules_of_group = compile_fault_rules(FAULT_RULES)
+
+
+def _match_fault_rules(missing_nebkey):
+    # the outermost group of the matched pattern closes last, so it is the lastgroup of the match
+    m = fault_regex.fullmatch(missing_nebkey)
+    if m is None:
+        return None, []
+    return m, fault_rules_of_group[m.lastgroup]
+
+
+def classify_problem(missing_nebkey, input_warp_cmf, instances, stack_hostnames):
+    """
+    classify a problem by the fault rules with the nebulous instances and stack hostnames already looked up by
+    classify_problems
+
+    Parameters
+    ----------
+    missing_nebkey : str
+        nebulous key of the missing file found in the update log
+    input_warp_cmf : str
+        nebulous key of the input warp cmf file found in the update log
+    instances : dict
+        nebulous keys mapped to their instances like neb_locate_bulk returns
+    stack_hostnames : dict
+        stack_ids mapped to the hostnames that processed the stacks
+
+    Returns
+    -------
+    tuple
+        the culprit nebulous key and the solution, which is either a callable fixing the problem, a string of the
+        JIRA ticket of non-fixable problems, or None for unknown problems
+    """
+    if missing_nebkey is None:
+        return missing_nebkey, None
+    m, rules = _match_fault_rules(missing_nebkey)
+    for rule in rules:
+        culprit_nebkey = rule.predicate(m, input_warp_cmf, instances, stack_hostnames)
+        if culprit_nebkey is not None:
+            return culprit_nebkey, rule.solution
+    # unknown cases
+    return missing_nebkey, None
+
+
+def classify_problems(scanned):
+    """
+    classify many problems in three stages: collect the keys the matched fault rules need from all logs, look them
+    up with one bulk nebulous query and one stackSumSkyfile query, and apply the rules in memory
+
+    Parameters
+    ----------
+    scanned : list of tuple
+        the missing nebulous key and input warp cmf file of each log as returned by scan_update_logs
+
+    Returns
+    -------
+    list of tuple
+        the culprit nebulous key and the solution of each log, see classify_problem
+    """
+    nebkeys = set()
+    stack_ids = set()
+    for missing_nebkey, input_warp_cmf in scanned:
+        if missing_nebkey is None:
+            continue
+        m, rules = _match_fault_rules(missing_nebkey)
+        for rule in rules:
+            nebkeys_, stack_ids_ = rule.lookup(m, input_warp_cmf)
+            nebkeys.update(nebkeys_)
+            stack_ids.update(stack_ids_)
+    instances = neb_locate_bulk(nebkeys)
+    stack_hostnames = get_stack_hostnames(stack_ids)
+    return [
+        classify_problem(missing_nebkey, input_warp_cmf, instances, stack_hostnames)
+        for missing_nebkey, input_warp_cmf in scanned
+    ]
+
+
+def _solution_name(solution):
+    return solution.__name__ if callable(solution) else solution
+
+
+def _code_signature(code):
+    # bytecode, constants and names of a code object, including those of its nested functions
+    return (
+        code.co_code,
+        tuple(
+            _code_signature(const) if isinstance(const, types.CodeType) else const
+            for const in code.co_consts
+        ),
+        code.co_names,
+    )
+
+
+def _function_signatures(funcs):
+    # code signatures of functions and of the functions of their module they call, e.g. _is_unavailable_on_ipp138
+    signatures = {}
+    pending = list(funcs)
+    while pending:
+        func = pending.pop()
+        if func.__name__ in signatures:
+            continue
+        signatures[func.__name__] = _code_signature(func.__code__)
+        for name in func.__code__.co_names:
+            callee = func.__globals__.get(name)
+            if (
+                isinstance(callee, types.FunctionType)
+                and callee.__module__ == func.__module__
+            ):
+                pending.append(callee)
+    return sorted(signatures.items())
+
+
+# the cached classifications are only valid for the same fault rules, so the version changes with the patterns, the
+# solutions and the code of the lookups, the predicates and the functions they call
+FAULT_RULES_VERSION = hashlib.sha1(
+    repr(
+        (
+            [(rule.pattern, _solution_name(rule.solution)) for rule in FAULT_RULES],
+            _function_signatures(
+                [classify_problem]
+                + [rule.lookup for rule in FAULT_RULES]
+                + [rule.predicate for rule in FAULT_RULES]
+            ),
+        )
+    ).encode()
+).hexdigest()
+DEFAULT_FAULT_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "ippy", "clear_ipp138_update_faults.sqlite"
+)
+
+
+def open_fault_cache(cache_path=DEFAULT_FAULT_CACHE):
+    """
+    open the SQLite cache of the classified faults, creating it if needed
+
+    The classification of a faulted skycell is reused as long as its update log has the same physical path, mtime
+    and size and the fault rules are unchanged. Fixable faults are not cached, because fixing them changes the
+    nebulous state the classification depends on without touching the log.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    cache_conn = sqlite3.connect(cache_path)
+    cache_conn.execute("""
+        create table if not exists faults (
+            diff_id integer not null,
+            skycell_id text not null,
+            label text not null,
+            log_path text not null,
+            log_mtime real not null,
+            log_size integer not null,
+            missing_nebkey text,
+            solution text,
+            rules_version text not null,
+            primary key (diff_id, skycell_id)
+        )
+        """)
+    return cache_conn
+
+
+def load_cached_faults(cache_conn, keys, instances, log_stats, log_neb_paths):
+    """
+    return the cached (missing nebulous key, solution) of the faulted skycells whose update logs are unchanged
+
+    Parameters
+    ----------
+    cache_conn : sqlite3.Connection
+        cache opened by open_fault_cache
+    keys : list of tuple
+        (diff_id, skycell_id) of the faulted skycells
+    instances : dict
+        nebulous path of each log mapped to its instance as returned by resolve_update_logs
+    log_stats : dict
+        nebulous path of each log mapped to its (mtime, size) as returned by stat_update_logs
+    log_neb_paths : list of str
+        nebulous path of the update log of each faulted skycell
+
+    Returns
+    -------
+    dict
+        (diff_id, skycell_id) mapped to the cached (missing nebulous key, solution)
+    """
+    solutions = {_solution_name(rule.solution): rule.solution for rule in FAULT_RULES}
+    cached = {}
+    rows = cache_conn.execute(
+        "select diff_id, skycell_id, log_path, log_mtime, log_size, missing_nebkey, solution from faults "
+        "where rules_version = ?",
+        (FAULT_RULES_VERSION,),
+    )
+    rows = {(row[0], row[1]): row[2:] for row in rows}
+    for key, log_neb_path in zip(keys, log_neb_paths):
+        row = rows.get(key)
+        log_stat = log_stats.get(log_neb_path)
+        if row is None or log_stat is None:
+            continue
+        log_path, log_mtime, log_size, missing_nebkey, solution = row
+        if (
+            log_path == instances[log_neb_path]["path"]
+            and (log_mtime, log_size) == log_stat
+        ):
+            cached[key] = missing_nebkey, solutions.get(solution, solution)
+    return cached
+
+
+def store_cached_faults(
+    cache_conn, keys, labels, instances, log_stats, log_neb_paths, classified
+):
+    """
+    cache the classified faults with the stats of their update logs, skipping fixable faults and unavailable logs
+    """
+    rows = []
+    for key, label, log_neb_path, (missing_nebkey, solution) in zip(
+        keys, labels, log_neb_paths, classified
+    ):
+        log_stat = log_stats.get(log_neb_path)
+        if callable(solution) or log_stat is None:
+            continue
+        rows.append(
+            (
+                *key,
+                label,
+                instances[log_neb_path]["path"],
+                *log_stat,
+                missing_nebkey,
+                _solution_name(solution),
+                FAULT_RULES_VERSION,
+            )
+        )
+    with cache_conn:
+        cache_conn.executemany(
+            "insert or replace into faults values (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+
+
+def prune_fault_cache(cache_conn, label, keys):
+    """
+    remove the cached faults of the label pattern that are no longer faulted, i.e., not in keys
+    """
+    keys = set(keys)
+    stale = [
+        row
+        for row in cache_conn.execute(
+            "select diff_id, skycell_id from faults where label like ?", (label,)
+        )
+        if row not in keys
+    ]
+    with cache_conn:
+        cache_conn.executemany(
+            "delete from faults where diff_id = ? and skycell_id = ?", stale
+        )
+    return len(stale)
+
+
+def main(
+    label,
+    pretend=True,
+    limit=None,
+    cache_path=DEFAULT_FAULT_CACHE,
+    max_workers=8,
+    retries=2,
+):
     if label == "all":
         label = "ps_ud_%"
     elif not label.startswith("ps_ud_"):
@@ -496,94 +977,96 @@ def main(label, pretend=True, limit=None):
     db_conn.close()
     if result is None:
         return None
-    diff_ids = []
-    skycell_ids = []
-    labels = []
-    missing_nebkeys = []
-    solutions = []
-    faults = []
-    for item in result:
+    keys = [(int(item[0]), item[1]) for item in result]
+    log_neb_paths = [item[3] for item in result]
+    instances = resolve_update_logs(log_neb_paths)
+    log_stats = stat_update_logs(instances)
+    if cache_path is not None:
+        cache_conn = open_fault_cache(cache_path)
+        classified = load_cached_faults(
+            cache_conn, keys, instances, log_stats, log_neb_paths
+        )
+    else:
+        classified = {}
+    # only scan and classify the new or changed faults
+    idxs_to_scan = [idx for idx, key in enumerate(keys) if key not in classified]
+    print(
+        f"{len(keys) - len(idxs_to_scan)} of {len(keys)} faults classified from the cache"
+    )
+    scanned = scan_update_logs(
+        [log_neb_paths[idx] for idx in idxs_to_scan], instances=instances
+    )
+    classified_new = classify_problems(
+        [scanned[log_neb_paths[idx]] for idx in idxs_to_scan]
+    )
+    classified.update(
+        (keys[idx], problem) for idx, problem in zip(idxs_to_scan, classified_new)
+    )
+    if cache_path is not None:
+        store_cached_faults(
+            cache_conn,
+            [keys[idx] for idx in idxs_to_scan],
+            [result[idx][2] for idx in idxs_to_scan],
+            instances,
+            log_stats,
+            [log_neb_paths[idx] for idx in idxs_to_scan],
+            classified_new,
+        )
+        # a limited query does not see all faults of the label
+        if limit is None:
+            prune_fault_cache(cache_conn, label, keys)
+        cache_conn.close()
+    classified = [classified[key] for key in keys]
+    diff_ids_to_fix = set()
+    # group skycells of the same diff_id to avoid duplicate change label operations
+    # also make sure the new label encapsulates all tickets of the skycell issues, e.g., ps_ud_QUB.ipp1580.ipp1762
+    to_clear = {}
+    for item, (missing_nebkey, solution) in zip(result, classified):
         # print(item[:])
-        missing_nebkey = find_missing_nebkey(item[3])
-        if missing_nebkey is None:
-            continue
-        # culprit_phy_path = neb_locate(missing_nebkey)
-        missing_nebkey, solution = classify_problem(missing_nebkey, item[3])
-        if solution is None:
-            continue
-        else:
-            diff_ids.append(item[0])
-            skycell_ids.append(item[1])
-            labels.append(item[2])
-            missing_nebkeys.append(missing_nebkey)
-            solutions.append(solution)
-            faults.append(item[4])
-    diff_ids_to_fix = []
-    # skycell_ids_to_fix = []
-    # missing_nebkeys_to_fix = []
-    # labels_to_fix = []
-    diff_ids_to_clear = []
-    skycell_ids_to_clear = []
-    missing_nebkeys_to_clear = []
-    labels_to_clear = []
-    faults_to_clear = []
-    label_suffixes = []
-    # fix faults with known solutions first
-    for idx, solution in enumerate(solutions):
+        diff_id, skycell_id, label_, _, fault = item
+        # fix faults with known solutions first
         # fixable faults
         if callable(solution):
-            diff_ids_to_fix.append(diff_ids[idx])
-            # skycell_ids_to_fix.append(skycell_ids[idx])
-            # missing_nebkeys_to_fix.append(missing_nebkeys[idx])
-            # labels_to_fix.append(labels[idx])
+            diff_ids_to_fix.add(diff_id)
             print(
-                f"diff_id={diff_ids[idx]}, skycell_id={skycell_ids[idx]}, fault={faults[idx]}, missing_nebkey={missing_nebkeys[idx]}, solution={solution.__name__}"
+                f"diff_id={diff_id}, skycell_id={skycell_id}, fault={fault}, missing_nebkey={missing_nebkey}, solution={solution.__name__}"
             )
-            solution(missing_nebkeys[idx], pretend=pretend)
+            solution(missing_nebkey, pretend=pretend)
         # non-fixable faults, solution is a string of the JIRA ticket
         elif solution is not None and isinstance(solution, str):
-            diff_ids_to_clear.append(diff_ids[idx])
-            skycell_ids_to_clear.append(skycell_ids[idx])
-            missing_nebkeys_to_clear.append(missing_nebkeys[idx])
-            labels_to_clear.append(labels[idx])
-            label_suffixes.append(solution)
-            faults_to_clear.append(faults[idx])
-    # then clear faults
-    # if len(set(diff_ids_to_clear)) < len(diff_ids_to_clear):
-    # group skycells of the same diff_id to avoid duplicate change label operations
-    # also make sure the new label encapsulates all tickets of the skycell issues, e.g., ps_ud_QUB.ipp1580.ipp1762
-    diff_ids_to_clear_uniq = sorted(set(diff_ids_to_clear))
-    for diff_id in diff_ids_to_clear_uniq:
-        idxs = [
-            i for i in range(len(diff_ids_to_clear)) if diff_ids_to_clear[i] == diff_id
-        ]
-        skycell_ids_to_clear_ = []
-        label_suffixes_ = []
-        faults_to_clear_ = []
-        # root of new label, i.e., the original label
-        new_label = labels_to_clear[idxs[0]]
-        for idx in idxs:
-            print(
-                f"diff_id={diff_ids_to_clear[idx]}, skycell_id={skycell_ids_to_clear[idx]}, fault={faults_to_clear[idx]}, missing_nebkey={missing_nebkeys_to_clear[idx]}, solution={label_suffixes[idx]}"
+            # root of new label, i.e., the original label
+            diff = to_clear.setdefault(
+                diff_id,
+                {
+                    "label": label_,
+                    "skycell_ids": [],
+                    "faults": [],
+                    "tickets": {},
+                    "printed": [],
+                },
+            )
+            diff["skycell_ids"].append(skycell_id)
+            diff["faults"].append(fault)
+            diff["tickets"][solution] = None
+            diff["printed"].append(
+                f"diff_id={diff_id}, skycell_id={skycell_id}, fault={fault}, missing_nebkey={missing_nebkey}, solution={solution}"
             )
-            skycell_ids_to_clear_.append(skycell_ids_to_clear[idx])
-            label_suffixes_.append(label_suffixes[idx])
-            faults_to_clear_.append(faults_to_clear[idx])
-        label_suffixes_ = set(label_suffixes_)
-        new_label = new_label + "." + ".".join(label_suffixes_)
+    # then clear faults
+    to_clear_ = []
+    for diff_id in sorted(to_clear):
+        diff = to_clear[diff_id]
+        print("\n".join(diff["printed"]))
+        new_label = diff["label"] + "." + ".".join(diff["tickets"])
         # see if there are fixable skycells that belong the same diff_id
         if diff_id in diff_ids_to_fix:
             print(
                 "clearing faults of the above skycells are blocked until fixable faults of other skycells that belong to the same diff_id are fixed"
             )
         else:
-            clear_faults(
-                diff_id,
-                skycell_ids_to_clear_,
-                new_label,
-                faults_to_clear_,
-                pretend=pretend,
-            )
+            to_clear_.append((diff_id, diff["skycell_ids"], new_label, diff["faults"]))
+    clear_faults_batch(
+        to_clear_, pretend=pretend, max_workers=max_workers, retries=retries
+    )
 
 
 if __name__ == "__main__":
@@ -612,9 +1095,35 @@ if __name__ == "__main__":
         nargs="?",
         help="Number limits of skycell_ids to check and clear. Useful for diagnose the issue before batch operations. Default is None for no limits.",
     )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=DEFAULT_FAULT_CACHE,
+        help=f"SQLite cache of the classified faults, reused while their update logs are unchanged. Default: {DEFAULT_FAULT_CACHE}",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="classify all faults without reading or updating the cache. Default: False when the flag not specified.",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=8,
+        help="Number of difftool commands running at once when clearing faults. Default: 8",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="Number of retries of a failed difftool command. Default: 2",
+    )
     parsed_args = parser.parse_args()
     main(
         label=parsed_args.label,
         pretend=parsed_args.pretend,
         limit=parsed_args.limit,
+        cache_path=None if parsed_args.no_cache else parsed_args.cache,
+        max_workers=parsed_args.max_workers,
+        retries=parsed_args.retries,
     )
@@ -4,21 +4,310 @@ import argparse
 import subprocess
 import sys
 import time
-from datetime import datetime
+from datetime import datetime, timezone
+from itertools import chain
 from pathlib import Path
 
 import MySQLdb
+import numpy as np
+from astropy.table import Table
 
 ippy_parent_dir = str(Path(__file__).resolve().parents[2])
 if ippy_parent_dir not in sys.path:
     sys.path.append(ippy_parent_dir)
 
 from ippy.constants import SCIDBM, SCIDBS1, SCIDBS2
-from ippy.misc import infer_inst_from_expname
+from ippy.misc import expname_pattern, group_expnames_by_inst
+from ippy.processing.nightly_obs import Visit
+
+# number of ids per "in (...)" clause of the batched queries
+QUERY_CHUNK_SIZE = 1000
+# number of failed difftool attempts before giving up on a quad
+MAX_DIFF_ATTEMPTS = 3
+# seconds for the chipRuns created by chiptool to be replicated to the database host of the queries before a quad
+# without them is considered not queued
+CHIP_QUEUE_GRACE = 300
+
+
+def read_expnames(expnames):
+    """
+    return the valid exposure names given on the command line or, if there are none, read from the given files
+    """
+    valid_expnames = [e for e in expnames if expname_pattern.match(e)]
+    if not valid_expnames:
+        for expname_file in expnames:
+            if Path(expname_file).is_file():
+                t_expnames = Table.read(expname_file, format="ascii.no_header")
+                # flatten the table if it has multiple columns, e.g. one quad per line
+                t_expnames = list(chain.from_iterable(np.ravel(t_expnames).tolist()))
+                valid_expnames.extend(e for e in t_expnames if expname_pattern.match(e))
+    if not valid_expnames:
+        raise ValueError("No valid exposure name found.")
+    # drop duplicates but keep the order
+    return list(dict.fromkeys(valid_expnames))
+
+
+def query_in_chunks(db_cursor, query, ids, params=()):
+    """
+    run a query with an "in ({})" clause in chunks of QUERY_CHUNK_SIZE ids and return all rows
+    """
+    ids = list(ids)
+    result = []
+    for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+        ids_chunk = ids[i : i + QUERY_CHUNK_SIZE]
+        db_cursor.execute(
+            query.format(", ".join(["%s"] * len(ids_chunk))), [*params, *ids_chunk]
+        )
+        result.extend(db_cursor.fetchall())
+    return result
+
+
+class QuadTracker:
+    """
+    state machine of a quad processed from chip to warp to wwdiff
+
+    The states are "chip" (waiting for the chipRuns), "warp" (waiting for the warps), "diff" (some diffs are queued,
+    waiting for the rest of the warps), "done" (all the diffs the quad can make are queued) and "failed" (some
+    exposures were not queued at chip stage). The state is derived from the database only, so a tracker can be
+    rebuilt at any time, e.g. after the orchestrator is interrupted.
+    """
+
+    def __init__(self, dbname, name, exp_names, exp_ids):
+        self.dbname = dbname
+        self.name = name
+        self.exp_names = exp_names
+        self.exp_ids = exp_ids
+        self.state = "chip"
+        self.visits = {}
+        self.queued_pairs = set()
+        self.failed_attempts = 0
+
+    def __str__(self):
+        return f"<Quad {self.name} in {self.dbname} {self.state}: {' '.join(self.exp_names)}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def update(self, visits, queued_pairs):
+        """
+        update the state from the visits and the (warp_id, template_warp_id) pairs of the diffs already queued
+        """
+        self.visits = {v.visit_num: v for v in visits}
+        warp_ids = set(v.warp_id for v in visits)
+        # keep the pairs queued by this process in case the database lags behind
+        self.queued_pairs |= set(p for p in queued_pairs if p[0] in warp_ids)
+        if len(self.visits) < 4:
+            self.state = "chip"
+        elif self.all_visits_processed() and all(
+            pair in self.queued_pairs for pair in self.diff_pairs()
+        ):
+            self.state = "done"
+        elif any(pair in self.queued_pairs for pair in self.diff_pairs()):
+            self.state = "diff"
+        else:
+            self.state = "warp"
+
+    def all_visits_processed(self):
+        return len(self.visits) == 4 and all(
+            v.is_processed() for v in self.visits.values()
+        )
+
+    def diff_pairs(self):
+        """
+        return the (warp_id, template_warp_id) pairs that are certain to be diffed given the current visits
+
+        The pairing follows the good warps in the order of visits: (1, 2) and (3, 4) for four good warps and (1, 2)
+        and (2, 3) for three. The first pair is fixed as soon as the first two good warps in the processed leading
+        visits are known, so it does not have to wait for the other visits of the quad.
+        """
+        processed_visits = []
+        for visit_num in sorted(self.visits):
+            if not self.visits[visit_num].is_processed():
+                break
+            processed_visits.append(self.visits[visit_num])
+        good_warp_ids = [v.warp_id for v in processed_visits if v.warp_state == "full"]
+        if len(processed_visits) == 4 and len(good_warp_ids) == 4:
+            return [
+                (good_warp_ids[0], good_warp_ids[1]),
+                (good_warp_ids[2], good_warp_ids[3]),
+            ]
+        elif len(processed_visits) == 4 and len(good_warp_ids) == 3:
+            return [
+                (good_warp_ids[0], good_warp_ids[1]),
+                (good_warp_ids[1], good_warp_ids[2]),
+            ]
+        elif len(good_warp_ids) >= 2:
+            return [(good_warp_ids[0], good_warp_ids[1])]
+        else:
+            return []
+
+    def pairs_to_queue(self):
+        return [pair for pair in self.diff_pairs() if pair not in self.queued_pairs]
+
+
+def get_quads(expnames, db_host):
+    """
+    group the exposures into quads and check that each quad has the four visits of the same night, chunk, and object
+
+    Returns
+    -------
+    list of QuadTracker
+    """
+    expnames_per_db = group_expnames_by_inst(expnames)
+    quads = []
+    errors = []
+    for dbname, expnames_ in expnames_per_db.items():
+        db_conn = MySQLdb.connect(
+            host=db_host.node, db=dbname, user=db_host.user, passwd=db_host.password
+        )
+        db_cursor = db_conn.cursor()
+        result = query_in_chunks(
+            db_cursor,
+            "select exp_name, exp_id, dateobs, object, comment from rawExp where exp_name in ({})",
+            expnames_,
+        )
+        db_cursor.close()
+        db_conn.close()
+        not_found = set(expnames_) - set(r[0] for r in result)
+        if not_found:
+            errors.append(f"{sorted(not_found)} not found in {dbname}.")
+        groups = {}
+        for exp_name, exp_id, dateobs, object, comment in result:
+            chunk_object_name = comment.rsplit(maxsplit=2)[0]
+            visit_num = int(comment.rsplit(maxsplit=1)[-1])
+            groups.setdefault((object, chunk_object_name, dateobs.date()), []).append(
+                (visit_num, exp_name, exp_id)
+            )
+        for (object, chunk_object_name, date), exps in groups.items():
+            exps.sort()
+            if [e[0] for e in exps] != [1, 2, 3, 4]:
+                errors.append(
+                    f"{[e[1] for e in exps]} of {object} in {chunk_object_name} on {date} do not form a quad with visit numbers from 1 to 4."
+                )
+                continue
+            quads.append(
+                QuadTracker(dbname, object, [e[1] for e in exps], [e[2] for e in exps])
+            )
+    if errors:
+        raise ValueError("\n".join(errors))
+    return quads
+
+
+def poll_quads(quads, db_host, label, reduction, data_group):
+    """
+    update the states of all the pending quads with one batched query of the warps and one of the diffs per database
+    """
+    quads_per_db = {}
+    for quad in quads:
+        quads_per_db.setdefault(quad.dbname, []).append(quad)
+    for dbname, quads_ in quads_per_db.items():
+        db_conn = MySQLdb.connect(
+            host=db_host.node, db=dbname, user=db_host.user, passwd=db_host.password
+        )
+        db_cursor = db_conn.cursor()
+        query = """
+            select exp_name, exp_id, dateobs, object, substring_index(comment,' ',-1) visit,
+            chip_id, chipRun.state chip_state,
+            cam_id, camRun.state cam_state, camProcessedExp.quality cam_quality, camProcessedExp.fwhm_major cam_fwhm_major,
+            warp_id, warpRun.state warp_state
+            from rawExp
+            join chipRun using (exp_id)
+            left join camRun using (chip_id)
+            left join camProcessedExp using (cam_id)
+            left join fakeRun using (cam_id)
+            left join warpRun using (fake_id)
+            where chipRun.label like %s and chipRun.data_group like %s and chipRun.reduction like %s
+            and exp_id in ({})
+            order by exp_id, warp_id
+        """
+        result = query_in_chunks(
+            db_cursor,
+            query,
+            chain.from_iterable(q.exp_ids for q in quads_),
+            params=(label, data_group, reduction),
+        )
+        # the latest warp of an exposure wins when there are more than one
+        visits = {
+            r[1]: Visit(
+                exp_name=r[0],
+                exp_id=r[1],
+                dateobs=r[2].replace(tzinfo=timezone.utc),
+                object=r[3],
+                visit_num=int(r[4]),
+                chip_id=r[5],
+                chip_state=r[6],
+                cam_id=r[7],
+                cam_state=r[8],
+                cam_quality=r[9],
+                cam_fwhm=r[10],
+                warp_id=r[11],
+                warp_state=r[12],
+                dbname=dbname,
+            )
+            for r in result
+        }
+        warp_ids = [v.warp_id for v in visits.values() if v.warp_id is not None]
+        queued_pairs = set()
+        if warp_ids:
+            query = """
+                select warp1, warp2 from diffInputSkyfile
+                where warp1 in ({}) and stack2 is NULL group by diff_id
+            """
+            queued_pairs = set(query_in_chunks(db_cursor, query, warp_ids))
+        db_cursor.close()
+        db_conn.close()
+        for quad in quads_:
+            quad.update([visits[i] for i in quad.exp_ids if i in visits], queued_pairs)
+
+
+def queue_wwdiff(dbname, warp_id_pair, label, reduction, data_group, workdir, commit):
+    # difftool -dbname gpc1 -definewarpwarp -warp_id 2466230 -template_warp_id 2466231 -backwards -set_workdir neb://@HOST@.0/gpc1/HG.tests/HG.testops.20220726 -set_dist_group NULL -set_label HG.testops -set_data_group HG.testops.20220726 -set_reduction SWEETSPOT -simple -rerun -pretend
+    run_difftool_cmd = [
+        "difftool",
+        "-dbname",
+        dbname,
+        "-definewarpwarp",
+        "-warp_id",
+        str(warp_id_pair[0]),
+        "-template_warp_id",
+        str(warp_id_pair[1]),
+        "-backwards",
+        "-set_workdir",
+        workdir,
+        "-set_dist_group",
+        "NULL",
+        "-set_label",
+        label,
+        "-set_data_group",
+        data_group,
+        "-set_reduction",
+        reduction,
+        "-simple",
+        "-rerun",
+    ]
+    if not commit:
+        run_difftool_cmd.append("-pretend")
+    print(" ".join(run_difftool_cmd))
+    try:
+        run_difftool = subprocess.run(
+            run_difftool_cmd, check=True, text=True, capture_output=True
+        )
+        print(run_difftool.stdout)
+        return True
+    except subprocess.CalledProcessError as e:
+        print(
+            f"Command '{' '.join(e.cmd)}' returned non-zero exit status, please check its stderr below."
+        )
+        print(e.stderr)
+        return False
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Process a quad to selected stage (e.g., WWDiff) with given expnames, label, and reduction class."
+        description="""Process quads to selected stage (e.g., WWDiff) with given expnames, label, and reduction class.
+        Any number of quads can be given. Each quad is tracked through chip, warp, and wwdiff stages and its diffs are
+        queued as soon as their warps are ready. The progress is derived from the database, so an interrupted run
+        can be resumed by simply running the same command again."""
     )
     parser.add_argument("label", help="The label for this run")
     parser.add_argument("reduction", help="The reduction class for this run")
@@ -26,14 +315,19 @@ if __name__ == "__main__":
         "expnames",
         type=str,
         nargs="+",
-        help="Exposure names or files that contain the exposure names to be processed. Separated by space.",
+        help="Exposure names or files that contain the exposure names to be processed, e.g. one quad per line. Separated by space.",
     )
     parser.add_argument(
         "--version",
-        help="""Version of the processing. Sometimes processing may fail or the data were processed with undesired setup. 
-        In this case, we need to reprocess the data with a new version number. It will be used to append to the end of the 
+        help="""Version of the processing. Sometimes processing may fail or the data were processed with undesired setup.
+        In this case, we need to reprocess the data with a new version number. It will be used to append to the end of the
         datagroup and the workdir.""",
     )
+    parser.add_argument(
+        "--date",
+        help="""UTC date of the datagroup in the format YYYYMMDD. Pass the date printed by an interrupted run to resume
+        it on a later day. Default: today""",
+    )
     parser.add_argument(
         "--end_stage",
         default="wwdiff",
@@ -56,65 +350,38 @@ if __name__ == "__main__":
         help="Commit to queue the processing. Default: False when the flag is not specified so chiptool will run with -pretend.",
     )
     parser.add_argument(
-        "--rerun",
-        action="store_true",
-        help="Rerun the commands to complete the processing if previously interupted by e.g., Ctrl-C while waiting for warps to complete. Default: False when the flag is not specified.",
+        "--check_interval",
+        type=int,
+        default=30,
+        help="Time interval in units of seconds for polling the warps of all pending quads. Default: 30",
     )
     args = parser.parse_args()
     # pick the database host for queries
     SCIDB = eval(args.db_host.upper())
-    # check if the four expnames are from the same quad
-    if len(args.expnames) != 4:
-        raise ValueError("Four expnames are required to form a quad.")
-    insts = [infer_inst_from_expname(expname) for expname in args.expnames]
-    inst = set(insts)
-    if len(inst) != 1:
-        raise ValueError("The four expnames must be from the same instrument.")
-    inst = list(inst)[0]
-    query = f"select exp_name, exp_id, dateobs, object, comment from rawExp where exp_name in {tuple(args.expnames)}"
-    # print(query)
-    db_conn = MySQLdb.connect(
-        host=SCIDB.node,
-        db=inst,
-        user=SCIDB.user,
-        passwd=SCIDB.password,
-    )
-    db_cursor = db_conn.cursor()
-    db_cursor.execute(query)
-    result = db_cursor.fetchall()
-    db_cursor.close()
-    db_conn.close()
-    if len(result) == 4:
-        exp_ids = [r[1] for r in result]
-        dateobses = [r[2] for r in result]
-        objects = [r[3] for r in result]
-        comments = [r[4] for r in result]
-    else:
-        raise ValueError("Less/more than four matching expnames found in the database.")
-    # check if the four expnames are from the same night
-    if not all(dateobs.date() == dateobses[0].date() for dateobs in dateobses):
-        raise ValueError("The four expnames must be from the same night.")
-    chunk_object_names = [comment.rsplit(maxsplit=2)[0] for comment in comments]
-    visit_nums = [int(comment.rsplit(maxsplit=1)[-1]) for comment in comments]
-    if len(set(objects)) != 1 or len(set(chunk_object_names)) != 1:
-        raise ValueError("The four expnames must have the same chunk and object name.")
-    if set(visit_nums) != set(range(1, 5)):
-        raise ValueError("The four expnames must have visit numbers from 1 to 4.")
-    # queue the processing from chip to warp
+    expnames = read_expnames(args.expnames)
+    quads = get_quads(expnames, SCIDB)
+    print(f"Processing {len(quads)} quads.")
+    # queue the processing from chip to warp for all quads at once, exposures already queued are skipped
     run_chiptool_cmd = [
         Path(__file__).resolve().parent / "run_chiptool.py",
         args.label,
         args.reduction,
-        *args.expnames,
+        "--expnames",
+        *chain.from_iterable(q.exp_names for q in quads),
     ]
     if args.workdir is not None:
         run_chiptool_cmd.extend(["--workdir", args.workdir])
     else:
         args.workdir = f"neb://@HOST@.0/{args.label}/{args.reduction}"
-    date = datetime.utcnow().strftime("%Y%m%d")
+    if args.date is None:
+        date = datetime.utcnow().strftime("%Y%m%d")
+    else:
+        date = datetime.strptime(args.date, "%Y%m%d").strftime("%Y%m%d")
+    # same as the datagroup defined by run_chiptool.py
     data_group = f"{args.label}.{args.reduction}.{date}"
+    run_chiptool_cmd.extend(["--date", date])
     if args.version is not None:
-        data_group += f".v{args.version}"
+        data_group += f".{args.version}"
         args.workdir += f".v{args.version}"
         run_chiptool_cmd.extend(["--version", args.version])
     if (
@@ -125,125 +392,72 @@ if __name__ == "__main__":
         run_chiptool_cmd.extend(["--end_stage", args.end_stage])
     if args.commit:
         run_chiptool_cmd.append("--commit")
-    if not args.rerun:
-        subprocess.run(run_chiptool_cmd, check=True)
-    else:
-        # check if the chipRun already exists which means queueing from chip to warp was successful
-        db_conn = MySQLdb.connect(
-            host=SCIDB.node,
-            db=inst,
-            user=SCIDB.user,
-            passwd=SCIDB.password,
-        )
-        db_cursor = db_conn.cursor()
-        query = f"""
-            select exp_name, exp_id, substring_index(comment,' ',-1) visit,
-            chip_id, chipRun.state chip_state 
-            from rawExp join chipRun using (exp_id)
-            where exp_id in {tuple(exp_ids)}
-            and (chipRun.label like "{args.label}" and chipRun.data_group like "{data_group}" and chipRun.reduction like "{args.reduction}")
-        """
-        db_cursor.execute(query)
-        result = db_cursor.fetchall()
-        if not result:
-            subprocess.run(run_chiptool_cmd, check=True)
-    if args.commit and (args.end_stage == "wwdiff" or args.end_stage == "wsdiff"):
-        time_start = time.time()
-        print("Waiting for the warp products to be ready...")
-        try:
-            # wait for 5 minutes to begin checking if the warp products are ready
-            if not args.rerun:
-                time.sleep(300)
-            # checking if the warp products are ready
-            db_conn = MySQLdb.connect(
-                host=SCIDB.node,
-                db=inst,
-                user=SCIDB.user,
-                passwd=SCIDB.password,
-            )
-            db_cursor = db_conn.cursor()
-            query = f"""
-                select exp_name, exp_id, substring_index(comment,' ',-1) visit,
-                chip_id, chipRun.state chip_state, 
-                cam_id, camRun.state cam_state, camProcessedExp.quality cam_quality, camProcessedExp.fwhm_major cam_fwhm_major,
-                warp_id, warpRun.state warp_state 
-                from rawExp 
-                left join chipRun using (exp_id)
-                left join camRun using (chip_id) 
-                left join camProcessedExp using (cam_id)
-                left join fakeRun using (cam_id) 
-                left join warpRun using (fake_id) 
-                where exp_id in {tuple(exp_ids)}
-                and (chipRun.label is NULL or (chipRun.label like "{args.label}" and chipRun.data_group like "{data_group}" and chipRun.reduction like "{args.reduction}"))
-                and (warpRun.state like "full" or (camRun.state like "full" and camProcessedExp.quality > 0))
-                order by visit
-            """
-            while True:
-                # query for completed processing from chip to warp, including those failed at cam stage
-                db_cursor.execute(query)
-                result = db_cursor.fetchall()
-                if len(result) == 4:
-                    db_cursor.close()
-                    db_conn.close()
-                    if args.rerun:
-                        print(
-                            f"All four exposures are processed. Now trying to queue wwdiff."
-                        )
-                    else:
-                        print(
-                            f"All four exposures are processed in {(time.time()-time_start)/60:.1f} minutes. Now trying to queue wwdiff."
-                        )
-                    good_warp_ids = [r[-2] for r in result if r[-1] == "full"]
-                    if len(good_warp_ids) == 4:
-                        warp_id_pairs = [
-                            (good_warp_ids[0], good_warp_ids[1]),
-                            (good_warp_ids[2], good_warp_ids[3]),
-                        ]
-                    elif len(good_warp_ids) == 3:
-                        warp_id_pairs = [
-                            (good_warp_ids[0], good_warp_ids[1]),
-                            (good_warp_ids[1], good_warp_ids[2]),
-                        ]
-                    elif len(good_warp_ids) == 2:
-                        warp_id_pairs = [(good_warp_ids[0], good_warp_ids[1])]
-                    else:
-                        warp_id_pairs = []
-                    break
-                else:
-                    time.sleep(20)
-            # queue wwdiff and/or wsdiff
-            if args.end_stage == "wwdiff":
-                for warp_id_pair in warp_id_pairs:
-                    # difftool -dbname gpc1 -definewarpwarp -warp_id 2466230 -template_warp_id 2466231 -backwards -set_workdir neb://@HOST@.0/gpc1/HG.tests/HG.testops.20220726 -set_dist_group NULL -set_label HG.testops -set_data_group HG.testops.20220726 -set_reduction SWEETSPOT -simple -rerun -pretend
-                    run_difftool_cmd = [
-                        "difftool",
-                        "-dbname",
-                        inst,
-                        "-definewarpwarp",
-                        "-warp_id",
-                        str(warp_id_pair[0]),
-                        "-template_warp_id",
-                        str(warp_id_pair[1]),
-                        "-backwards",
-                        "-set_workdir",
-                        args.workdir,
-                        "-set_dist_group",
-                        "NULL",
-                        "-set_label",
+    # failures are reported by run_chiptool.py and show up as quads that failed at chip stage below
+    subprocess.run(run_chiptool_cmd)
+    if not (args.commit and args.end_stage == "wwdiff"):
+        sys.exit(0)
+
+    print(
+        f"Using data_group {data_group}. To resume this run, run the same command with --date {date}."
+    )
+    time_start = time.time()
+    print("Waiting for the warp products to be ready...")
+    pending_quads = quads
+    try:
+        while pending_quads:
+            poll_quads(pending_quads, SCIDB, args.label, args.reduction, data_group)
+            for quad in pending_quads:
+                # chiptool -definebyquery creates the chipRuns right away, so those still missing from the replica
+                # after the grace period were not queued
+                if quad.state == "chip" and time.time() - time_start > CHIP_QUEUE_GRACE:
+                    quad.state = "failed"
+                    print(f"{quad} has exposures not queued at chip stage.")
+                    continue
+                for warp_id_pair in quad.pairs_to_queue():
+                    if queue_wwdiff(
+                        quad.dbname,
+                        warp_id_pair,
                         args.label,
-                        "-set_data_group",
-                        data_group,
-                        "-set_reduction",
                         args.reduction,
-                        "-simple",
-                        "-rerun",
-                    ]
-                    if not args.commit:
-                        run_difftool_cmd.append("-pretend")
-                    print(" ".join(run_difftool_cmd))
-                    subprocess.run(run_difftool_cmd, check=True)
-        except KeyboardInterrupt:
-            print(
-                "Keyboard interruption. Please rerun the script with --rerun to complete the processing."
-            )
-            sys.exit(1)
+                        data_group,
+                        args.workdir,
+                        args.commit,
+                    ):
+                        quad.queued_pairs.add(warp_id_pair)
+                    else:
+                        quad.failed_attempts += 1
+                if quad.failed_attempts >= MAX_DIFF_ATTEMPTS:
+                    quad.state = "failed"
+                    print(
+                        f"{quad} failed to queue wwdiff {quad.failed_attempts} times."
+                    )
+                elif quad.all_visits_processed() and not quad.pairs_to_queue():
+                    quad.state = "done"
+                    print(
+                        f"{quad} all diffs queued in {(time.time()-time_start)/60:.1f} minutes."
+                    )
+            pending_quads = [
+                q for q in pending_quads if q.state not in ("done", "failed")
+            ]
+            if pending_quads:
+                print(
+                    f"{len(pending_quads)} quads pending: "
+                    + ", ".join(
+                        f"{sum(q.state == s for q in pending_quads)} {s}"
+                        for s in ("chip", "warp", "diff")
+                    )
+                    + " "
+                    + datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                )
+                time.sleep(args.check_interval)
+    except KeyboardInterrupt:
+        print(
+            f"Keyboard interruption. Run the same command with --date {date} to resume the processing."
+        )
+        sys.exit(1)
+    failed_quads = [q for q in quads if q.state == "failed"]
+    print(
+        f"{len(quads) - len(failed_quads)}/{len(quads)} quads have all their diffs queued."
+    )
+    if failed_quads:
+        sys.exit(1)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
+import heapq
 import sys
 import time
 from datetime import datetime
+from itertools import count
 from pathlib import Path
 
 import MySQLdb
@@ -87,10 +89,77 @@ def get_chunk_and_dateobs(dbname, label, data_group, chunks, dateobses):
     return chunk_dateobs_pairs_from_db
 
 
+def poll_chunk(chunk_name, dateobs, dbname, label, data_group, commit, verbose):
+    """
+    check a chunk and queue its WWdiffs whose warps are ready
+
+    Returns
+    -------
+    tuple
+        (count of WWdiffs still to queue, whether the chunk is still observed, whether warps of the pending WWdiffs
+        are imminent, a signature of the processing state of the chunk to detect progress between polls)
+    """
+    chunk = Chunk(
+        chunk_name=chunk_name,
+        dbname=dbname,
+        dateobs=dateobs,
+        label=label,
+        data_group=data_group,
+    )
+    # check if any quads have more than 2 copy of the same visit
+    # that suggests the chunk/quad have been processed with the same label more than once
+    # need extra info to locate exactly the chunk/quad that needs wwdiffs, e.g., data_group
+    # note that sometimes a quad may have more than four visits when there is an overridden visit, so use 8 here
+    if any(len(quad.visits) >= 8 for quad in chunk.quads):
+        raise ValueError(
+            f"{chunk.chunk_name} has been processed with the same label for more than once. Needs extra info to locate the chunk/quad. Please try supplying data_group."
+        )
+    print("=" * 120)
+    print(chunk)
+    count_diffs_to_queue = 0
+    is_imminent = False
+    for quad in chunk.quads:
+        diffs_to_queue, diffs_can_be_queued = quad.diffs_to_queue()
+        count_diffs_to_queue += len(diffs_to_queue)
+        # warps of the pending WWdiffs are already running
+        if any(
+            v.warp_id is not None and v.warp_state != "full"
+            for pair in diffs_to_queue
+            for v in pair
+        ):
+            is_imminent = True
+        if verbose or diffs_can_be_queued:
+            print("-" * 120)
+            print(quad)
+            for visit in quad.visits:
+                print(visit)
+            for wwdiff in quad.wwdiffs:
+                print(wwdiff)
+        if diffs_can_be_queued:
+            quad.queue_wwdiffs(pretend=not commit, verbose=True)
+            if commit:
+                # check again soon in case more WWdiffs become ready, while in pretend mode nothing is queued, so the
+                # chunk backs off like any other until its state changes
+                is_imminent = True
+    signature = tuple(
+        sorted(
+            (v.exp_id, v.chip_state, v.cam_state, v.warp_id, v.warp_state)
+            for quad in chunk.quads
+            for v in quad.visits
+        )
+    ) + tuple(sorted(d.diff_id for quad in chunk.quads for d in quad.wwdiffs))
+    return (
+        count_diffs_to_queue,
+        chunk.obs_status == "in progress",
+        is_imminent,
+        signature,
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="""Queue WWdiffs for given dbname, label, and optionaly specified chunks. 
-        if chunks are not specified, all chunks processed with the given label will be considered. 
+        description="""Queue WWdiffs for given dbname, labels, and optionaly specified chunks. 
+        if chunks are not specified, all chunks processed with the given labels will be considered. 
         This script should be called after chip to warp processing have been queued using e.g. run_chiptool.py."""
     )
     parser.add_argument(
@@ -98,17 +167,34 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "label",
-        help="The label for query chip to warp processing. The same label will also be used to queue WWdiffs.",
+        nargs="+",
+        help="The labels for query chip to warp processing. The same label will also be used to queue WWdiffs.",
     )
     parser.add_argument(
         "--check_interval",
         type=int,
         default=60,
-        help="Time interval in units of seconds for scanning the database and queueing WWdiffs.",
+        help="""Time interval in units of seconds for scanning the database for chunks and for polling chunks that
+        are progressing. Chunks whose warps are imminent are polled every --min_interval and idle chunks back off
+        exponentially up to --max_interval. Default: 60""",
+    )
+    parser.add_argument(
+        "--min_interval",
+        type=int,
+        default=10,
+        help="Time interval in units of seconds for polling chunks whose warps are imminent. Default: 10",
+    )
+    parser.add_argument(
+        "--max_interval",
+        type=int,
+        default=900,
+        help="Maximum time interval in units of seconds for polling idle chunks. Default: 900",
     )
     parser.add_argument(
         "--data_group",
-        help="The data_group for query chip to warp processing.",
+        nargs="+",
+        help="""The data_groups for query chip to warp processing. Must be in the same order as the labels.
+        If length is one, it will be broadcasted to the length of labels and vice versa.""",
     )
     parser.add_argument(
         "--chunks",
@@ -143,56 +229,82 @@ if __name__ == "__main__":
             f"chunks and dateobs must be of the same length. {args.chunks} and {args.dateobses} were given."
         )
 
+    # (label, data_group) pairs to watch
+    if args.data_group is None:
+        watches = [(label, None) for label in args.label]
+    elif len(args.label) == len(args.data_group):
+        watches = list(zip(args.label, args.data_group))
+    elif len(args.label) == 1:
+        watches = [(args.label[0], data_group) for data_group in args.data_group]
+    elif len(args.data_group) == 1:
+        watches = [(label, args.data_group[0]) for label in args.label]
+    else:
+        parser.error("Length of data_group must be the same as label or 1.")
+
+    # each chunk is polled at its own pace from a heap of (next poll time, sequence number, chunk key)
+    schedule = []
+    seq = count()
+    intervals = {}
+    signatures = {}
+    finished_chunks = set()
+    next_scan = 0
     while True:
-        print("#" * 120)
-        print(
-            "Checking chunk/quad status " + datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        )
-        chunk_dateobs_pair = get_chunk_and_dateobs(
-            dbname=args.dbname,
-            label=args.label,
-            data_group=args.data_group,
-            chunks=args.chunks,
-            dateobses=args.dateobses,
-        )
-        if chunk_dateobs_pair is None:
-            raise ValueError(f"No chunks found in the database for label {args.label}.")
-        count_diffs_to_queue = 0
-        for chunk, dateobs in chunk_dateobs_pair:
-            chunk = Chunk(
-                chunk_name=chunk,
-                dbname=args.dbname,
-                dateobs=dateobs,
-                label=args.label,
-                data_group=args.data_group,
-            )
-            # check if any quads have more than 2 copy of the same visit
-            # that suggests the chunk/quad have been processed with the same label more than once
-            # need extra info to locate exactly the chunk/quad that needs wwdiffs, e.g., data_group
-            # note that sometimes a quad may have more than four visits when there is an overridden visit, so use 8 here
-            if any(len(quad.visits) >= 8 for quad in chunk.quads):
-                raise ValueError(
-                    f"{chunk.chunk_name} has been processed with the same label for more than once. Needs extra info to locate the chunk/quad. Please try supplying data_group."
+        if time.time() >= next_scan:
+            print("#" * 120)
+            print("Scanning for chunks " + datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            for label, data_group in watches:
+                chunk_dateobs_pair = get_chunk_and_dateobs(
+                    dbname=args.dbname,
+                    label=label,
+                    data_group=data_group,
+                    chunks=args.chunks,
+                    dateobses=args.dateobses,
                 )
-            print("=" * 120)
-            print(chunk)
-            for quad in chunk.quads:
-                (
-                    count_diffs_to_queue_this_quad,
-                    count_diffs_queued_this_quad,
-                ) = quad.queue_wwdiffs(pretend=True, verbose=False)
-                count_diffs_to_queue += count_diffs_to_queue_this_quad
-                if args.verbose or count_diffs_queued_this_quad > 0:
-                    print("-" * 120)
-                    print(quad)
-                    for visit in quad.visits:
-                        print(visit)
-                    for wwdiff in quad.wwdiffs:
-                        print(wwdiff)
-                quad.queue_wwdiffs(pretend=not args.commit, verbose=True)
-        if count_diffs_to_queue == 0:
+                if chunk_dateobs_pair is None:
+                    if next_scan == 0:
+                        raise ValueError(
+                            f"No chunks found in the database for label {label}."
+                        )
+                    continue
+                for chunk, dateobs in chunk_dateobs_pair:
+                    key = (chunk, dateobs, label, data_group)
+                    if key not in intervals and key not in finished_chunks:
+                        intervals[key] = args.check_interval
+                        heapq.heappush(schedule, (time.time(), next(seq), key))
+            next_scan = time.time() + args.check_interval
+        if not schedule:
             print("#" * 120)
             print("No more WWdiffs to queue. Aborting the scanning.")
             break
+        next_poll, _, key = schedule[0]
+        if next_poll > time.time():
+            time.sleep(max(min(next_poll, next_scan) - time.time(), 0))
+            continue
+        heapq.heappop(schedule)
+        chunk, dateobs, label, data_group = key
+        print(
+            f"Checking chunk {chunk} on {dateobs} for label {label} "
+            + datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        )
+        (
+            count_diffs_to_queue,
+            is_obs_in_progress,
+            is_imminent,
+            signature,
+        ) = poll_chunk(
+            chunk, dateobs, args.dbname, label, data_group, args.commit, args.verbose
+        )
+        if count_diffs_to_queue == 0 and not is_obs_in_progress:
+            # nothing left to wait for, stop polling the chunk
+            finished_chunks.add(key)
+            del intervals[key]
+            signatures.pop(key, None)
+            continue
+        if is_imminent:
+            intervals[key] = args.min_interval
+        elif signatures.get(key) != signature:
+            intervals[key] = args.check_interval
         else:
-            time.sleep(args.check_interval)
+            intervals[key] = min(intervals[key] * 2, args.max_interval)
+        signatures[key] = signature
+        heapq.heappush(schedule, (time.time() + intervals[key], next(seq), key))
@@ -3,7 +3,7 @@
 import argparse
 import subprocess
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from itertools import chain
 from pathlib import Path
@@ -17,7 +17,95 @@ if ippy_parent_dir not in sys.path:
     sys.path.append(ippy_parent_dir)
 
 from ippy.constants import SCIDBS1
-from ippy.misc import expname_pattern, infer_inst_from_expname
+from ippy.misc import expname_pattern, group_expnames_by_inst, parse_expnames
+
+# number of exposure names per "in (...)" clause when checking for existing chipRuns
+QUERY_CHUNK_SIZE = 1000
+
+
+def get_chunk_expnames(chunks, dateobses, dbnames):
+    """
+    resolve the exposures of all given chunks with one query per database
+
+    Parameters
+    ----------
+    chunks, dateobses, dbnames : list of str
+        chunk names and the dateobs and dbname of each chunk, of the same length
+
+    Returns
+    -------
+    list of str
+        exposure names of the chunks
+    """
+    chunks_per_db = {}
+    for chunk, dateobs, dbname in zip(chunks, dateobses, dbnames):
+        chunks_per_db.setdefault(dbname, []).append((chunk, dateobs))
+    expnames = []
+    db_conn = MySQLdb.connect(
+        host=SCIDBS1.node,
+        user=SCIDBS1.user,
+        passwd=SCIDBS1.password,
+    )
+    db_cursor = db_conn.cursor()
+    for dbname, chunk_dateobs_pairs in chunks_per_db.items():
+        chunk_conds = " or ".join(
+            ["(comment like %s and dateobs like %s)"] * len(chunk_dateobs_pairs)
+        )
+        query = f"""select exp_name, dateobs, reduction from {dbname}.rawExp where (obs_mode like '%%SS%%' or obs_mode like '%%BRIGHT%%') 
+        and obs_mode not like 'ENGINEERING' and obs_mode not like 'MANUAL' and exp_type like 'OBJECT' and comment like '%%visit%%' and 
+        ({chunk_conds})"""
+        params = []
+        for chunk, dateobs in chunk_dateobs_pairs:
+            params.extend([f"{chunk}%", f"{dateobs}%"])
+        db_cursor.execute(query, params)
+        expnames.extend([r[0] for r in db_cursor.fetchall()])
+    db_cursor.close()
+    db_conn.close()
+    return expnames
+
+
+def get_queued_expnames(expnames, label, data_group):
+    """
+    bulk check chipRun for exposures that are already queued with the given label and data_group
+
+    Parameters
+    ----------
+    expnames : list of str
+        exposure names to check
+    label : str
+        chipRun label
+    data_group : str
+        chipRun data_group
+
+    Returns
+    -------
+    set of str
+        exposure names that already have a chipRun with the label and data_group
+    """
+    expnames_per_db = group_expnames_by_inst(expnames)
+    queued = set()
+    db_conn = MySQLdb.connect(
+        host=SCIDBS1.node,
+        user=SCIDBS1.user,
+        passwd=SCIDBS1.password,
+    )
+    db_cursor = db_conn.cursor()
+    for dbname, expnames_ in expnames_per_db.items():
+        for i in range(0, len(expnames_), QUERY_CHUNK_SIZE):
+            expnames_chunk = expnames_[i : i + QUERY_CHUNK_SIZE]
+            query = f"""select exp_name from {dbname}.rawExp join {dbname}.chipRun using (exp_id) 
+            where chipRun.label like %s and chipRun.data_group like %s 
+            and exp_name in ({", ".join(["%s"] * len(expnames_chunk))})"""
+            db_cursor.execute(query, [label, data_group, *expnames_chunk])
+            queued.update(r[0] for r in db_cursor.fetchall())
+    db_cursor.close()
+    db_conn.close()
+    return queued
+
+
+def run_chiptool(cmd):
+    return subprocess.run(cmd, text=True, capture_output=True)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -64,6 +152,11 @@ if __name__ == "__main__":
         In this case, we need to reprocess the data with a new identifier, such as a different datagroup. The string will be used to append to the end of the default
         datagroup and workdir.""",
     )
+    parser.add_argument(
+        "--date",
+        help="""UTC date of the datagroup and the default workdir in the format YYYYMMDD, e.g. to resume a run started
+        on a previous day. Default: today""",
+    )
     parser.add_argument(
         "--end_stage",
         default="warp",
@@ -79,10 +172,24 @@ if __name__ == "__main__":
         action="store_true",
         help="Commit to queue the processing. Default: False when the flag is not specified so chiptool will run with -pretend.",
     )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=4,
+        help="Maximum number of chiptool commands running concurrently for each dbname. Default: 4",
+    )
+    parser.add_argument(
+        "--failed_list",
+        help="""File to write the exposure names for which chiptool failed, one per line. It can be passed to --expnames
+        to retry them. Default: <datagroup>.failed.txt in the current directory.""",
+    )
     args = parser.parse_args()
     label = args.label
     reduction = args.reduction
-    date = datetime.utcnow().strftime("%Y%m%d")
+    if args.date is None:
+        date = datetime.utcnow().strftime("%Y%m%d")
+    else:
+        date = datetime.strptime(args.date, "%Y%m%d").strftime("%Y%m%d")
     datagroup = f"{label}.{reduction}.{date}"
     if args.version is not None:
         # workdir += f".v{args.version}"
@@ -142,27 +249,22 @@ if __name__ == "__main__":
                 args.dbname = args.dbname * len(args.chunk)
             else:
                 parser.error("Length of dbname must be the same as chunk or 1.")
-        for chunk, dateobs, dbname in zip(args.chunk, args.dateobs, args.dbname):
-            db_conn = MySQLdb.connect(
-                host=SCIDBS1.node,
-                user=SCIDBS1.user,
-                passwd=SCIDBS1.password,
-                db=dbname,
-            )
-            db_cursor = db_conn.cursor()
-            query = f"""select exp_name, dateobs, reduction from rawExp  where (obs_mode like '%SS%' or obs_mode like '%BRIGHT%') 
-            and obs_mode not like 'ENGINEERING' and obs_mode not like 'MANUAL' and exp_type like 'OBJECT' and comment like '%visit%' and 
-            comment like '{chunk}%' and dateobs like '{dateobs}%'"""
-            db_cursor.execute(query)
-            result = db_cursor.fetchall()
-            db_cursor.close()
-            db_conn.close()
-            valid_expnames.extend([r[0] for r in result])
+        valid_expnames = get_chunk_expnames(args.chunk, args.dateobs, args.dbname)
     if len(valid_expnames) == 0:
         raise ValueError("No valid exposures found.")
+    # drop duplicates but keep the order
+    valid_expnames = list(dict.fromkeys(valid_expnames))
+    # skip the exposures already queued with the same label and datagroup, e.g. by a previous interrupted run
+    queued_expnames = get_queued_expnames(valid_expnames, label, datagroup)
+    if queued_expnames:
+        print(
+            f"Skipped {len(queued_expnames)} exposures already queued with label {label} and data_group {datagroup}."
+        )
+        valid_expnames = [e for e in valid_expnames if e not in queued_expnames]
 
-    for expname in valid_expnames:
-        dbname = infer_inst_from_expname(expname)
+    cmds_per_db = {}
+    dbnames = parse_expnames(valid_expnames)["camera"].tolist()
+    for expname, dbname in zip(valid_expnames, dbnames):
         if args.workdir is None:
             workdir = f"neb://@HOST@.0/{dbname}/{label}/{reduction}.{date}"
         else:
@@ -179,20 +281,60 @@ if __name__ == "__main__":
             "-set_workdir",
             workdir,
         ]
-        print(" ".join(run_chiptool_cmd))
-        try:
-            run_chiptool = subprocess.run(
-                run_chiptool_cmd,
-                text=True,
-                capture_output=True,
-                check=True,
-            )
-            print(run_chiptool.stdout)
-        except subprocess.CalledProcessError as e:
-            print(
-                f"Command '{' '.join(e.cmd)}' returned non-zero exit status, please check its stderr below."
-            )
-            # print(e.stdout)
-            print(e.stderr)
-            sys.exit(1)
-        time.sleep(0.01)
+        cmds_per_db.setdefault(dbname, []).append((expname, run_chiptool_cmd))
+
+    # run chiptool concurrently with at most max_workers commands per dbname and keep going on errors
+    failed_expnames = []
+    reported_expnames = set()
+    executors = {dbname: ThreadPoolExecutor(args.max_workers) for dbname in cmds_per_db}
+    futures = {}
+    try:
+        futures = {
+            executors[dbname].submit(run_chiptool, cmd): (expname, cmd)
+            for dbname, cmds in cmds_per_db.items()
+            for expname, cmd in cmds
+        }
+        for future in as_completed(futures):
+            expname, cmd = futures[future]
+            reported_expnames.add(expname)
+            print(" ".join(cmd))
+            try:
+                result = future.result()
+            except OSError as e:
+                print(f"Command '{' '.join(cmd)}' failed to run: {e}")
+                failed_expnames.append(expname)
+                continue
+            if result.returncode == 0:
+                print(result.stdout)
+            else:
+                print(
+                    f"Command '{' '.join(cmd)}' returned non-zero exit status, please check its stderr below."
+                )
+                print(result.stderr)
+                failed_expnames.append(expname)
+    except KeyboardInterrupt:
+        for future in futures:
+            future.cancel()
+        # the unreported commands are either cancelled or killed by the interruption
+        failed_expnames.extend(
+            expname
+            for expname, _ in futures.values()
+            if expname not in reported_expnames
+        )
+        print("Keyboard interruption. Waiting for the running chiptool commands.")
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+
+    num_cmds = sum(len(cmds) for cmds in cmds_per_db.values())
+    print(f"{num_cmds - len(failed_expnames)}/{num_cmds} chiptool commands succeeded.")
+    if failed_expnames:
+        failed_list = args.failed_list
+        if failed_list is None:
+            failed_list = f"{datagroup}.failed.txt"
+        with open(failed_list, "w") as f:
+            f.write("\n".join(failed_expnames) + "\n")
+        print(
+            f"Exposure names of the failed commands are written to {failed_list}. Pass it to --expnames to retry them."
+        )
+        sys.exit(1)
@@ -1,2 +1,3 @@
 from .common import *
 from .robust_stats import *
+from .streaming import *
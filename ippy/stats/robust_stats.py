@@ -1,4 +1,6 @@
 # from math import erf
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
 
 import numpy as np
 from astropy.stats import sigma_clip
@@ -7,30 +9,75 @@ from astropy.stats import sigma_clip
 
 
 def sigma_clip_stats(
-    x, sigma=3, sigma_lower=None, sigma_upper=None, axis=None, maxiters=10, ngood_min=1
+    x,
+    sigma=3,
+    sigma_lower=None,
+    sigma_upper=None,
+    axis=None,
+    maxiters=10,
+    ngood_min=1,
+    block_rows=None,
+    max_workers=None,
 ):
     """
-    wrapper of astropy.stats.sigma_clip
+    sigma clipped mean, median, std and error of the mean of x, with the semantics of astropy.stats.sigma_clip
+
+    When axis is given, e.g. to combine a stack of images, the output is computed in blocks along its first dimension
+    so that only the block is copied. Each block is sorted once along the clipped axes and all iterations reuse the
+    sorted values, accumulating in float32 for float32 or non-float data like astropy. Otherwise this is a wrapper of
+    astropy.stats.sigma_clip.
+
+    Parameters
+    ----------
+    x : array_like
+        data to clip, non-finite or masked values are ignored
+    sigma : float, optional
+        number of standard deviations of the clipping bounds, by default 3
+    sigma_lower : float, optional
+        number of standard deviations of the lower bound, by default sigma
+    sigma_upper : float, optional
+        number of standard deviations of the upper bound, by default sigma
+    axis : int or tuple of int, optional
+        axes to clip along, by default None to clip the flattened data
+    maxiters : int, optional
+        maximum number of clipping iterations, by default 10, or None to iterate until convergence
+    ngood_min : int, optional
+        minimum number of kept values to have valid statistics, by default 1
+    block_rows : int, optional
+        number of indices of the first output dimension in a block, by default None for blocks of about 16M values
+    max_workers : int, optional
+        number of threads processing the blocks, by default None to process them serially
 
     Returns
     -------
-    _type_
-        _description_
+    tuple
+        mean, median, std and error of the mean, NaN where fewer than ngood_min values are kept
     """
-    # x = np.asarray(x).ravel()
-    clipped = sigma_clip(
-        x,
-        sigma=sigma,
-        sigma_lower=sigma_lower,
-        sigma_upper=sigma_upper,
-        axis=axis,
-        maxiters=maxiters,
-        masked=False,
-    )
-    ngood = np.isfinite(clipped).sum(axis=axis)
-    mean = np.nanmean(clipped, axis=axis)
-    median = np.nanmedian(clipped, axis=axis)
-    std = np.nanstd(clipped, axis=axis)
+    if axis is None:
+        # x = np.asarray(x).ravel()
+        clipped = sigma_clip(
+            x,
+            sigma=sigma,
+            sigma_lower=sigma_lower,
+            sigma_upper=sigma_upper,
+            axis=axis,
+            maxiters=maxiters,
+            masked=False,
+        )
+        ngood = np.isfinite(clipped).sum(axis=axis)
+        mean = np.nanmean(clipped, axis=axis)
+        median = np.nanmedian(clipped, axis=axis)
+        std = np.nanstd(clipped, axis=axis)
+    else:
+        mean, median, std, ngood = _sigma_clip_stats_axis(
+            x,
+            sigma if sigma_lower is None else sigma_lower,
+            sigma if sigma_upper is None else sigma_upper,
+            axis,
+            maxiters,
+            block_rows,
+            max_workers,
+        )
     mean_err = std / np.sqrt(ngood)
     if ngood.ndim < 1:
         if ngood < ngood_min:
@@ -45,61 +92,418 @@ def sigma_clip_stats(
     return mean, median, std, mean_err
 
 
-def robust_binned_stats(
-    x, y, *, statistic="mean", bins=10, nsigma=3, maxiters=10, ngood_min=1
+def _sigma_clip_stats_axis(
+    x, sigma_lower, sigma_upper, axis, maxiters, block_rows, max_workers
 ):
-    x = np.asarray(x).ravel()
-    idx_sort = np.argsort(x)
-    x = x[idx_sort]
+    if isinstance(x, np.ma.MaskedArray):
+        x = x.astype(x.dtype if x.dtype.kind == "f" else np.float32).filled(np.nan)
+    else:
+        x = np.asanyarray(x)
+    dtype = x.dtype if x.dtype.kind == "f" else np.dtype(np.float32)
+    axis = tuple(np.atleast_1d(axis))
+    axis = tuple(x.ndim + n if n < 0 else n for n in axis)
+    # move the clipped axes last, a view of x
+    x = np.moveaxis(x, axis, range(x.ndim - len(axis), x.ndim))
+    out_shape = x.shape[: x.ndim - len(axis)]
+    k = int(np.prod(x.shape[len(out_shape) :]))
+    if not out_shape:
+        x = x[np.newaxis]
+    nrows = x.shape[0]
+    row_size = max(x[:1].size, 1)
+    if block_rows is None:
+        block_rows = max(2**24 // row_size, 1)
+    mean = np.empty(x.shape[: len(x.shape) - len(axis)], dtype=dtype)
+    median = np.empty_like(mean)
+    std = np.empty_like(mean)
+    ngood = np.empty(mean.shape, dtype=np.intp)
+
+    def process(i):
+        block = x[i : i + block_rows]
+        stats = _sigma_clip_stats_rows(
+            block.reshape(-1, k).astype(dtype, copy=False),
+            sigma_lower,
+            sigma_upper,
+            maxiters,
+        )
+        for out, stat in zip((mean, median, std, ngood), stats):
+            out[i : i + block_rows] = stat.reshape(out[i : i + block_rows].shape)
+
+    blocks = range(0, nrows, block_rows)
+    if max_workers is None or max_workers <= 1:
+        for i in blocks:
+            process(i)
+    else:
+        with ThreadPoolExecutor(max_workers) as executor:
+            list(executor.map(process, blocks))
+    if not out_shape:
+        return mean[0], median[0], std[0], ngood[0]
+    return mean, median, std, ngood
+
+
+class BinnedStats(NamedTuple):
+    """sigma clipped statistics of each bin, NaN where a bin has fewer than ngood_min good points"""
+
+    mean: np.ndarray
+    median: np.ndarray
+    std: np.ndarray
+    mean_err: np.ndarray
+    ngood: np.ndarray
+    bin_edges: np.ndarray
+
+
+def _sorted_median(values, lo, hi):
+    # median of values[lo:hi] of each group, where values are sorted within each group
+    if values.size == 0:
+        return np.full(lo.shape, np.nan)
+    n = hi - lo
+    lower = np.clip(lo + (n - 1) // 2, 0, values.size - 1)
+    upper = np.clip(lo + n // 2, 0, values.size - 1)
+    return np.where(n > 0, 0.5 * (values[lower] + values[upper]), np.nan)
+
+
+def _searchsorted_groups(values, lo, hi, targets, side="left"):
+    # np.searchsorted of each target in values[lo:hi] of its group, bisecting all groups at once
+    lo, hi = lo.copy(), hi.copy()
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        v = values[np.where(active, mid, 0)]
+        with np.errstate(invalid="ignore"):
+            go_right = v < targets if side == "left" else v <= targets
+        lo = np.where(active & go_right, mid + 1, lo)
+        hi = np.where(active & ~go_right, mid, hi)
+        active = lo < hi
+    return lo
+
+
+def _clip_sorted_ranges(
+    values, lo, hi, moments, shrink, sigma_lower, sigma_upper, maxiters, center
+):
+    # iterative clipping of the ranges values[lo:hi] of sorted values, where moments(lo, hi, idx) returns the mean and
+    # std of the ranges of groups idx relative to center, and shrink(lo, hi, lower, upper, idx) returns the ranges of
+    # the values within the bounds. only the groups changed by the last iteration are clipped again.
+    maxiters = np.inf if maxiters is None else maxiters
+    lo, hi = lo.copy(), hi.copy()
+    active = np.arange(lo.size)
+    iteration = 0
+    while iteration < maxiters and active.size:
+        iteration += 1
+        lo_, hi_ = lo[active], hi[active]
+        median = _sorted_median(values, lo_, hi_)
+        std = moments(lo_, hi_, active)[1]
+        # clipped values never come back, like astropy.stats.sigma_clip
+        lo_new, hi_new = shrink(
+            lo_, hi_, median - sigma_lower * std, median + sigma_upper * std, active
+        )
+        lo[active], hi[active] = lo_new, hi_new
+        active = active[(lo_new != lo_) | (hi_new != hi_)]
+    mean, std = moments(lo, hi, slice(None))
+    return mean + center, _sorted_median(values, lo, hi), std, hi - lo
+
+
+def _sigma_clip_stats_rows(x, sigma_lower, sigma_upper, maxiters):
+    # sigma clipped statistics of each row of a 2D array, non-finite values are ignored
+    x = np.where(np.isfinite(x), x, np.nan)
+    x.sort(axis=1)
+    nrows, k = x.shape
+    values = x.ravel()
+    # NaNs are sorted last
+    lo = np.arange(nrows) * k
+    hi = lo + k - np.count_nonzero(np.isnan(x), axis=1)
+    # center each row at its initial median and accumulate along the rows, so that float32 cumulative sums of short
+    # rows do not lose precision, while long rows like whole cells are accumulated in float64
+    dtype = x.dtype if k <= 4096 else np.float64
+    center = np.nan_to_num(_sorted_median(values, lo, hi)).astype(dtype)
+    centered = x - center[:, None]
+    centered[np.isnan(centered)] = 0
+    csum = np.zeros((nrows, k + 1), dtype=dtype)
+    np.cumsum(centered, axis=1, out=csum[:, 1:])
+    np.square(centered, out=centered)
+    csum2 = np.zeros((nrows, k + 1), dtype=dtype)
+    np.cumsum(centered, axis=1, out=csum2[:, 1:])
+    del centered
+    csum, csum2 = csum.ravel(), csum2.ravel()
+    # index of the cumulative sums of the value at index i of row r is i + r
+    rows = np.arange(nrows)
+
+    def moments(lo, hi, idx):
+        n = hi - lo
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = (csum[hi + rows[idx]] - csum[lo + rows[idx]]) / n
+            var = (csum2[hi + rows[idx]] - csum2[lo + rows[idx]]) / n - mean**2
+        return mean, np.sqrt(np.maximum(var, 0))
+
+    def shrink(lo, hi, lower, upper, idx):
+        if k > 64:
+            lo_new = _searchsorted_groups(values, lo, hi, lower)
+            return lo_new, _searchsorted_groups(values, lo_new, hi, upper, side="right")
+        # comparing short rows with the bounds is cheaper than bisecting them, NaNs compare False
+        x_ = x[idx]
+        with np.errstate(invalid="ignore"):
+            lo_new = np.maximum(
+                lo, idx * k + np.count_nonzero(x_ < lower[:, None], axis=1)
+            )
+            hi_new = np.minimum(
+                hi, idx * k + np.count_nonzero(x_ <= upper[:, None], axis=1)
+            )
+        return lo_new, np.maximum(hi_new, lo_new)
+
+    return _clip_sorted_ranges(
+        values, lo, hi, moments, shrink, sigma_lower, sigma_upper, maxiters, center
+    )
+
+
+def grouped_sigma_clip_stats(
+    values, labels, ngroups, sigma=3, sigma_lower=None, sigma_upper=None, maxiters=10
+):
+    """
+    sigma clipped statistics of many groups of values at once, with the same semantics as calling sigma_clip_stats
+    on each group
+
+    The values are sorted once by group and value, so the values kept by the iterative clipping of each group are a
+    contiguous range of its sorted values. Every iteration then updates the ranges of the groups that changed with
+    segment sums over the ranges, medians taken at the offsets of the ranges, and a bisection of the clipping bounds.
+
+    Parameters
+    ----------
+    values : array_like
+        values to clip, non-finite values are ignored
+    labels : array_like of int
+        group of each value, values whose labels are outside [0, ngroups) are ignored
+    ngroups : int
+        number of groups
+    sigma : float, optional
+        number of standard deviations of the clipping bounds, by default 3
+    sigma_lower : float, optional
+        number of standard deviations of the lower bound, by default sigma
+    sigma_upper : float, optional
+        number of standard deviations of the upper bound, by default sigma
+    maxiters : int, optional
+        maximum number of clipping iterations, by default 10, or None to iterate until convergence
+
+    Returns
+    -------
+    tuple of np.ndarray
+        mean, median, std and number of kept values of each group, where the statistics are NaN for empty groups
+    """
+    sigma_lower = sigma if sigma_lower is None else sigma_lower
+    sigma_upper = sigma if sigma_upper is None else sigma_upper
+    values = np.asarray(values, dtype=float).ravel()
+    labels = np.asarray(labels).ravel()
+    good = np.isfinite(values) & (labels >= 0) & (labels < ngroups)
+    values = values[good]
+    labels = labels[good].astype(np.intp)
+    # a stable sort of the small integer labels is a radix sort
+    label_dtype = np.int16 if ngroups <= np.iinfo(np.int16).max else np.intp
+    order = np.argsort(values)
+    order = order[np.argsort(labels[order].astype(label_dtype), kind="stable")]
+    values = values[order]
+    labels = labels[order]
+    edges = np.searchsorted(labels, np.arange(ngroups + 1))
+    start, end = edges[:-1], edges[1:]
+    lo, hi = start.copy(), end.copy()
+    # center each group at its initial median so that the sums do not lose precision, and sum each group on its own,
+    # since differences of cumulative sums over all groups lose the precision of groups of small spread after groups
+    # of large spread. a trailing zero lets the ranges end at the last value.
+    center = np.nan_to_num(_sorted_median(values, lo, hi))
+    centered = np.append(values - center[labels], 0.0)
+    centered2 = centered**2
+
+    def moments(lo, hi, idx):
+        n = hi - lo
+        if n.size == 0:
+            return np.full(0, np.nan), np.full(0, np.nan)
+        # the ranges of the groups are ordered and disjoint, so the sums of [lo, hi) are every other segment sum
+        bounds = np.column_stack((lo, hi)).ravel()
+        sums = np.where(n > 0, np.add.reduceat(centered, bounds)[::2], 0)
+        sums2 = np.where(n > 0, np.add.reduceat(centered2, bounds)[::2], 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = sums / n
+            var = sums2 / n - mean**2
+        return mean, np.sqrt(np.maximum(var, 0))
+
+    def shrink(lo, hi, lower, upper, idx):
+        lo_new = _searchsorted_groups(values, lo, hi, lower)
+        return lo_new, _searchsorted_groups(values, lo_new, hi, upper, side="right")
+
+    return _clip_sorted_ranges(
+        values, lo, hi, moments, shrink, sigma_lower, sigma_upper, maxiters, center
+    )
+
+
+def _as_list_of_values(x, y, name="y"):
+    # y or each element of a list of y raveled, checked against the shape of x
     if not isinstance(y, list):
         y = np.asarray(y).ravel()
         if y.shape != x.shape:
-            raise ValueError("x and y must have the same shape")
-        y = [y[idx_sort]]
-    else:
-        for i in range(len(y)):
-            y[i] = np.asarray(y[i]).ravel()
-            if y[i].shape != x.shape:
-                raise ValueError("x and each elemeent of y must have the same shape")
-            y[i] = y[i][idx_sort]
-    if isinstance(bins, int):
+            raise ValueError(f"x and {name} must have the same shape")
+        return [y]
+    y = [np.asarray(y_).ravel() for y_ in y]
+    for y_ in y:
+        if y_.shape != x.shape:
+            raise ValueError(f"x and each elemeent of {name} must have the same shape")
+    return y
+
+
+def _bin_edges(x, bins):
+    # number of bins and bin edges from the number of equal-width bins or the edges
+    if isinstance(bins, (int, np.integer)):
         if bins < 1:
             raise ValueError(
                 "bins must be a positive integer when specifying the number of bins"
             )
-        nbins = bins
-        bins = np.linspace(x.min(), x.max(), nbins + 1)
-    else:
-        try:
-            nbins = len(bins) - 1
-        except TypeError:
-            raise TypeError("bins must be an integer or a sequence")
-        if nbins < 1:
-            raise ValueError(
-                "bins must encompass at least one bin when specifying the edges of bins"
-            )
-    bins_num = np.digitize(x, bins)
-    # include the last point in the last bin, don't want to have a single bin that contains only the last point
-    bins_num[-1] = nbins
+        return bins, np.linspace(x.min(), x.max(), bins + 1)
+    try:
+        nbins = len(bins) - 1
+    except TypeError:
+        raise TypeError("bins must be an integer or a sequence")
+    if nbins < 1:
+        raise ValueError(
+            "bins must encompass at least one bin when specifying the edges of bins"
+        )
+    return nbins, np.asarray(bins)
+
+
+def _binned_stats(y, labels, shape, bin_edges, statistic, nsigma, maxiters, ngood_min):
+    # statistics of each y in the bins given by labels, clipping all bins of each y in one pass
+    if statistic not in ("mean", "median", "std", "mean err", "all"):
+        raise ValueError(
+            "statistic must be one of 'mean', 'median', 'std', 'mean err' or 'all'"
+        )
+    nbins = int(np.prod(shape))
     res = []
-    for i in range(len(y)):
-        y_ = y[i]
-        res_ = np.full(nbins, np.nan)
-        for i in range(nbins):
-            idx_bin = bins_num == i + 1
-            mean, median, std, mean_err = sigma_clip_stats(
-                y_[idx_bin], sigma=nsigma, maxiters=maxiters, ngood_min=ngood_min
-            )
-            if statistic == "mean":
-                res_[i] = mean
-            if statistic == "median":
-                res_[i] = median
-            if statistic == "std":
-                res_[i] = std
-            if statistic == "mean err":
-                res_[i] = mean_err
-        res.append(res_)
+    # each y is clipped on its own, since the y of a list may have very different scales
+    for y_ in y:
+        mean, median, std, ngood = grouped_sigma_clip_stats(
+            y_, labels, nbins, sigma=nsigma, maxiters=maxiters
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_err = std / np.sqrt(ngood)
+        idx = ngood < ngood_min
+        for stat in (mean, median, std, mean_err):
+            stat[idx] = np.nan
+        stats = BinnedStats(
+            *(stat.reshape(shape) for stat in (mean, median, std, mean_err, ngood)),
+            bin_edges,
+        )
+        if statistic == "all":
+            res.append(stats)
+        else:
+            res.append(getattr(stats, statistic.replace(" ", "_")))
     if len(res) == 1:
         return res[0]
     else:
         return res
+
+
+def robust_binned_stats(
+    x, y, *, statistic="mean", bins=10, nsigma=3, maxiters=10, ngood_min=1
+):
+    """
+    sigma clipped statistics of y in bins of x
+
+    All bins of each y are clipped in one pass by grouped_sigma_clip_stats.
+
+    Parameters
+    ----------
+    x : array_like
+        values to bin
+    y : array_like or list of array_like
+        values to compute the statistics of, or a list of them sharing the same x
+    statistic : str, optional
+        "mean", "median", "std", "mean err", or "all" for a BinnedStats of all statistics, by default "mean"
+    bins : int or sequence, optional
+        number of equal-width bins between the minimum and maximum of x, or the bin edges, by default 10
+    nsigma : float, optional
+        number of standard deviations of the clipping bounds, by default 3
+    maxiters : int, optional
+        maximum number of clipping iterations, by default 10
+    ngood_min : int, optional
+        minimum number of points kept in a bin to have valid statistics, by default 1
+
+    Returns
+    -------
+    np.ndarray or BinnedStats, or a list of them if y is a list
+        the statistic of each bin
+    """
+    x = np.asarray(x).ravel()
+    y = _as_list_of_values(x, y)
+    nbins, bins = _bin_edges(x, bins)
+    bins_num = np.digitize(x, bins)
+    # include the last point in the last bin, don't want to have a single bin that contains only the last point
+    bins_num[np.argmax(x)] = nbins
+    return _binned_stats(
+        y, bins_num - 1, (nbins,), bins, statistic, nsigma, maxiters, ngood_min
+    )
+
+
+def robust_binned_stats_2d(
+    x, y, z, *, statistic="mean", bins=10, nsigma=3, maxiters=10, ngood_min=1
+):
+    """
+    sigma clipped statistics of z in 2D bins of x and y, e.g. a focal-plane map
+
+    The bins follow np.histogram2d, where points on the upper edge of an axis belong to its last bin. All bins of each
+    z are clipped in one pass by grouped_sigma_clip_stats, with the same semantics as robust_binned_stats.
+
+    Parameters
+    ----------
+    x : array_like
+        values to bin along the first axis
+    y : array_like
+        values to bin along the second axis
+    z : array_like or list of array_like
+        values to compute the statistics of, or a list of them sharing the same x and y
+    statistic : str, optional
+        "mean", "median", "std", "mean err", or "all" for a BinnedStats of all statistics, by default "mean"
+    bins : int or tuple, optional
+        number of equal-width bins of both axes, or a tuple of the number of bins or the bin edges of each axis,
+        by default 10
+    nsigma : float, optional
+        number of standard deviations of the clipping bounds, by default 3
+    maxiters : int, optional
+        maximum number of clipping iterations, by default 10
+    ngood_min : int, optional
+        minimum number of points kept in a bin to have valid statistics, by default 1
+
+    Returns
+    -------
+    np.ndarray or BinnedStats, or a list of them if z is a list
+        the statistic of each bin with the shape (number of x bins, number of y bins), where bin_edges of BinnedStats
+        is a tuple of the edges of each axis
+    """
+    x = np.asarray(x).ravel()
+    y = np.asarray(y).ravel()
+    if y.shape != x.shape:
+        raise ValueError("x and y must have the same shape")
+    z = _as_list_of_values(x, z, name="z")
+    if isinstance(bins, (int, np.integer)):
+        bins = (bins, bins)
+    elif len(bins) != 2:
+        raise ValueError(
+            "bins must be an integer or a tuple of the bins of the two axes"
+        )
+    shape = []
+    bin_edges = []
+    labels = np.zeros(x.shape, dtype=np.intp)
+    is_binned = np.ones(x.shape, dtype=bool)
+    for v, bins_ in zip((x, y), bins):
+        nbins, edges = _bin_edges(v, bins_)
+        bins_num = np.digitize(v, edges) - 1
+        bins_num[v == edges[-1]] = nbins - 1
+        is_binned &= (bins_num >= 0) & (bins_num < nbins)
+        labels = labels * nbins + bins_num
+        shape.append(nbins)
+        bin_edges.append(edges)
+    # points outside of the bins are dropped
+    labels[~is_binned] = -1
+    return _binned_stats(
+        z,
+        labels,
+        tuple(shape),
+        tuple(bin_edges),
+        statistic,
+        nsigma,
+        maxiters,
+        ngood_min,
+    )
@@ -0,0 +1,240 @@
+import itertools
+
+import numpy as np
+
+
+def _finite(chunk):
+    chunk = np.asarray(chunk, dtype=float).ravel()
+    return chunk[np.isfinite(chunk)]
+
+
+class StreamingRMS:
+    """
+    root mean square of data seen in chunks, the streaming equivalent of ippy.stats.rms
+
+    Non-finite values are ignored. Accumulators of different chunks, e.g. computed in separate processes, are
+    combined exactly with merge.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.sumsq = 0.0
+
+    def update(self, chunk):
+        chunk = _finite(chunk)
+        self.n += chunk.size
+        self.sumsq += np.dot(chunk, chunk)
+        return self
+
+    def merge(self, other):
+        self.n += other.n
+        self.sumsq += other.sumsq
+        return self
+
+    def result(self):
+        return np.sqrt(self.sumsq / self.n) if self.n else np.nan
+
+
+class StreamingMeanStd:
+    """
+    mean and standard deviation (ddof=0) of data seen in chunks
+
+    Each chunk is reduced with numpy and combined with the running moments by the pairwise update of Chan et al.
+    (1979), the parallel form of Welford's algorithm, so the result is as accurate as a single pass over all the data
+    and merging accumulators is exact.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def _combine(self, n, mean, m2):
+        if n == 0:
+            return self
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.n * n / total
+        self.n = total
+        return self
+
+    def update(self, chunk):
+        chunk = _finite(chunk)
+        if chunk.size == 0:
+            return self
+        mean = chunk.mean()
+        return self._combine(chunk.size, mean, np.sum((chunk - mean) ** 2))
+
+    def merge(self, other):
+        return self._combine(other.n, other.mean, other.m2)
+
+    def result(self):
+        """
+        Returns
+        -------
+        tuple
+            mean and standard deviation, NaN if no data
+        """
+        if self.n == 0:
+            return np.nan, np.nan
+        return self.mean, np.sqrt(self.m2 / self.n)
+
+
+class _StreamingHistogram:
+    # counts, sums and sums of squares of the values relative to the centers of fixed bins, with the underflow and
+    # overflow in the first and last elements, so that accumulators with the same bins merge exactly and the moments
+    # do not suffer from cancellation
+
+    def __init__(self, lo, hi, nbins=10000):
+        if not hi > lo:
+            raise ValueError("hi must be greater than lo")
+        if nbins < 1:
+            raise ValueError("nbins must be a positive integer")
+        self.bin_edges = np.linspace(lo, hi, nbins + 1)
+        self.bin_centers = np.concatenate(
+            ([lo], 0.5 * (self.bin_edges[:-1] + self.bin_edges[1:]), [hi])
+        )
+        self.counts = np.zeros(nbins + 2, dtype=np.int64)
+        self.sums = np.zeros(nbins + 2)
+        self.sumsq = np.zeros(nbins + 2)
+
+    @property
+    def bin_width(self):
+        return self.bin_edges[1] - self.bin_edges[0]
+
+    def update(self, chunk):
+        chunk = _finite(chunk)
+        idx = np.searchsorted(self.bin_edges, chunk, side="right")
+        # the upper edge belongs to the last bin like np.histogram
+        idx[chunk == self.bin_edges[-1]] = self.bin_edges.size - 1
+        chunk = chunk - self.bin_centers[idx]
+        minlength = self.counts.size
+        self.counts += np.bincount(idx, minlength=minlength)
+        self.sums += np.bincount(idx, weights=chunk, minlength=minlength)
+        self.sumsq += np.bincount(idx, weights=chunk**2, minlength=minlength)
+        return self
+
+    def merge(self, other):
+        if not np.array_equal(self.bin_edges, other.bin_edges):
+            raise ValueError("only accumulators with the same bins can be merged")
+        self.counts += other.counts
+        self.sums += other.sums
+        self.sumsq += other.sumsq
+        return self
+
+    def _median(self, keep, outside=False):
+        # median of the values in the kept bins, and the underflow and overflow if outside, interpolated linearly
+        # within the bin of the middle rank
+        counts = np.where(keep, self.counts[1:-1], 0)
+        under, over = (self.counts[0], self.counts[-1]) if outside else (0, 0)
+        n = under + counts.sum() + over
+        rank = 0.5 * n
+        if n == 0 or not under < rank <= n - over:
+            return np.nan
+        cumcounts = under + np.cumsum(counts)
+        i = np.searchsorted(cumcounts, rank)
+        below = cumcounts[i] - counts[i]
+        return self.bin_edges[i] + (rank - below) / counts[i] * self.bin_width
+
+
+class StreamingMedian(_StreamingHistogram):
+    """
+    approximate median of data seen in chunks, from a histogram with fixed bins
+
+    The median is interpolated within the bin of the middle rank, so it is within one bin width, (hi - lo) / nbins,
+    of the exact median as long as the exact median lies in [lo, hi]. It is NaN if more than half of the values are
+    outside [lo, hi]. Accumulators with the same lo, hi and nbins are merged exactly.
+
+    Parameters
+    ----------
+    lo : float
+        lower edge of the histogram
+    hi : float
+        upper edge of the histogram
+    nbins : int, optional
+        number of bins, by default 10000
+    """
+
+    def result(self):
+        return self._median(np.ones(self.counts.size - 2, dtype=bool), outside=True)
+
+
+class StreamingClippedMean(_StreamingHistogram):
+    """
+    approximate sigma clipped statistics of data seen in chunks, from a histogram with fixed bins that keeps the
+    count, sum and sum of squares of each bin
+
+    The clipping iterates like ippy.stats.sigma_clip_stats, keeping the bins whose centers are within the bounds
+    around the median of the kept bins. The mean and std are exact for the values in the kept bins, which differ from
+    the exactly clipped values only by those within half a bin width of the bounds; the median is within one bin
+    width of the median of the kept values. Values outside [lo, hi] are always clipped, so the histogram should
+    encompass the bounds. Accumulators with the same lo, hi and nbins are merged exactly.
+
+    Parameters
+    ----------
+    lo : float
+        lower edge of the histogram
+    hi : float
+        upper edge of the histogram
+    nbins : int, optional
+        number of bins, by default 10000
+    sigma : float, optional
+        number of standard deviations of the clipping bounds, by default 3
+    maxiters : int, optional
+        maximum number of clipping iterations, by default 10, or None to iterate until no bin is clipped
+    ngood_min : int, optional
+        minimum number of kept values to have valid statistics, by default 1
+    """
+
+    def __init__(self, lo, hi, nbins=10000, sigma=3, maxiters=10, ngood_min=1):
+        super().__init__(lo, hi, nbins)
+        self.sigma = sigma
+        self.maxiters = maxiters
+        self.ngood_min = ngood_min
+
+    def _moments(self, keep):
+        counts = self.counts[1:-1][keep]
+        n = counts.sum()
+        if n == 0:
+            return n, np.nan, np.nan
+        centers = self.bin_centers[1:-1][keep]
+        sums = self.sums[1:-1][keep]
+        mean = (sums.sum() + np.dot(counts, centers)) / n
+        # sum of the squares relative to the mean from those relative to the bin centers
+        offsets = centers - mean
+        m2 = (
+            self.sumsq[1:-1][keep].sum()
+            + 2 * np.dot(offsets, sums)
+            + np.dot(counts, offsets**2)
+        )
+        return n, mean, np.sqrt(max(m2 / n, 0))
+
+    def result(self):
+        """
+        Returns
+        -------
+        tuple
+            mean, median, std and error of the mean of the kept values like ippy.stats.sigma_clip_stats
+        """
+        centers = self.bin_centers[1:-1]
+        keep = np.ones(centers.size, dtype=bool)
+        # the kept bins only shrink, so the clipping converges without maxiters
+        iterations = (
+            itertools.count() if self.maxiters is None else range(self.maxiters)
+        )
+        for _ in iterations:
+            n, mean, std = self._moments(keep)
+            median = self._median(keep)
+            keep_new = (
+                keep
+                & (centers >= median - self.sigma * std)
+                & (centers <= median + self.sigma * std)
+            )
+            if np.array_equal(keep_new, keep):
+                break
+            keep = keep_new
+        n, mean, std = self._moments(keep)
+        if n < max(self.ngood_min, 1):
+            return np.nan, np.nan, np.nan, np.nan
+        return mean, self._median(keep), std, std / np.sqrt(n)
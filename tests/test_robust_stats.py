@@ -0,0 +1,31 @@
+import numpy as np
+
+from ippy.stats import sigma_clip_stats
+from ippy.stats.robust_stats import grouped_sigma_clip_stats, robust_binned_stats
+
+
+def test_robust_binned_stats_list_of_y_with_mixed_scales():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 1, 100000)
+    flux = rng.normal(1e9, 1e7, x.size)
+    mag = rng.normal(15, 0.003, x.size)
+    std_together = robust_binned_stats(x, [flux, mag], statistic="std", bins=5)[1]
+    std_alone = robust_binned_stats(x, mag, statistic="std", bins=5)
+    np.testing.assert_allclose(std_together, std_alone)
+    np.testing.assert_allclose(std_alone, 0.003, rtol=0.05)
+
+
+def test_grouped_sigma_clip_stats_groups_with_mixed_scales():
+    rng = np.random.default_rng(1)
+    labels = rng.integers(0, 4, 100000)
+    values = np.where(
+        labels == 0,
+        rng.normal(1e9, 1e7, labels.size),
+        rng.normal(15, 0.003, labels.size),
+    )
+    mean, median, std, _ = grouped_sigma_clip_stats(values, labels, 4)
+    for group in range(4):
+        expected = sigma_clip_stats(values[labels == group], sigma=3, maxiters=10)
+        np.testing.assert_allclose(
+            (mean[group], median[group], std[group]), expected[:3], rtol=1e-9
+        )
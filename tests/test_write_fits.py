@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ippy.io import write_hdus
+
+
+@pytest.mark.parametrize("compression_type", ["RICE_1", "GZIP_1", "HCOMPRESS_1"])
+def test_write_hdus_bands_with_nan_only_in_later_band(tmp_path, compression_type):
+    # ZBLANK is only in the header of the bands with NaNs, here the last of 4
+    data = np.random.default_rng(0).normal(1000, 10, (400, 300)).astype(np.float32)
+    data[350] = np.nan
+    settings = dict(
+        compression_type=compression_type,
+        tile_shape=(10, 300),
+        quantize_method=1,
+        dither_seed=9999,
+    )
+    write_hdus(
+        [fits.PrimaryHDU(), fits.CompImageHDU(data, **settings)],
+        tmp_path / "bands.fits",
+        max_workers=4,
+    )
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, **settings)]).writeto(
+        tmp_path / "once.fits"
+    )
+    with fits.open(tmp_path / "bands.fits") as bands, fits.open(
+        tmp_path / "once.fits"
+    ) as once:
+        assert np.isnan(bands[1].data[350]).all()
+        np.testing.assert_array_equal(bands[1].data, once[1].data)